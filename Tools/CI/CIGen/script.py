@@ -56,9 +56,9 @@ class BuildStage(IStage):
             variation) + ":\n")
         file.write("  stage: build\n")
         file.write("  before_script:\n")
-        file.write("    - python Tools/CI/beforescript.py Editor\n")
+        file.write("    - python -m Tools.CI.beforescript Editor\n")
         file.write("  after_script:\n")
-        file.write("    - python Tools/CI/afterscript.py\n")
+        file.write("    - python -m Tools.CI.afterscript\n")
 
         if schedule_only:
             file.write("  only:\n")
@@ -147,7 +147,7 @@ class RunStage(IStage):
             variation) + ":\n")
 
         file.write("  before_script:\n")
-        file.write("    - python Tools/CI/beforescript.py Player\n")
+        file.write("    - python -m Tools.CI.beforescript Player\n")
 
         file.write("  variables:\n    GIT_STRATEGY: fetch\n")
         file.write("  stage: run\n")
@@ -209,9 +209,9 @@ class TestStage(IStage):
             file.write(name_prefix + tag["name"] + ":test:" + _clean_variation(variation) + ":\n")
             file.write("  stage: test\n")
             file.write("  before_script:\n")
-            file.write("    - python Tools/CI/beforescript.py Editor\n")
+            file.write("    - python -m Tools.CI.beforescript Editor\n")
             file.write("  after_script:\n")
-            file.write("    - python Tools/CI/afterscript.py\n")
+            file.write("    - python -m Tools.CI.afterscript\n")
             if schedule_only:
                 file.write("  only:\n")
             else:
@@ -265,7 +265,7 @@ class ValidationStage():
         file.write(name_prefix + "validation:" + _clean_variation(variation) + ":\n")
         file.write("  stage: validation\n")
         file.write("  script:\n")
-        file.write("    - python Tools/CI/validation.py --build-version '{0}' "
+        file.write("    - python -m Tools.CI.validation --build-version '{0}' "
                    "--package-path Samples/Packages/com.unity.entities "
                    "--package-path Samples/Packages/com.unity.jobs "
                    "--package-path Samples/Packages/com.unity.collections\n".format(variation))
@@ -4,7 +4,9 @@ import shutil
 import tarfile
 import zipfile
 
-import requests
+from ..Publishing.request_policy import RequestPolicy
+
+request_policy = RequestPolicy()
 
 
 def get_current_os():
@@ -19,9 +21,9 @@ def get_current_os():
 
 def get_url_json(url):
     print "  Getting json from {0}".format(url)
-    import urllib2
-    response = urllib2.urlopen(url)
-    return json.loads(response.read())
+    response = request_policy.request("GET", url, hedge=True)
+    response.raise_for_status()
+    return json.loads(response.content)
 
 
 def extract_tarball(download_path, extract_path):
@@ -34,9 +36,16 @@ def extract_tarball(download_path, extract_path):
 def download_url(url, filename):
     print "  Downloading %s to %s" % (url, filename)
 
-    r = requests.get(url, stream=True)
-    with open(filename, 'wb') as f:
-        shutil.copyfileobj(r.raw, f)
+    def download():
+        r = request_policy.request("GET", url, retry=False, stream=True)
+        try:
+            r.raise_for_status()
+            with open(filename, 'wb') as f:
+                shutil.copyfileobj(r.raw, f)
+        finally:
+            r.close()
+
+    request_policy.retry(url, "downloading {0}".format(url), download)
 
 
 def extract_zip(archive, destination):
@@ -0,0 +1,288 @@
+"""
+Benchmarks for the hot paths of publishStable, run against synthetic packages so they don't need a registry or a
+Unity project. Run them from this folder with the publishing folder on the PYTHONPATH, like the tests:
+
+    python benchmarks.py                                 run everything and print the results
+    python benchmarks.py --output results.json           also write the results as json
+    python benchmarks.py --compare benchmark_baseline.json
+    python benchmarks.py --update-baseline
+
+--compare exits with 1 if any benchmark got slower than the baseline by more than --tolerance. The baseline is only
+meaningful on a similar machine, so update it together with changes that are expected to change the timings.
+"""
+import argparse
+import hashlib
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import tarfile
+import tempfile
+import timeit
+
+import publishStable
+from publishStable import _get_all_files_in_package
+from publishStable import cmp_directories_ignore_line_endings
+from publishStable import cmp_files
+from publishStable import compare_package_files
+from publishStable import compare_tarball_with_folder
+from publishStable import pack_local_package
+from publishStable import parse_package_json
+
+RESULTS_FORMAT = 1
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmark_baseline.json")
+BLOCK_SIZE = 64 * 1024
+WORDS = ["using", "Unity", "Entities", "struct", "public", "void", "float3", "return", "var", "int", "//", "{", "}",
+         "namespace", "IJobParallelFor", "EntityManager", "ComponentSystem", "=", "+", "new", "NativeArray<int>"]
+
+# Packages to generate. Sizes are picked from a log uniform distribution between min_size and max_size, so there are
+# many small files and a few big ones like in real packages
+SCENARIOS = {
+    "many_small_files": {"file_count": 2000, "min_size": 256, "max_size": 32 * 1024, "binary_ratio": 0.1,
+                         "crlf_ratio": 0.3, "seed": 1},
+    "few_large_files": {"file_count": 12, "min_size": 512 * 1024, "max_size": 8 * 1024 * 1024, "binary_ratio": 0.25,
+                        "crlf_ratio": 0.5, "seed": 2},
+}
+
+
+def _text_block(rng, line_ending):
+    lines = []
+    size = 0
+    while size < BLOCK_SIZE:
+        line = " " * (4 * rng.randint(0, 3)) + " ".join(rng.choice(WORDS) for _ in range(rng.randint(0, 12)))
+        lines.append(line)
+        size += len(line) + len(line_ending)
+    return line_ending.join(lines) + line_ending
+
+
+def _binary_block(seed):
+    # A NUL byte at the start so it is detected as binary, followed by bytes that look random
+    digests = []
+    digest = hashlib.sha512(str(seed)).digest()
+    for _ in range(BLOCK_SIZE / len(digest)):
+        digest = hashlib.sha512(digest).digest()
+        digests.append(digest)
+    return "\0" + "".join(digests)
+
+
+def _content(block, size, offset):
+    repeated = block * (size / len(block) + 2)
+    return repeated[offset % len(block):][:size]
+
+
+def generate_package(folder, name, file_count, min_size, max_size, binary_ratio, crlf_ratio, seed):
+    # type: (str, str, int, int, int, float, float, int) -> list
+    """
+    Writes a package with file_count files to folder, and returns the relative paths of the files together with
+    whether they are binary. binary_ratio is the share of binary files and crlf_ratio the share of text files that use
+    CRLF line endings. The same arguments always give the same package
+    """
+    rng = random.Random(seed)
+    blocks = {"\n": _text_block(rng, "\n"), "\r\n": _text_block(rng, "\r\n"), "binary": _binary_block(seed)}
+
+    os.makedirs(folder)
+    with open(os.path.join(folder, "package.json"), 'w') as f:
+        json.dump({"name": name, "version": "0.1.0", "dependencies": {}, "description": name,
+                   "keywords": ["benchmark"]}, f, indent=4)
+
+    files = []
+    for i in range(file_count):
+        # Around 20 files per folder, up to three levels deep
+        relative_folder = "/".join("Folder{0}".format(d) for d in str(i / 20)[-3:])
+        is_binary = rng.random() < binary_ratio
+        relative_path = "{0}/File{1}.{2}".format(relative_folder, i, "bytes" if is_binary else "cs")
+        size = int(min_size * (float(max_size) / min_size) ** rng.random())
+
+        if is_binary:
+            block = blocks["binary"]
+        else:
+            block = blocks["\r\n" if rng.random() < crlf_ratio else "\n"]
+
+        path = os.path.join(folder, *relative_path.split("/"))
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'wb') as f:
+            f.write(_content(block, size, i))
+        files.append((relative_path, is_binary))
+    return files
+
+
+def create_installed_copy(local_folder, installed_folder, files):
+    # type: (str, str, list) -> None
+    # Copies a package and flips the line endings of every text file, so the copy is only equal once line endings
+    # are ignored and comparisons can't stop early
+    shutil.copytree(local_folder, installed_folder)
+    for relative_path, is_binary in files:
+        if is_binary:
+            continue
+        path = os.path.join(installed_folder, *relative_path.split("/"))
+        with open(path, 'rb') as f:
+            data = f.read()
+        if "\r\n" in data:
+            data = data.replace("\r\n", "\n")
+        else:
+            data = data.replace("\n", "\r\n")
+        with open(path, 'wb') as f:
+            f.write(data)
+
+
+class Fixture(object):
+    def __init__(self, root, scenario_name, scenario):
+        self.local = os.path.join(root, scenario_name, "local")
+        self.installed = os.path.join(root, scenario_name, "installed")
+        self.extract_folder = os.path.join(root, scenario_name, "extracted")
+        self.files = generate_package(self.local, scenario_name, **scenario)
+        create_installed_copy(self.local, self.installed, self.files)
+
+        self.tarball = os.path.join(root, scenario_name, "installed.tgz")
+        with open(self.tarball, 'wb') as f:
+            pack_local_package(self.installed, parse_package_json(self.installed), f)
+
+        text_files = [p for p, is_binary in self.files if not is_binary]
+        binary_files = [p for p, is_binary in self.files if is_binary]
+        self.largest_text_file = max(text_files, key=self.get_size) if text_files else None
+        self.largest_binary_file = max(binary_files, key=self.get_size) if binary_files else None
+
+    def get_size(self, relative_path):
+        return os.path.getsize(os.path.join(self.local, *relative_path.split("/")))
+
+    def get_pair(self, relative_path):
+        parts = relative_path.split("/")
+        return os.path.join(self.local, *parts), os.path.join(self.installed, *parts)
+
+
+def _compare_tarball(fixture):
+    with open(fixture.tarball, 'rb') as f:
+        compare_tarball_with_folder(f, fixture.local)
+
+
+def _extract_tarball(fixture):
+    tar = tarfile.open(fixture.tarball, 'r:gz')
+    try:
+        tar.extractall(fixture.extract_folder)
+    finally:
+        tar.close()
+    shutil.rmtree(fixture.extract_folder)
+
+
+BENCHMARKS = [
+    ("get_all_files_in_package", lambda f: _get_all_files_in_package(f.local)),
+    ("cmp_files_text", lambda f: cmp_files(*f.get_pair(f.largest_text_file))),
+    ("cmp_files_binary", lambda f: cmp_files(*f.get_pair(f.largest_binary_file))),
+    ("cmp_directories_ignore_line_endings",
+     lambda f: cmp_directories_ignore_line_endings(f.local, f.installed, [p for p, is_binary in f.files])),
+    ("compare_package_files", lambda f: compare_package_files(f.local, f.installed, "0.1.0")),
+    ("compare_tarball_with_folder", _compare_tarball),
+    ("tarball_extraction", _extract_tarball),
+]
+
+
+def time_benchmark(func, fixture, repeat):
+    # type: (callable, Fixture, int) -> dict
+    timings = []
+    for _ in range(repeat):
+        # Start every run without the file hashes remembered from the previous one
+        publishStable.file_hashes.clear()
+        start_time = timeit.default_timer()
+        func(fixture)
+        timings.append(timeit.default_timer() - start_time)
+    timings.sort()
+    return {"min": round(timings[0], 6), "median": round(timings[len(timings) / 2], 6)}
+
+
+def run_benchmarks(repeat, scenario_names=None, benchmark_names=None):
+    # type: (int, list, list) -> dict
+    publishStable.args.add_package_as_dependency_to_package = []
+    root = tempfile.mkdtemp(prefix="publishBenchmarks")
+    results = {}
+    stdout = sys.stdout
+    try:
+        for scenario_name in sorted(scenario_names or SCENARIOS.keys()):
+            fixture = Fixture(root, scenario_name, SCENARIOS[scenario_name])
+            results[scenario_name] = {}
+            for name, func in BENCHMARKS:
+                if benchmark_names and name not in benchmark_names:
+                    continue
+                # The functions print their progress, which would only add noise to the timings
+                sys.stdout = open(os.devnull, 'w')
+                try:
+                    results[scenario_name][name] = time_benchmark(func, fixture, repeat)
+                finally:
+                    sys.stdout.close()
+                    sys.stdout = stdout
+                print "{0:20} {1:38} {2:9.4f}s".format(scenario_name, name, results[scenario_name][name]["median"])
+    finally:
+        shutil.rmtree(root)
+
+    return {"format": RESULTS_FORMAT, "python": platform.python_version(), "repeat": repeat,
+            "scenarios": SCENARIOS, "results": results}
+
+
+def write_results(results, path):
+    # type: (dict, str) -> None
+    with open(path, 'w') as f:
+        json.dump(results, f, indent=4, sort_keys=True, separators=(',', ': '))
+        f.write("\n")
+
+
+def find_regressions(results, baseline, tolerance, min_difference=0.005):
+    # type: (dict, dict, float, float) -> list
+    """
+    Returns (scenario, benchmark, baseline time, time) for every benchmark whose fastest run is more than tolerance
+    times the fastest run in the baseline. The fastest run is the one least disturbed by whatever else the machine was
+    doing, and differences below min_difference seconds are ignored since they are mostly noise
+    """
+    if baseline.get("format") != RESULTS_FORMAT:
+        raise Exception("The baseline has format {0} but the results have format {1}. Update the baseline".format(
+            baseline.get("format"), RESULTS_FORMAT))
+
+    regressions = []
+    for scenario_name, benchmarks in sorted(results["results"].iteritems()):
+        for name, timing in sorted(benchmarks.iteritems()):
+            baseline_timing = baseline["results"].get(scenario_name, {}).get(name)
+            if baseline_timing is None:
+                continue
+            if timing["min"] > baseline_timing["min"] * tolerance and \
+                    timing["min"] - baseline_timing["min"] > min_difference:
+                regressions.append((scenario_name, name, baseline_timing["min"], timing["min"]))
+    return regressions
+
+
+def main(): # pragma: no cover
+    parser = argparse.ArgumentParser(description="Times the hot paths of publishStable on synthetic packages")
+    parser.add_argument('--repeat', type=int, default=5, help="How many times to run each benchmark. The median and "
+                                                              "the fastest run are reported")
+    parser.add_argument('--scenario', action='append', choices=sorted(SCENARIOS.keys()),
+                        help="Only run these scenarios")
+    parser.add_argument('--benchmark', action='append', choices=[name for name, func in BENCHMARKS],
+                        help="Only run these benchmarks")
+    parser.add_argument('--output', help="Write the results as json to this path")
+    parser.add_argument('--compare', help="A baseline to compare the results with")
+    parser.add_argument('--tolerance', type=float, default=2.0, help="How many times slower than the baseline a "
+                                                                     "benchmark can be before it counts as a "
+                                                                     "regression")
+    parser.add_argument('--update-baseline', action='store_true', help="Write the results to {0}".format(
+        os.path.basename(BASELINE_PATH)))
+    options = parser.parse_args()
+
+    results = run_benchmarks(options.repeat, options.scenario, options.benchmark)
+    if options.output:
+        write_results(results, options.output)
+    if options.update_baseline:
+        write_results(results, BASELINE_PATH)
+
+    if options.compare:
+        with open(options.compare, 'r') as f:
+            regressions = find_regressions(results, json.load(f), options.tolerance)
+        if regressions:
+            print "The following benchmarks are slower than the baseline:"
+            for scenario_name, name, baseline_time, time in regressions:
+                print "  {0} {1}: {2:.4f}s -> {3:.4f}s".format(scenario_name, name, baseline_time, time)
+            sys.exit(1)
+        print "No regressions compared to {0}".format(options.compare)
+
+
+if __name__ == "__main__": # pragma: no cover
+    main()
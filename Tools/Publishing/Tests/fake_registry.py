@@ -0,0 +1,217 @@
+"""
+An npm registry that runs in a thread of the current process, for tests and for measuring how the publishing scripts
+behave against slow or unreliable registries without touching a real one. It serves package metadata documents and
+tarballs, accepts publishes and can delay, throttle and fail requests.
+"""
+import BaseHTTPServer
+import base64
+import hashlib
+import json
+import random
+import SocketServer
+import threading
+import time
+import urllib
+import zlib
+
+
+class _Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class _RequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    # Keep-alive like a real registry, so clients can reuse their connections
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.server.registry._handle(self, "GET")
+
+    def do_PUT(self):
+        self.server.registry._handle(self, "PUT")
+
+
+class FakeRegistry(object):
+    """
+    latency is the number of seconds every request waits before it is answered, bandwidth the number of bytes per
+    second response bodies are sent with (None for no limit) and error_rate the share of requests that fail with a 500.
+    Errors are picked by a random generator seeded with seed, so a run can be repeated. With gzip_tarballs tarballs
+    are sent gzip encoded, like registries behind some proxies do.
+    """
+
+    CHUNK_SIZE = 16 * 1024
+
+    def __init__(self, latency=0.0, bandwidth=None, error_rate=0.0, seed=0):
+        # type: (float, int, float, int) -> None
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.error_rate = error_rate
+        self.gzip_tarballs = False
+        self.documents = {}
+        self.tarballs = {}
+        self.requests = []
+        self._failures = {}
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._server = None
+        self._thread = None
+
+    @property
+    def url(self):
+        # type: () -> str
+        return "http://127.0.0.1:{0}".format(self._server.server_address[1])
+
+    def start(self):
+        # type: () -> FakeRegistry
+        self._server = _Server(("127.0.0.1", 0), _RequestHandler)
+        self._server.registry = self
+        # A short poll interval, since stop waits for the server to notice
+        self._thread = threading.Thread(target=self._server.serve_forever, kwargs={"poll_interval": 0.05},
+                                        name="FakeRegistry")
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        # type: () -> None
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def get_tarball_path(self, package_name, version):
+        # type: (str, str) -> str
+        return "/{0}/-/{1}-{2}.tgz".format(urllib.quote(package_name, safe="@"), package_name.split("/")[-1], version)
+
+    def add_package(self, package_file, tarball):
+        # type: (dict, str) -> None
+        # Adds a version of a package as if it had been published. package_file is the package.json in the tarball
+        package_name = package_file["name"]
+        version = package_file["version"]
+        path = self.get_tarball_path(package_name, version)
+        version_document = dict(package_file)
+        version_document["_id"] = "{0}@{1}".format(package_name, version)
+        version_document["dist"] = {
+            "shasum": hashlib.sha1(tarball).hexdigest(),
+            "integrity": "sha512-{0}".format(base64.b64encode(hashlib.sha512(tarball).digest())),
+            # The server might not have been started yet, so the host is filled in when the document is served
+            "tarball": path,
+        }
+        with self._lock:
+            document = self.documents.setdefault(package_name, {"_id": package_name, "name": package_name,
+                                                                "dist-tags": {}, "versions": {}})
+            document["versions"][version] = version_document
+            document["dist-tags"]["latest"] = version
+            self.tarballs[path] = tarball
+
+    def fail_next(self, path, count=1):
+        # type: (str, int) -> None
+        # Answers the next count requests for path with a 500
+        with self._lock:
+            self._failures[path] = self._failures.get(path, 0) + count
+
+    def get_request_counts(self):
+        # type: () -> dict
+        counts = {}
+        with self._lock:
+            for method, path, status in self.requests:
+                key = "{0} {1}".format(method, status)
+                counts[key] = counts.get(key, 0) + 1
+        return counts
+
+    def _handle(self, handler, method):
+        path = handler.path.split("?")[0]
+        # The request body is always read, so the connection can be used again even if the request fails
+        content_length = int(handler.headers.get("Content-Length", 0))
+        request_body = handler.rfile.read(content_length)
+        if len(request_body) < content_length:
+            # The client broke the connection off in the middle of the request, there is no one to answer
+            with self._lock:
+                self.requests.append((method, handler.path.split("?")[0], "aborted"))
+            handler.close_connection = True
+            return
+        if self.latency:
+            time.sleep(self.latency)
+
+        with self._lock:
+            failing = self._random.random() < self.error_rate or self._failures.get(path, 0) > 0
+            if self._failures.get(path, 0) > 0:
+                self._failures[path] -= 1
+
+        if failing:
+            status, body, headers = 500, json.dumps({"error": "internal server error"}), {}
+        elif method == "PUT":
+            status, body, headers = self._publish(path, request_body)
+        elif path in self.tarballs:
+            status, body, headers = self._get_tarball(path, handler.headers.get("Range"))
+        else:
+            status, body, headers = self._get_document(urllib.unquote(path.lstrip("/")))
+
+        with self._lock:
+            self.requests.append((method, path, status))
+        self._respond(handler, status, body, headers)
+
+    def _get_document(self, package_name):
+        with self._lock:
+            document = self.documents.get(package_name)
+            if document is None:
+                return 404, json.dumps({"error": "not_found"}), {}
+            document = json.loads(json.dumps(document))
+        for version_document in document["versions"].values():
+            version_document["dist"]["tarball"] = self.url + version_document["dist"]["tarball"]
+        return 200, json.dumps(document), {"Content-Type": "application/json"}
+
+    def _get_tarball(self, path, range_header):
+        tarball = self.tarballs[path]
+        if self.gzip_tarballs:
+            compressor = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+            return 200, compressor.compress(tarball) + compressor.flush(), {"Content-Type": "application/octet-stream",
+                                                                             "Content-Encoding": "gzip"}
+        if not range_header or not range_header.startswith("bytes="):
+            return 200, tarball, {"Content-Type": "application/octet-stream"}
+
+        start = int(range_header[len("bytes="):].split("-")[0])
+        if start >= len(tarball):
+            return 416, "", {"Content-Range": "bytes */{0}".format(len(tarball))}
+        return 206, tarball[start:], {"Content-Type": "application/octet-stream",
+                                      "Content-Range": "bytes {0}-{1}/{2}".format(start, len(tarball) - 1,
+                                                                                  len(tarball))}
+
+    def _publish(self, path, request_body):
+        document = json.loads(request_body)
+        package_name = urllib.unquote(path.lstrip("/"))
+        if document.get("name") != package_name:
+            return 400, json.dumps({"error": "name doesn't match the url"}), {}
+
+        attachment = document["_attachments"].values()[0]
+        tarball = base64.b64decode(attachment["data"])
+        for version, version_document in document["versions"].iteritems():
+            with self._lock:
+                existing = self.documents.get(package_name, {}).get("versions", {})
+            if version in existing:
+                return 403, json.dumps({"error": "cannot modify pre-existing version: {0}".format(version)}), {}
+            if version_document["dist"]["shasum"] != hashlib.sha1(tarball).hexdigest():
+                return 400, json.dumps({"error": "shasum doesn't match the tarball"}), {}
+            package_file = dict((k, v) for k, v in version_document.iteritems() if k not in ["_id", "dist"])
+            self.add_package(package_file, tarball)
+        return 201, json.dumps({"ok": True}), {"Content-Type": "application/json"}
+
+    def _respond(self, handler, status, body, headers):
+        handler.send_response(status)
+        for key, value in headers.iteritems():
+            handler.send_header(key, value)
+        handler.send_header("Content-Length", str(len(body)))
+        handler.end_headers()
+
+        # Without a bandwidth limit the whole body goes out at once, otherwise it is sent in chunks with pauses
+        chunk_size = len(body) or 1
+        if self.bandwidth:
+            chunk_size = self.CHUNK_SIZE
+        for start in range(0, len(body), chunk_size):
+            chunk = body[start:start + chunk_size]
+            handler.wfile.write(chunk)
+            if self.bandwidth:
+                time.sleep(float(len(chunk)) / self.bandwidth)
@@ -1,5 +1,5 @@
-import subprocess
 import json
+from registry import RegistryError
 
 def _registry_exists(registry):
     if registry.startswith('wrong'):
@@ -11,38 +11,16 @@ def _registry_empty(registry):
         return False
     return True
 
-def _view(package_name, extra, registry):
+def fetch_package_document(package_name, registry):
     if not _registry_exists(registry):
-        raise subprocess.CalledProcessError(1,'view',"doh!")
+        raise RegistryError("doh!")
     if _registry_empty(registry):
-        raise subprocess.CalledProcessError(1,'view',"{0} is not in the npm registry".format(package_name))
+        return None
 
-    package_name = package_name.split('@')[0]
     file = open('./localPackages/' + package_name + '/package.json').read()
     fields = json.loads(file)
+    fields['dist'] = {'tarball': "{0}/{1}/-/{1}-{2}.tgz".format(registry, package_name, fields['version'])}
 
-    if extra == 'version':
-        return fields['version']
-
-    if extra =='dependencies':
-
-        str = '{ '
-        for index, dependency_name in enumerate(fields['dependencies']):
-            comma = ','
-            if(index == len(fields['dependencies']) - 1):
-                comma = ''
-            str += "'" + dependency_name + "': '" + fields['dependencies'][dependency_name] + "'" + comma + "\n"
-        str += '}'
-        return str
-
-
-
-def npm_cmd(cmd, registry):
-    try:
-        instruction, package_name, extra = cmd.split(' ')
-        if instruction == 'view':
-            return _view(package_name, extra, registry)
-
-    except subprocess.CalledProcessError as e:
-        raise e
-
+    return {'name': package_name,
+            'dist-tags': {'latest': fields['version']},
+            'versions': {fields['version']: fields}}
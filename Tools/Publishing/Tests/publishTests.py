@@ -1,4 +1,14 @@
+import base64
+import collections
+import hashlib
+import io
+import json
 import os
+import shutil
+import sys
+import tarfile
+import tempfile
+import time
 import mock
 import npm_mock
 from unittest import TestCase
@@ -11,6 +21,7 @@ from publishStable import _get_version_in_registry
 from publishStable import download_package_tarball
 from publishStable import is_package_changed
 from publishStable import cmp_files
+from publishStable import cmp_directories_ignore_line_endings
 from publishStable import increase_version
 from publishStable import validate_version
 from publishStable import parse_package_json
@@ -20,10 +31,61 @@ from publishStable import is_preview
 from publishStable import get_filtered_dependencies_from_view_registry
 from publishStable import best_view_registry
 from publishStable import parseArgumentList
+from publishStable import get_package_version
+from publishStable import PackageSnapshot
+from publishStable import pack_local_package
+from publishStable import is_package_shasum_unchanged
+from publishStable import get_dependency_waves
+from publishStable import schedule_dependency_graph
+from publishStable import get_package_graph
+from publishStable import resolve_republish_dependencies
+from publishStable import get_packages_missing_in_registry
+from publishStable import create_hash_manifest
+from publishStable import is_package_changed_from_hash_manifest
+from publishStable import compare_tarball_with_folder
+from publishStable import get_package_from_url
+from publishStable import parse_package_trees
+from publishStable import format_package_trees
+from publishStable import is_package_tree_unchanged
+from publishStable import modify_json
+from publishStable import get_project_manifests
+from publishStable import scatter_manifest
+from publishStable import squash_commits
+from publishStable import commit_index
+from publishStable import commit_release
+from publishStable import is_head_tree_changed
+from publishStable import add_destination_repo
+from publishStable import get_next_release
+from publishStable import parse_next_release
+
+from registry import RegistryClient
+from registry import RegistryError
+from registry import get_npmrc_paths
+from registry import read_npm_config_credentials
+from registry import read_npmrc_credentials
+from request_policy import CircuitBreaker
+from request_policy import CircuitOpenError
+from request_policy import LatencyTracker
+from request_policy import RequestPolicy
+from tarball_cache import TarballCache
+from workspace import Workspace
+from git_runner import GitRunner
+from tracing import Tracer
+from tracing import traced
+from benchmarks import generate_package
+from benchmarks import find_regressions
+from fake_registry import FakeRegistry
+import registry_harness
+import publishBatch
+from repo_walker import RepoPathMatcher
+from repo_walker import scan_repository
+from packer import pack_package
+from packer import NPM_PACK_MTIME
 
 import publishStable
 import subprocess
 import semver
+import requests
 
 class TestGetPackagesFolder(TestCase):
     def test_get_packages_folder_SetfolderWithoutManifest_RaiseException(self):
@@ -129,6 +191,77 @@ class TestGetAllFiles(TestCase):
     def test_get_all_files_ProvideExistingPackageWithNodeModules_ReturnListOfFiles(self):
         self.assertEquals(_get_all_files_in_package('./installedPackages/package5'), ['testFile.txt'])
 
+class FakeScandir(object):
+    # Lists a folder like os.scandir of python 3 does, which python 2 doesn't have
+    def __init__(self, path):
+        self.entries = [FakeDirEntry(os.path.join(path, name)) for name in os.listdir(path)]
+
+    def __iter__(self):
+        return iter(self.entries)
+
+class FakeDirEntry(object):
+    def __init__(self, path):
+        self.path = path
+        self.name = os.path.basename(path)
+
+    def is_dir(self, follow_symlinks=True):
+        return os.path.isdir(self.path) and (follow_symlinks or not os.path.islink(self.path))
+
+    def is_symlink(self):
+        return os.path.islink(self.path)
+
+    def stat(self, follow_symlinks=True):
+        return os.stat(self.path) if follow_symlinks else os.lstat(self.path)
+
+class TestPackageSnapshot(TestCase):
+    def setUp(self):
+        self.package_folder = tempfile.mkdtemp()
+        for path in ['package.json', 'Runtime/a.cs', 'Runtime/Nested/b.cs', 'node_modules/dependency/c.js']:
+            full_path = os.path.join(self.package_folder, *path.split('/'))
+            if not os.path.isdir(os.path.dirname(full_path)):
+                os.makedirs(os.path.dirname(full_path))
+            with open(full_path, 'wb') as f:
+                f.write(path)
+
+    def tearDown(self):
+        shutil.rmtree(self.package_folder)
+
+    def test_package_snapshot_ProvideNonExistingPath_RaiseException(self):
+        self.assertRaises(ValueError, PackageSnapshot, './this/is/a/fake/path')
+
+    def test_package_snapshot_NestedFolders_ReturnRelativePathsWithoutNodeModules(self):
+        self.assertEquals(PackageSnapshot(self.package_folder).get_relative_paths(),
+                          ['Runtime/Nested/b.cs', 'Runtime/a.cs'])
+
+    def test_package_snapshot_ExistingFile_KeepsSize(self):
+        snapshot = PackageSnapshot(self.package_folder)
+        self.assertTrue('Runtime/a.cs' in snapshot)
+        self.assertEquals(snapshot.files['Runtime/a.cs'].size, len('Runtime/a.cs'))
+
+    def _add_symlinks(self):
+        os.symlink(os.path.join(self.package_folder, 'Runtime'), os.path.join(self.package_folder, 'Linked'))
+        os.symlink(os.path.join(self.package_folder, 'missing.cs'), os.path.join(self.package_folder, 'dangling.cs'))
+
+    def test_package_snapshot_Symlinks_SkipsLinkedFoldersLikeOsWalk(self):
+        self._add_symlinks()
+        self.assertEquals(PackageSnapshot(self.package_folder).get_relative_paths(),
+                          ['Runtime/Nested/b.cs', 'Runtime/a.cs', 'dangling.cs'])
+
+    def test_package_snapshot_SymlinksWithScandir_SameAsWithoutScandir(self):
+        self._add_symlinks()
+        with mock.patch('publishStable.scandir', FakeScandir):
+            snapshot = PackageSnapshot(self.package_folder)
+        self.assertEquals(snapshot.get_relative_paths(), ['Runtime/Nested/b.cs', 'Runtime/a.cs', 'dangling.cs'])
+        self.assertEquals(snapshot.files['dangling.cs'].size,
+                          os.lstat(os.path.join(self.package_folder, 'dangling.cs')).st_size)
+
+    def test_get_hashes_SameFilesTwice_HashesEachFileOnce(self):
+        with mock.patch('publishStable._hash_file') as hash_mock:
+            hash_mock.return_value = 'hash'
+            PackageSnapshot(self.package_folder).get_hashes()
+            PackageSnapshot(self.package_folder).get_hashes()
+            self.assertEquals(hash_mock.call_count, 2)
+
 class TestCmpFiles(TestCase):
     def test_cmp_files_CompareNonExistingFiles_RaiseException(self):
         self.assertRaises(IOError, cmp_files, 'file', 'file')
@@ -139,11 +272,82 @@ class TestCmpFiles(TestCase):
     def test_cmp_files_CompareExistingDifferentFiles_ReturnFalse(self):
         self.assertFalse(cmp_files('./localPackages/package1/package.json', './localPackages/package2/package.json'))
 
+class TestCmpFilesIgnoringLineEndings(TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def _write(self, name, content):
+        path = os.path.join(self.folder, name)
+        with open(path, 'wb') as f:
+            f.write(content)
+        return path
+
+    def test_cmp_files_SameTextWithDifferentLineEndings_ReturnTrue(self):
+        first = self._write('first.txt', 'line one\nline two\n')
+        second = self._write('second.txt', 'line one\r\nline two\r\n')
+        self.assertTrue(cmp_files(first, second))
+
+    def test_cmp_files_LineEndingSplitBetweenChunks_ReturnTrue(self):
+        first = self._write('first.txt', 'abc\r\ndef\r\nghi')
+        second = self._write('second.txt', 'abc\ndef\nghi')
+        self.assertTrue(cmp_files(first, second, chunk_size=4))
+
+    def test_cmp_files_DifferentTextOfSameSize_ReturnFalse(self):
+        first = self._write('first.txt', 'line one\n')
+        second = self._write('second.txt', 'line two\n')
+        self.assertFalse(cmp_files(first, second, chunk_size=4))
+
+    def test_cmp_files_TextWithExtraLines_ReturnFalse(self):
+        first = self._write('first.txt', 'line one\n\nline two\n')
+        second = self._write('second.txt', 'line one\n')
+        self.assertFalse(cmp_files(first, second))
+
+    def test_cmp_files_BinaryFilesWithDifferentLineEndings_ReturnFalse(self):
+        first = self._write('first.bin', '\0\1\r\n\2')
+        second = self._write('second.bin', '\0\1\n\2')
+        self.assertFalse(cmp_files(first, second))
+
+    def test_cmp_files_IdenticalBinaryFiles_ReturnTrue(self):
+        first = self._write('first.bin', '\0\1\r\n\2' * 1000)
+        second = self._write('second.bin', '\0\1\r\n\2' * 1000)
+        self.assertTrue(cmp_files(first, second, chunk_size=7))
+
+    def test_hash_file_LineEndingSplitBetweenChunks_SameHashAsWithLf(self):
+        crlf = self._write('crlf.txt', 'x' * (publishStable.BINARY_CHECK_SIZE - 1) + '\r\ny\r\nz')
+        lf = self._write('lf.txt', 'x' * (publishStable.BINARY_CHECK_SIZE - 1) + '\ny\nz')
+        self.assertEquals(publishStable._hash_file(crlf, chunk_size=3), publishStable._hash_file(lf))
+        self.assertEquals(publishStable._hash_file(lf), hashlib.sha1('x' * (publishStable.BINARY_CHECK_SIZE - 1) +
+                                                                     '\ny\nz').hexdigest())
+
+    def test_hash_file_BinaryFile_HashesBytesAsTheyAre(self):
+        path = self._write('binary.bin', '\0\r\n' * 5000)
+        self.assertEquals(publishStable._hash_file(path, chunk_size=7), hashlib.sha1('\0\r\n' * 5000).hexdigest())
+
+    def test_cmp_directories_ignore_line_endings_MissingAndChangedFiles_ReturnMismatches(self):
+        os.mkdir(os.path.join(self.folder, 'first'))
+        os.mkdir(os.path.join(self.folder, 'second'))
+        for name, first, second in [('same.txt', 'a\r\n', 'a\n'), ('changed.txt', 'a', 'b')]:
+            self._write(os.path.join('first', name), first)
+            self._write(os.path.join('second', name), second)
+        self._write(os.path.join('first', 'missing.txt'), 'a')
+
+        match, mismatch, errors = cmp_directories_ignore_line_endings(os.path.join(self.folder, 'first'),
+                                                                      os.path.join(self.folder, 'second'),
+                                                                      ['same.txt', 'changed.txt', 'missing.txt'])
+        self.assertEquals(match, ['same.txt'])
+        self.assertEquals(mismatch, ['changed.txt', 'missing.txt'])
+        self.assertEquals(errors, [])
+
 class TestVersionInRegistry(TestCase):
     def setUp(self):
-        patch = mock.patch('publishStable.npm_cmd')
-        self.npm_mock = patch.start()
-        self.npm_mock.side_effect = npm_mock.npm_cmd
+        patch = mock.patch('publishStable.registry_client', RegistryClient(npmrc_path=''))
+        self.registry_client = patch.start()
+        fetch_patch = mock.patch.object(self.registry_client, '_fetch_package_document')
+        self.fetch_mock = fetch_patch.start()
+        self.fetch_mock.side_effect = npm_mock.fetch_package_document
 
     def tearDown(self):
         mock.patch.stopall()
@@ -155,7 +359,164 @@ class TestVersionInRegistry(TestCase):
         self.assertEquals(_get_version_in_registry('package1', 'empty_registry'), '')
 
     def test_mock_npm_cmd_ProvideNonExistingRegistry_RaiseException(self):
-        self.assertRaises(subprocess.CalledProcessError, _get_version_in_registry, 'package1', 'wrong_registry')
+        self.assertRaises(RegistryError, _get_version_in_registry, 'package1', 'wrong_registry')
+
+    def test_get_version_in_registry_SamePackageTwice_FetchesDocumentOnce(self):
+        _get_version_in_registry('package1', 'registry')
+        _get_version_in_registry('package1', 'registry/')
+        self.assertEquals(self.fetch_mock.call_count, 1)
+
+class TestRegistryClient(TestCase):
+    def setUp(self):
+        self.npmrc_folder = tempfile.mkdtemp()
+        self.npmrc_path = os.path.join(self.npmrc_folder, '.npmrc')
+        with open(self.npmrc_path, 'w') as f:
+            f.write('registry=https://registry.npmjs.org\n'
+                    '//staging-packages.unity.com/:_authToken=${PUBLISH_TEST_TOKEN}\n'
+                    '//artifactory.example.com/api/npm/upm/:_auth=dXNlcjpwYXNz\n')
+        os.environ['PUBLISH_TEST_TOKEN'] = 'secret'
+        self.client = RegistryClient(npmrc_path=self.npmrc_path)
+        patch = mock.patch.object(self.client, '_fetch_package_document')
+        self.fetch_mock = patch.start()
+        self.fetch_mock.side_effect = npm_mock.fetch_package_document
+
+    def tearDown(self):
+        mock.patch.stopall()
+        del os.environ['PUBLISH_TEST_TOKEN']
+        shutil.rmtree(self.npmrc_folder)
+
+    def test_read_npmrc_credentials_NpmrcWithTokens_ReturnsCredentialsPerRegistry(self):
+        self.assertEquals(read_npmrc_credentials(self.npmrc_path),
+                          {'//staging-packages.unity.com/': ('_authToken', 'secret'),
+                           '//artifactory.example.com/api/npm/upm/': ('_auth', 'dXNlcjpwYXNz')})
+
+    def test_get_npmrc_paths_UserConfigFromEnvironment_ReturnsProjectUserAndGlobalConfig(self):
+        with mock.patch.dict(os.environ, {'npm_config_userconfig': '/ci/user.npmrc',
+                                          'NPM_CONFIG_GLOBALCONFIG': '/ci/global.npmrc'}):
+            self.assertEquals(get_npmrc_paths('/repo'), ['/repo/.npmrc', '/ci/user.npmrc', '/ci/global.npmrc'])
+
+    def test_read_npm_config_credentials_SameRegistryInSeveralFiles_ProjectConfigWins(self):
+        project_npmrc = os.path.join(self.npmrc_folder, 'project.npmrc')
+        with open(project_npmrc, 'w') as f:
+            f.write('//staging-packages.unity.com/:_authToken=project\n')
+        self.assertEquals(read_npm_config_credentials([project_npmrc, self.npmrc_path]),
+                          {'//staging-packages.unity.com/': ('_authToken', 'project'),
+                           '//artifactory.example.com/api/npm/upm/': ('_auth', 'dXNlcjpwYXNz')})
+
+    def test_load_npm_config_NpmrcInProject_UsesProjectCredentials(self):
+        with open(os.path.join(self.npmrc_folder, '.npmrc'), 'w') as f:
+            f.write('//project-registry/:_authToken=project\n')
+        with mock.patch.dict(os.environ, {'NPM_CONFIG_USERCONFIG': os.path.join(self.npmrc_folder, 'missing')}):
+            self.client.load_npm_config(self.npmrc_folder)
+        self.assertEquals(self.client.get_headers('https://project-registry')['Authorization'], 'Bearer project')
+
+    def test_get_headers_RegistryWithToken_ReturnsBearerAuthorization(self):
+        self.assertEquals(self.client.get_headers('https://staging-packages.unity.com')['Authorization'],
+                          'Bearer secret')
+
+    def test_get_headers_SeveralMatchingRegistries_UsesLongestMatch(self):
+        self.client._credentials = collections.OrderedDict([
+            ('//artifactory.example.com/', ('_authToken', 'host')),
+            ('//artifactory.example.com/api/npm/upm/', ('_authToken', 'repo')),
+            ('//artifactory.example.com/api/', ('_authToken', 'api'))])
+        self.assertEquals(self.client.get_headers('https://artifactory.example.com/api/npm/upm')['Authorization'],
+                          'Bearer repo')
+        self.assertEquals(self.client.get_headers('https://artifactory.example.com/other')['Authorization'],
+                          'Bearer host')
+
+    def test_get_headers_RegistryWithoutCredentials_ReturnsNoAuthorization(self):
+        self.assertNotIn('Authorization', self.client.get_headers('https://packages.unity.com'))
+
+    def test_get_package_url_ScopedPackage_EncodesSlash(self):
+        self.assertEquals(self.client.get_package_url('@unity/package1', 'https://registry/'),
+                          'https://registry/@unity%2Fpackage1')
+
+    def test_get_version_metadata_ExistingVersion_ReturnsTarballFromDocument(self):
+        self.assertEquals(self.client.get_version_metadata('package1', '0.0.1', 'registry')['dist']['tarball'],
+                          'registry/package1/-/package1-0.0.1.tgz')
+
+    def test_get_version_metadata_NonExistingVersion_RaiseException(self):
+        self.assertRaises(RegistryError, self.client.get_version_metadata, 'package1', '9.9.9', 'registry')
+
+    def test_has_version_PackageNotInRegistry_ReturnFalse(self):
+        self.assertFalse(self.client.has_version('package1', '0.0.1', 'empty_registry'))
+
+    def test_get_dependencies_QueriesForSamePackage_FetchesDocumentOnce(self):
+        self.client.get_latest_version('package1', 'registry')
+        self.client.get_version_metadata('package1', '0.0.1', 'registry')
+        self.assertEquals(self.client.get_dependencies('package1', '0.0.1', 'registry'), {'package3': '0.2.1'})
+        self.assertEquals(self.fetch_mock.call_count, 1)
+
+    def test_publish_NewVersion_PutsDocumentWithTarballAttachment(self):
+        put_mock = mock.patch.object(self.client._session, 'put').start()
+        put_mock.return_value = mock.Mock(status_code=201)
+        self.client.get_latest_version('package1', 'https://staging-packages.unity.com')
+        self.client.publish({'name': 'package1', 'version': '0.0.2'}, 'tarball', 'https://staging-packages.unity.com')
+
+        url = put_mock.call_args[0][0]
+        headers = put_mock.call_args[1]['headers']
+        document = json.loads(put_mock.call_args[1]['data'])
+        self.assertEquals(url, 'https://staging-packages.unity.com/package1')
+        self.assertEquals(headers['Authorization'], 'Bearer secret')
+        self.assertEquals(document['dist-tags'], {'latest': '0.0.2'})
+        self.assertEquals(document['versions']['0.0.2']['dist']['shasum'], hashlib.sha1('tarball').hexdigest())
+        self.assertEquals(document['versions']['0.0.2']['dist']['tarball'],
+                          'https://staging-packages.unity.com/package1/-/package1-0.0.2.tgz')
+        self.assertEquals(base64.b64decode(document['_attachments']['package1-0.0.2.tgz']['data']), 'tarball')
+        # The next lookup has to see the new version
+        self.client.get_latest_version('package1', 'https://staging-packages.unity.com')
+        self.assertEquals(self.fetch_mock.call_count, 2)
+
+    def test_publish_VersionAlreadyExists_RaiseException(self):
+        put_mock = mock.patch.object(self.client._session, 'put').start()
+        put_mock.return_value = mock.Mock(status_code=403, text='cannot modify pre-existing version')
+        self.assertRaises(RegistryError, self.client.publish, {'name': 'package1', 'version': '0.0.1'}, 'tarball',
+                          'registry')
+
+class TestGetPackageVersion(TestCase):
+    registry_versions = {}
+
+    def setUp(self):
+        patch = mock.patch('publishStable._get_version_in_registry')
+        self.version_mock = patch.start()
+        self.version_mock.side_effect = lambda package_name, registry: self.registry_versions[registry]
+        publishStable.args.max_concurrent_requests = 8
+        publishStable.args.publish_registry = 'publish'
+        publishStable.best_view_registry = None
+
+    def tearDown(self):
+        mock.patch.stopall()
+
+    def test_get_package_version_HigherVersionInLaterRegistry_ReturnHighestVersion(self):
+        self.registry_versions = {'first': '0.0.1', 'second': '0.1.0', 'empty': ''}
+        publishStable.args.view_registries = ['first', 'second', 'empty']
+        self.assertEquals(get_package_version('package1'), '0.1.0')
+        self.assertEquals(publishStable.best_view_registry, 'second')
+
+    def test_get_package_version_SameVersionInPublishRegistry_PreferPublishRegistry(self):
+        self.registry_versions = {'first': '0.1.0', 'publish': '0.1.0', 'last': '0.1.0'}
+        publishStable.args.view_registries = ['first', 'publish', 'last']
+        self.assertEquals(get_package_version('package1'), '0.1.0')
+        self.assertEquals(publishStable.best_view_registry, 'publish')
+
+    def test_get_package_version_NotInAnyRegistry_ReturnFirstVersion(self):
+        self.registry_versions = {'first': '', 'second': ''}
+        publishStable.args.view_registries = ['first', 'second']
+        self.assertEquals(get_package_version('package1'), '0.0.0')
+        self.assertIsNone(publishStable.best_view_registry)
+
+    def test_get_package_version_SlowRegistries_QueriesRegistriesConcurrently(self):
+        self.registry_versions = {'first': '0.0.1', 'second': '0.0.2', 'third': '0.0.3'}
+        publishStable.args.view_registries = ['first', 'second', 'third']
+
+        def slow_version(package_name, registry):
+            time.sleep(0.2)
+            return self.registry_versions[registry]
+        self.version_mock.side_effect = slow_version
+
+        start = time.time()
+        self.assertEquals(get_package_version('package1'), '0.0.3')
+        self.assertLess(time.time() - start, 0.5)
 
 class TestIsPreview(TestCase):
     def test_is_preview_VersionIsStableRelease_ReturnFalse(self):
@@ -248,14 +609,1265 @@ class TestIncreaseVersion(TestCase):
     def test_increase_version_PreviewFlagAndRelease_ReturnSameVersion(self):
         self.assertEquals(increase_version('1.2.3-preview.2', BumpVersion.RELEASE), '1.2.3')
 
+class TestCreateHashManifest(TestCase):
+    def setUp(self):
+        self.first = tempfile.mkdtemp()
+        self.second = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.first)
+        shutil.rmtree(self.second)
+
+    def _write_package(self, path, content):
+        with open(os.path.join(path, 'package.json'), 'wb') as f:
+            f.write('{}')
+        with open(os.path.join(path, 'testFile.txt'), 'wb') as f:
+            f.write(content)
+
+    def test_create_hash_manifest_ProvideExistingPackageWithNodeModules_ReturnsDigestOfPackageFiles(self):
+        file_hash = publishStable._hash_file('./installedPackages/package3/testFile.txt')
+        self.assertEquals(create_hash_manifest('./installedPackages/package3'),
+                          {'format': publishStable.HASH_MANIFEST_FORMAT,
+                           'digest': publishStable.get_hashes_digest({'testFile.txt': file_hash})})
+
+    def test_get_hashes_digest_FileRenamed_ReturnsDifferentDigest(self):
+        self.assertNotEquals(publishStable.get_hashes_digest({'a.txt': '1' * 40}),
+                             publishStable.get_hashes_digest({'b.txt': '1' * 40}))
+
+    def test_create_hash_manifest_SameFileWithDifferentLineEndings_ReturnsSameHashes(self):
+        self._write_package(self.first, 'first line\nsecond line\n')
+        self._write_package(self.second, 'first line\r\nsecond line\r\n')
+        self.assertEquals(create_hash_manifest(self.first), create_hash_manifest(self.second))
+
+    def test_create_hash_manifest_DifferentFileContent_ReturnsDifferentHashes(self):
+        self._write_package(self.first, 'first line\n')
+        self._write_package(self.second, 'other line\n')
+        self.assertNotEquals(create_hash_manifest(self.first), create_hash_manifest(self.second))
+
+class TestCompareTarballWithFolder(TestCase):
+    def _create_tarball(self, files):
+        tar_stream = io.BytesIO()
+        tar = tarfile.open(fileobj=tar_stream, mode='w:gz')
+        for name, content in files:
+            info = tarfile.TarInfo('package/' + name)
+            info.size = len(content)
+            tar.addfile(info, io.BytesIO(content))
+        tar.close()
+        tar_stream.seek(0)
+        return tar_stream
+
+    def _package_files(self, installed_path):
+        files = []
+        for name in ['package.json', 'testFile.txt']:
+            with open(os.path.join(installed_path, name), 'rb') as f:
+                files.append((name, f.read()))
+        return files
+
+    def test_compare_tarball_with_folder_NoDifferencesInPackage_ReturnsNoMismatch(self):
+        tar_stream = self._create_tarball(self._package_files('./installedPackages/package1Clone'))
+        match, mismatch, installed_package = compare_tarball_with_folder(tar_stream, './localPackages/package1')
+        self.assertEquals(match, ['testFile.txt'])
+        self.assertEquals(mismatch, [])
+        self.assertEquals(installed_package, parse_package_json('./installedPackages/package1Clone'))
+
+    def test_compare_tarball_with_folder_DifferentLineEndings_ReturnsNoMismatch(self):
+        files = self._package_files('./installedPackages/package1Clone')
+        files = [(name, content.replace('\n', '\r\n')) for name, content in files]
+        match, mismatch, installed_package = compare_tarball_with_folder(self._create_tarball(files),
+                                                                         './localPackages/package1')
+        self.assertEquals(mismatch, [])
+
+    def test_compare_tarball_with_folder_BinaryFileWithDifferentLineEndings_ReturnsMismatch(self):
+        files = [('package.json', '{}'), ('testFile.txt', '\0' + open('./localPackages/package1/testFile.txt').read())]
+        local_folder = tempfile.mkdtemp()
+        try:
+            with open(os.path.join(local_folder, 'package.json'), 'wb') as f:
+                f.write('{}')
+            with open(os.path.join(local_folder, 'testFile.txt'), 'wb') as f:
+                f.write(files[1][1].replace('\n', '\r\n'))
+            match, mismatch, installed_package = compare_tarball_with_folder(self._create_tarball(files), local_folder)
+        finally:
+            shutil.rmtree(local_folder)
+        self.assertEquals(mismatch, ['testFile.txt'])
+
+    def test_compare_tarball_with_folder_DifferentFileContent_ReturnsMismatch(self):
+        files = [('package.json', '{}'), ('testFile.txt', 'Some other content')]
+        match, mismatch, installed_package = compare_tarball_with_folder(self._create_tarball(files),
+                                                                         './localPackages/package1')
+        self.assertEquals(mismatch, ['testFile.txt'])
+
+    def test_compare_tarball_with_folder_FileMissingInTarball_ReturnsMismatch(self):
+        files = [('package.json', '{}')]
+        match, mismatch, installed_package = compare_tarball_with_folder(self._create_tarball(files),
+                                                                         './localPackages/package1')
+        self.assertEquals(mismatch, ['testFile.txt'])
+
+    def test_compare_tarball_with_folder_ExtraFilesAndStopAtFirstMismatch_ReturnsFirstMismatch(self):
+        files = [('package.json', '{}'), ('a.txt', 'a'), ('b.txt', 'b')]
+        match, mismatch, installed_package = compare_tarball_with_folder(self._create_tarball(files),
+                                                                         './localPackages/package1',
+                                                                         stop_at_first_mismatch=True)
+        self.assertEquals(mismatch, ['a.txt'])
+
+class TestPackageTrees(TestCase):
+    release_message = ('Release 4\n\nPackage-Tree: package1 0.0.1 aaaa package3@0.2.1\n'
+                       'Package-Tree: package2 0.0.2 bbbb -\n')
+
+    def setUp(self):
+        patch = mock.patch('publishStable.git_runner')
+        self.git_mock = patch.start()
+        self.git_mock.get_object_info.return_value = ('aaaa', 'tree', 0)
+        publishStable.args.add_package_as_dependency_to_package = []
+        publishStable.published_package_trees = parse_package_trees(self.release_message)
+        publishStable.package_trees = {}
+        publishStable.local_packages = {'package3': '0.2.1'}
+
+    def tearDown(self):
+        mock.patch.stopall()
+
+    def test_parse_package_trees_ReleaseWithoutTrees_ReturnsEmpty(self):
+        self.assertEquals(parse_package_trees('Release 3'), {})
+
+    def test_parse_package_trees_ReleaseWithTrees_ReturnsVersionTreeAndDependenciesPerPackage(self):
+        self.assertEquals(parse_package_trees(self.release_message),
+                          {'package1': ('0.0.1', 'aaaa', 'package3@0.2.1'), 'package2': ('0.0.2', 'bbbb', '-')})
+
+    def test_parse_package_trees_TreesWithoutDependencies_AreIgnored(self):
+        self.assertEquals(parse_package_trees('Release 3\n\nPackage-Tree: package1 0.0.1 aaaa'), {})
+
+    def test_format_package_trees_ProcessedPackages_CanBeParsedAgain(self):
+        publishStable.package_trees = {'package1': ('aaaa', 'package3@0.2.1'), 'package2': ('bbbb', '-')}
+        publishStable.local_packages = {'package1': '0.0.1', 'package2': '0.0.2'}
+        self.assertEquals(parse_package_trees(format_package_trees()), publishStable.published_package_trees)
+
+    def test_is_package_tree_unchanged_SameTreeAndVersion_ReturnTrue(self):
+        self.assertTrue(is_package_tree_unchanged('./localPackages/package1', 'package1', '0.0.1'))
+        self.assertEquals(publishStable.package_trees, {'package1': ('aaaa', 'package3@0.2.1')})
+
+    def test_is_package_tree_unchanged_DependencyBumped_ReturnFalse(self):
+        publishStable.local_packages = {'package3': '0.2.2'}
+        self.assertFalse(is_package_tree_unchanged('./localPackages/package1', 'package1', '0.0.1'))
+
+    def test_is_package_tree_unchanged_DifferentTree_ReturnFalse(self):
+        self.git_mock.get_object_info.return_value = ('cccc', 'tree', 0)
+        self.assertFalse(is_package_tree_unchanged('./localPackages/package1', 'package1', '0.0.1'))
+
+    def test_is_package_tree_unchanged_DifferentVersion_ReturnFalse(self):
+        self.assertFalse(is_package_tree_unchanged('./localPackages/package1', 'package1', '0.0.2'))
+
+    def test_is_package_tree_unchanged_PackageNotInRelease_ReturnFalse(self):
+        self.assertFalse(is_package_tree_unchanged('./installedPackages/package3', 'package3', '0.0.1'))
+
+    def test_is_package_tree_unchanged_PackageWithExtraDependencies_ReturnFalse(self):
+        publishStable.args.add_package_as_dependency_to_package = ['package1:package2']
+        self.assertFalse(is_package_tree_unchanged('./localPackages/package1', 'package1', '0.0.1'))
+
+class TestScatterManifest(TestCase):
+    def setUp(self):
+        self.previous_cwd = os.getcwd()
+        self.repo = tempfile.mkdtemp()
+        os.chdir(self.repo)
+        subprocess.check_output('git init -q', shell=True)
+        for project in ['Samples', 'Prototypes/Physics', 'Prototypes/Audio', 'Shared']:
+            os.makedirs(os.path.join(project, 'Packages'))
+            with open(os.path.join(project, 'Packages', 'manifest.json'), 'w') as f:
+                f.write('{"dependencies": {}}')
+        with open(os.path.join('Shared', 'Packages', 'manifest.json'), 'w') as f:
+            f.write('{"dependencies": {"package1": "0.0.2"}}')
+        shutil.copy(os.path.join('Shared', 'Packages', 'manifest.json'), os.path.join('Prototypes', 'Audio', 'Packages'))
+        os.makedirs('NotPackages')
+        with open(os.path.join('NotPackages', 'manifest.json'), 'w') as f:
+            f.write('{}')
+        subprocess.check_output('git add Samples Shared NotPackages', shell=True)
+        args.packages_path = 'Shared/Packages'
+
+    def tearDown(self):
+        mock.patch.stopall()
+        os.chdir(self.previous_cwd)
+        shutil.rmtree(self.repo)
+
+    def test_scatter_manifest_ProjectsInRepo_CopiesSharedManifestToTrackedAndNewProjects(self):
+        scatter_manifest()
+        for project in ['Samples', 'Prototypes/Physics', 'Prototypes/Audio']:
+            with open(os.path.join(project, 'Packages', 'manifest.json')) as f:
+                self.assertEquals(f.read(), '{"dependencies": {"package1": "0.0.2"}}')
+        with open(os.path.join('NotPackages', 'manifest.json')) as f:
+            self.assertEquals(f.read(), '{}')
+
+    def test_scatter_manifest_SomeManifestsUpToDate_StagesChangedOnesInOneCommand(self):
+        git_mock = mock.patch('publishStable.git_cmd', side_effect=publishStable.git_cmd).start()
+        scatter_manifest()
+        add_calls = [c[0][0] for c in git_mock.call_args_list if c[0][0][0] == 'add']
+        self.assertEquals(add_calls, [['add', '--', 'Prototypes/Physics/Packages/manifest.json',
+                                       'Samples/Packages/manifest.json']])
+
+    def test_get_project_manifests_ProjectsWithSpacesAndNonAsciiNames_ReturnPathsAsOnDisk(self):
+        for project in ['My Project', 'Proj\xc3\xa9t']:
+            os.makedirs(os.path.join(project, 'Packages'))
+            with open(os.path.join(project, 'Packages', 'manifest.json'), 'w') as f:
+                f.write('{}')
+        subprocess.check_output(['git', 'add', 'My Project'])
+        manifests = get_project_manifests()
+        self.assertIn(os.path.join('My Project', 'Packages', 'manifest.json'), manifests)
+        self.assertIn(os.path.join('Proj\xc3\xa9t', 'Packages', 'manifest.json'), manifests)
+
+class TestGitRunner(TestCase):
+    def setUp(self):
+        self.previous_cwd = os.getcwd()
+        self.repo = tempfile.mkdtemp()
+        os.chdir(self.repo)
+        self.runner = GitRunner()
+        self.runner.run(['init', '-q'])
+        with open('file with spaces.txt', 'w') as f:
+            f.write('content\n')
+        self.runner.run(['add', '--', 'file with spaces.txt'])
+        self.runner.run(['-c', 'user.name=publish', '-c', 'user.email=publish@example.com', 'commit', '-q', '-m',
+                         'First commit'])
+
+    def tearDown(self):
+        self.runner.close()
+        os.chdir(self.previous_cwd)
+        shutil.rmtree(self.repo)
+
+    def test_run_ArgumentsWithSpaces_PassedWithoutShell(self):
+        self.assertEquals(self.runner.run(['log', '-1', '--pretty=%s']), 'First commit\n')
+        self.assertEquals(self.runner.run(['ls-files', '-z']), 'file with spaces.txt\0')
+
+    def test_run_FailingCommand_RaiseException(self):
+        self.assertRaises(subprocess.CalledProcessError, self.runner.run, ['rev-parse', 'missing-branch'])
+        self.assertNotEquals(self.runner.run_code_only(['rev-parse', '--verify', '-q', 'missing-branch']), 0)
+
+    def test_get_object_info_ExistingAndMissingObjects_ReturnInfoOrNone(self):
+        blob = self.runner.run(['rev-parse', 'HEAD:file with spaces.txt']).strip()
+        self.assertEquals(self.runner.get_object_info('HEAD:file with spaces.txt'), (blob, 'blob', 8))
+        self.assertEquals(self.runner.get_object_info('HEAD:missing.txt'), None)
+        self.assertEquals(self.runner.get_object_info('HEAD:My Project'), None)
+        self.assertEquals(self.runner.get_object_info('HEAD^{tree}')[1], 'tree')
+
+    def test_get_object_info_SeveralObjects_UsesSameProcess(self):
+        self.runner.get_object_info('HEAD:file with spaces.txt')
+        process = self.runner._batch_process
+        self.runner.get_object_info('HEAD:missing.txt')
+        self.assertIs(self.runner._batch_process, process)
+        self.runner.close()
+        self.assertIsNotNone(process.poll())
+
+    def test_get_report_CommandsRun_ListsMostExpensiveAndTotals(self):
+        self.runner.timings = [(0.5, 'git status'), (2.0, 'git fetch target'), (0.25, 'git status')]
+        report = self.runner.get_report(1)
+        self.assertIn('Ran 3 git commands in 2.75s', report)
+        self.assertIn('2.000s  git fetch target', report)
+        self.assertNotIn('0.500s  git status', report)
+        self.assertIn('2.000s  fetch (1 calls)', report)
+
+class TestTracing(TestCase):
+    def setUp(self):
+        self.tracer = Tracer()
+
+    def test_span_TracingDisabled_RecordsNothing(self):
+        with self.tracer.span('squash_commits') as span:
+            span.set('key', 'value')
+        self.assertEquals(self.tracer.events, [])
+
+    def test_span_NestedSpans_ChildInsideParent(self):
+        self.tracer.enable()
+        with self.tracer.span('package1', 'package'):
+            with self.tracer.span('git rev-parse', 'subprocess', command='git rev-parse HEAD'):
+                time.sleep(0.01)
+        child, parent = self.tracer.events
+        self.assertEquals(child['args'], {'command': 'git rev-parse HEAD'})
+        self.assertTrue(parent['ts'] <= child['ts'])
+        self.assertTrue(child['ts'] + child['dur'] <= parent['ts'] + parent['dur'])
+
+    def test_span_ExceptionInSpan_RecordsError(self):
+        self.tracer.enable()
+        try:
+            with self.tracer.span('publish'):
+                raise ValueError('Status 500')
+        except ValueError:
+            pass
+        self.assertEquals(self.tracer.events[0]['args']['error'], 'ValueError: Status 500')
+
+    def test_get_chrome_trace_Spans_ReturnsCompleteEventsAndThreadNames(self):
+        self.tracer.enable()
+        with self.tracer.span('squash_commits'):
+            pass
+        events = self.tracer.get_chrome_trace()['traceEvents']
+        self.assertEquals([e['ph'] for e in events], ['M', 'X'])
+        self.assertEquals(json.loads(json.dumps(events))[1]['name'], 'squash_commits')
+
+    def test_get_summary_RepeatedSpans_ReturnsTotalsPerName(self):
+        self.tracer.enable()
+        for i in range(3):
+            with self.tracer.span('GET package document', 'http'):
+                pass
+        self.assertIn('3  ', self.tracer.get_summary().split('\n')[1])
+        self.assertIn('http: GET package document', self.tracer.get_summary())
+
+    def test_traced_Function_RecordsSpanOnlyWhenEnabled(self):
+        @traced()
+        def squash_commits():
+            return 'done'
+
+        with mock.patch('tracing.tracer', self.tracer):
+            self.assertEquals(squash_commits(), 'done')
+            self.assertEquals(self.tracer.events, [])
+            self.tracer.enable()
+            self.assertEquals(squash_commits(), 'done')
+            self.assertEquals([e['name'] for e in self.tracer.events], ['squash_commits'])
+
+class TestBenchmarks(TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def _generate(self, name, **kwargs):
+        scenario = {'file_count': 50, 'min_size': 100, 'max_size': 1000, 'binary_ratio': 0.2, 'crlf_ratio': 0.5,
+                    'seed': 3}
+        scenario.update(kwargs)
+        return generate_package(os.path.join(self.folder, name), name, **scenario)
+
+    def test_generate_package_SameSeed_GeneratesSamePackage(self):
+        self.assertEquals(self._generate('first'), self._generate('second'))
+        self.assertEquals(create_hash_manifest(os.path.join(self.folder, 'first')),
+                          create_hash_manifest(os.path.join(self.folder, 'second')))
+
+    def test_generate_package_OnlyBinaryFiles_AllFilesDetectedAsBinary(self):
+        files = self._generate('binary', binary_ratio=1.0)
+        self.assertEquals(len(files), 50)
+        for relative_path, is_binary in files:
+            with open(os.path.join(self.folder, 'binary', *relative_path.split('/')), 'rb') as f:
+                self.assertTrue(publishStable._is_binary(f.read()))
+
+    def test_find_regressions_SlowerThanTolerance_ReturnsRegression(self):
+        baseline = {'format': 1, 'results': {'many_small_files': {'cmp_files_text': {'min': 0.1, 'median': 0.1},
+                                                                  'get_all_files_in_package': {'min': 0.001,
+                                                                                               'median': 0.001}}}}
+        results = {'format': 1, 'results': {'many_small_files': {'cmp_files_text': {'min': 0.3, 'median': 0.3},
+                                                                 'get_all_files_in_package': {'min': 0.004,
+                                                                                              'median': 0.004}}}}
+        self.assertEquals(find_regressions(results, baseline, 2.0),
+                          [('many_small_files', 'cmp_files_text', 0.1, 0.3)])
+        self.assertEquals(find_regressions(results, baseline, 4.0), [])
+
+class TestFakeRegistry(TestCase):
+    def setUp(self):
+        self.registry = FakeRegistry().start()
+        self.client = RegistryClient(npmrc_path='')
+
+    def tearDown(self):
+        self.registry.stop()
+
+    def test_publish_NewPackage_CanBeFetchedAndDownloaded(self):
+        self.client.publish({'name': '@unity/package1', 'version': '0.0.2'}, 'tarball', self.registry.url)
+        self.assertEquals(self.client.get_latest_version('@unity/package1', self.registry.url), '0.0.2')
+        dist = self.client.get_version_metadata('@unity/package1', '0.0.2', self.registry.url)['dist']
+        file_path = os.path.join(tempfile.mkdtemp(), 'package1.tgz')
+        with mock.patch('publishStable.registry_client', self.client):
+            get_package_from_url(dist['tarball'], file_path, dist['shasum'], dist['integrity'])
+        with open(file_path, 'rb') as f:
+            self.assertEquals(f.read(), 'tarball')
+        shutil.rmtree(os.path.dirname(file_path))
+
+    def test_publish_ExistingVersion_RaiseException(self):
+        self.registry.add_package({'name': 'package1', 'version': '0.0.1'}, 'tarball')
+        self.assertRaises(RegistryError, self.client.publish, {'name': 'package1', 'version': '0.0.1'}, 'tarball',
+                          self.registry.url)
+
+    def test_get_package_document_ErrorRateOne_RaiseException(self):
+        self.registry.error_rate = 1.0
+        self.client.policy.max_attempts = 1
+        self.assertRaises(RegistryError, self.client.get_latest_version, 'package1', self.registry.url)
+        self.assertEquals(self.registry.get_request_counts(), {'GET 500': 1})
+
+    def test_get_package_document_Latency_DelaysResponse(self):
+        self.registry.latency = 0.1
+        start_time = time.time()
+        self.assertEquals(self.client.get_latest_version('package1', self.registry.url), '')
+        self.assertTrue(time.time() - start_time >= 0.1)
+
+class TestMirror(TestCase):
+    def setUp(self):
+        self.source = FakeRegistry().start()
+        self.target = FakeRegistry().start()
+        self.client = RegistryClient(npmrc_path='')
+        # Not a multiple of three or of the chunk size, so the base64 encoding has to carry bytes between chunks
+        self.tarball = ''.join(chr(i * 7 % 256) for i in range(1000))
+        self.package_file = {'name': '@unity/package1', 'version': '0.0.1', 'dependencies': {'package3': '0.2.1'}}
+        self.source.add_package(self.package_file, self.tarball)
+
+    def tearDown(self):
+        self.source.stop()
+        self.target.stop()
+        mock.patch.stopall()
+
+    def test_mirror_MissingInTarget_StreamsTarballToTarget(self):
+        self.assertTrue(self.client.mirror('@unity/package1', '0.0.1', self.source.url, self.target.url,
+                                           chunk_size=64))
+        version_document = self.target.documents['@unity/package1']['versions']['0.0.1']
+        self.assertEquals(version_document['dependencies'], {'package3': '0.2.1'})
+        self.assertEquals(version_document['dist']['shasum'], hashlib.sha1(self.tarball).hexdigest())
+        self.assertEquals(self.target.tarballs.values(), [self.tarball])
+
+    def test_mirror_ExistingInTarget_SkipsPackage(self):
+        self.target.add_package(self.package_file, self.tarball)
+        self.assertFalse(self.client.mirror('@unity/package1', '0.0.1', self.source.url, self.target.url))
+        self.assertEquals(self.target.get_request_counts(), {'GET 200': 1})
+        self.assertEquals(self.source.get_request_counts(), {})
+
+    def test_mirror_CorruptTarball_AbortsPublish(self):
+        path = self.source.tarballs.keys()[0]
+        self.source.tarballs[path] = 'x' + self.tarball[1:]
+        self.assertRaises(Exception, self.client.mirror, '@unity/package1', '0.0.1', self.source.url, self.target.url)
+        self.assertNotIn('@unity/package1', self.target.documents)
+
+    def test_mirror_SourceFailsOnce_RetriesTarballDownload(self):
+        self.client.policy = RequestPolicy(self.client._session, sleep=lambda delay: None)
+        self.source.fail_next(self.source.tarballs.keys()[0])
+        self.assertTrue(self.client.mirror('@unity/package1', '0.0.1', self.source.url, self.target.url))
+        self.assertEquals(self.target.tarballs.values(), [self.tarball])
+
+    def test_mirror_GzipEncodedTarball_DownloadsTarballFirst(self):
+        self.source.gzip_tarballs = True
+        self.assertTrue(self.client.mirror('@unity/package1', '0.0.1', self.source.url, self.target.url,
+                                           chunk_size=64))
+        self.assertEquals(self.target.tarballs.values(), [self.tarball])
+
+    def test_mirror_GzipEncodedTarballTooLarge_RaisesRegistryError(self):
+        self.source.gzip_tarballs = True
+        self.assertRaises(RegistryError, self.client.mirror, '@unity/package1', '0.0.1', self.source.url,
+                          self.target.url, chunk_size=64, max_buffered_size=500)
+        self.assertNotIn('@unity/package1', self.target.documents)
+
+    def test_mirror_packages_OneMissingInSource_ReportsOnlyThatOne(self):
+        mock.patch('publishStable.registry_client', self.client).start()
+        args.publish_registry = self.target.url
+        args.publish_concurrency = 2
+        failures = publishStable.mirror_packages({'@unity/package1': '0.0.1', 'package2': '0.0.1'}, self.source.url)
+        self.assertEquals(failures.keys(), ['package2'])
+        self.assertIn('@unity/package1', self.target.documents)
+
+class TestPublishBatch(TestCase):
+    def setUp(self):
+        self.saved_args = dict(vars(args))
+        self.saved_state = dict((name, getattr(publishStable, name)) for name in
+                                ['git_runner', 'tarball_cache', 'workspace', 'local_packages', 'modified_packages'])
+        self.folder = tempfile.mkdtemp()
+        self.jobs_path = os.path.join(self.folder, 'jobs.json')
+        with open(self.jobs_path, 'w') as f:
+            json.dump({'common_args': ['--publish-registry', 'https://publish', '--target-branch', 'stable',
+                                       '--packages-path', 'Samples/Packages'],
+                       'jobs': [{'name': 'samples', 'args': ['--target-repo', 'samples.git', '--git-timings', '5']},
+                                {'args': ['--target-repo', 'other.git', '--packages-path', 'Other/Packages']}]}, f)
+
+    def tearDown(self):
+        mock.patch.stopall()
+        args.__dict__.clear()
+        args.__dict__.update(self.saved_args)
+        for name, value in self.saved_state.iteritems():
+            setattr(publishStable, name, value)
+        shutil.rmtree(self.folder)
+
+    def test_load_jobs_CommonArgs_AddedToEveryJob(self):
+        jobs = publishBatch.load_jobs(self.jobs_path)
+        self.assertEquals([name for name, job_args in jobs], ['samples', 'job2'])
+        self.assertEquals([job_args.target_repo for name, job_args in jobs], ['samples.git', 'other.git'])
+        self.assertEquals([job_args.publish_registry for name, job_args in jobs], ['https://publish'] * 2)
+        self.assertEquals(jobs[1][1].packages_path, 'Other/Packages')
+        # The batch reports timings for all jobs at once
+        self.assertEquals(jobs[0][1].git_timings, 0)
+
+    def test_start_job_PreviousJob_ResetsRepoStateAndKeepsCaches(self):
+        jobs = publishBatch.load_jobs(self.jobs_path)
+        publishStable.start_job(jobs[0][1])
+        registry_client = publishStable.registry_client
+        git_runner = publishStable.git_runner
+        publishStable.local_packages['package1'] = '0.0.2'
+        publishStable.file_hashes[('/path', 1, 1.0)] = 'hash'
+        tarball_cache = publishStable.tarball_cache = TarballCache(os.path.join(self.folder, 'cache'), 1024)
+
+        publishStable.start_job(jobs[1][1])
+        self.assertEquals(args.target_repo, 'other.git')
+        self.assertEquals(publishStable.local_packages, {})
+        self.assertIsNot(publishStable.git_runner, git_runner)
+        self.assertIs(publishStable.registry_client, registry_client)
+        self.assertEquals(publishStable.file_hashes[('/path', 1, 1.0)], 'hash')
+        # A cache in another folder than the job asks for isn't kept
+        self.assertIsNone(publishStable.tarball_cache)
+        publishStable.file_hashes.pop(('/path', 1, 1.0))
+
+    def test_run_jobs_FailedJob_SkipRemainingJobs(self):
+        main_mock = mock.patch('publishStable.main').start()
+        main_mock.side_effect = [SystemExit(-1), None]
+        results = publishBatch.run_jobs(publishBatch.load_jobs(self.jobs_path), keep_going=False)
+        self.assertEquals([r['status'] for r in results], ['failed', 'skipped'])
+        self.assertEquals(main_mock.call_count, 1)
+
+    def test_run_jobs_KeepGoing_RunAllJobsAndReport(self):
+        main_mock = mock.patch('publishStable.main').start()
+
+        def main():
+            if args.target_repo == 'samples.git':
+                raise Exception('Could not push')
+            publishStable.git_runner.timings.append((1.5, 'git fetch target'))
+        main_mock.side_effect = main
+        results = publishBatch.run_jobs(publishBatch.load_jobs(self.jobs_path), keep_going=True)
+        self.assertEquals([r['status'] for r in results], ['failed', 'ok'])
+        report = publishBatch.get_report(results, 5)
+        self.assertIn('failed   samples: Could not push', report)
+        self.assertIn('git fetch target [job2]', report)
+
+class TestRegistryHarness(TestCase):
+    def test_run_SomePackagesChanged_PublishesChangedPackages(self):
+        options = mock.Mock(packages=3, changed_ratio=0.34, files_per_package=5, registries=2, latency=0.0,
+                            bandwidth=None, error_rate=0.0, keep=False, verbose=False)
+        result = registry_harness.run(options, ['--git-timings', '0'])
+        self.assertEquals(result['exit_code'], 0)
+        self.assertEquals(result['published_packages'], 1)
+        self.assertEquals(result['requests'][0].get('PUT 201'), 1)
+
+class TestScanRepository(TestCase):
+    files = ['publishStable.py', 'publishStable.pyc', '.gitignore', '.vs/settings.json', '.vs/.hidden',
+             'Tools/Publishing/publishStable.py', 'Tools/CI/.cache/result', 'Samples/Assets/.DS_Store',
+             'Samples/Assets/Scene.unity', 'Samples/Library/.hidden', '.git/config']
+
+    def setUp(self):
+        self.repo = tempfile.mkdtemp()
+        for path in self.files:
+            path = os.path.join(self.repo, *path.split('/'))
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            open(path, 'w').close()
+        self.matcher = RepoPathMatcher(['publishStable.*', 'Tools/Publishing', 'Samples/Library/'],
+                                       ['.gitignore', '.vs'])
+
+    def tearDown(self):
+        shutil.rmtree(self.repo)
+
+    def test_scan_repository_RepoFolder_ReturnsStrippedAndHiddenPaths(self):
+        self.assertEquals(scan_repository(self.matcher, self.repo),
+                          (['Samples/Library', 'Tools/Publishing', 'publishStable.py', 'publishStable.pyc'],
+                           ['Samples/Assets/.DS_Store', 'Tools/CI/.cache']))
+
+    def test_scan_repository_ListOfFiles_ReturnsSameAsWalkingFolder(self):
+        self.assertEquals(scan_repository(self.matcher, paths=[f for f in self.files if not f.startswith('.git/')]),
+                          scan_repository(self.matcher, self.repo))
+
+    def test_match_WildcardInPattern_DoesNotMatchAcrossFoldersOrHiddenNames(self):
+        matcher = RepoPathMatcher(['*.py', 'Tools/[CP]*'], [])
+        self.assertEquals(matcher.match('publishStable.py', 'publishStable.py', False), 'strip')
+        self.assertEquals(matcher.match('Tools/publishStable.py', 'publishStable.py', False), None)
+        self.assertEquals(matcher.match('.hidden.py', '.hidden.py', False), 'hidden')
+        self.assertEquals(matcher.match('Tools/CI', 'CI', True), 'strip')
+
+class TestSquashCommits(TestCase):
+    def setUp(self):
+        self.previous_cwd = os.getcwd()
+        self.repo = tempfile.mkdtemp()
+        os.chdir(self.repo)
+        self._git('init -q')
+        self._git('config user.email publish@example.com')
+        self._git('config user.name publish')
+        self._write('a.txt', 'old')
+        self._write('old.txt', 'old')
+        self._git('add -A')
+        self._git('commit -q -m Release')
+        self.target_commit = self._git('rev-parse HEAD').strip()
+        self._git('checkout -q -b source')
+        self._git('rm -q old.txt')
+        for path in ['a.txt', 'publishStable.py', 'Tools/Publishing/publishStable.py', 'Samples/Assets/Scene.unity',
+                     '.gitignore']:
+            self._write(path, 'new')
+        self._git('add -A')
+        self._git('commit -q -m Source')
+        self._git('checkout -q -b publishStable-temp {0}'.format(self.target_commit))
+        self._write('Samples/Library/untracked.txt', 'untracked')
+        publishStable.source_branch = 'source'
+        args.strip_from_commit = ['publishStable.*', 'Tools/Publishing']
+        args.whitelist_hidden_paths = ['.gitignore']
+        publishStable.package_trees = {}
+
+    def tearDown(self):
+        os.chdir(self.previous_cwd)
+        shutil.rmtree(self.repo)
+
+    def _git(self, cmd):
+        return subprocess.check_output('git {0}'.format(cmd), shell=True)
+
+    def _write(self, path, content):
+        if os.path.dirname(path) and not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as f:
+            f.write(content)
+
+    def test_squash_commits_SourceBranch_CommitsSourceTreeWithoutStrippedPaths(self):
+        squash_commits()
+        self.assertEquals(self._git('rev-parse HEAD~1').strip(), self.target_commit)
+        self.assertEquals(self._git('ls-tree -r --name-only HEAD').split(),
+                          ['.gitignore', 'Samples/Assets/Scene.unity', 'a.txt'])
+        self.assertEquals(self._git('status --porcelain --ignored'), '')
+        with open('a.txt') as f:
+            self.assertEquals(f.read(), 'new')
+
+    def test_squash_commits_HiddenPathNotWhitelisted_RaiseException(self):
+        args.whitelist_hidden_paths = []
+        self.assertRaises(Exception, squash_commits)
+
+    def test_commit_release_AfterSquash_ReplacesSquashCommit(self):
+        squash_commits()
+        commit_release('Release 2')
+        self.assertEquals(self._git('log --pretty=%s').split('\n')[:2], ['Release 2', 'Release'])
+        self.assertTrue(is_head_tree_changed())
+
+    def test_commit_release_EmptyRelease_RaiseException(self):
+        squash_commits()
+        head = self._git('rev-parse HEAD')
+        self.assertRaises(Exception, commit_release, '')
+        self.assertEquals(self._git('rev-parse HEAD'), head)
+
+    def test_commit_index_EmptyMessage_RaiseException(self):
+        head = self._git('rev-parse HEAD')
+        self.assertRaises(Exception, commit_index, ' \n', [head.strip()])
+        self.assertEquals(self._git('rev-parse HEAD'), head)
+
+    def test_is_head_tree_changed_SameTreeAsTarget_ReturnFalse(self):
+        self._git('checkout -q source')
+        self._git('checkout -q -b publishStable-temp2')
+        args.strip_from_commit = []
+        squash_commits()
+        self.assertFalse(is_head_tree_changed())
+
+class TestShallowTargetFetch(TestCase):
+    def setUp(self):
+        self.previous_cwd = os.getcwd()
+        self.root = tempfile.mkdtemp()
+        self.target = os.path.join(self.root, 'target.git')
+        self._git(self.root, 'init -q --bare target.git')
+        self._git(self.target, 'config uploadpack.allowFilter true')
+        self._git(self.root, 'init -q work')
+        work = os.path.join(self.root, 'work')
+        for message in ['Release 1', 'Release 2', 'Fix']:
+            self._commit(work, 'target.txt', message)
+        self._git(work, 'push -q {0} HEAD:stable'.format(self.target))
+
+        self.source = os.path.join(self.root, 'source')
+        self._git(self.root, 'init -q source')
+        self._commit(self.source, 'source.txt', 'Source')
+        os.chdir(self.source)
+        publishStable.source_branch = 'master'
+        args.target_repo = self.target
+        args.target_branch = 'stable'
+        args.shallow_target_fetch = True
+        args.release_lookup_depth = 10
+
+    def tearDown(self):
+        os.chdir(self.previous_cwd)
+        shutil.rmtree(self.root)
+
+    def _git(self, cwd, cmd):
+        return subprocess.check_output('git {0}'.format(cmd), shell=True, cwd=cwd)
+
+    def _commit(self, repo, path, message):
+        self._git(repo, 'config user.email publish@example.com')
+        self._git(repo, 'config user.name publish')
+        with open(os.path.join(repo, path), 'w') as f:
+            f.write(message)
+        self._git(repo, 'add -A')
+        self._git(repo, 'commit -q -m "{0}"'.format(message))
+
+    def test_add_destination_repo_Shallow_FetchesOnlyTipWithoutFiles(self):
+        add_destination_repo()
+        self.assertEquals(self._git(self.source, 'rev-list --count target/stable').strip(), '1')
+        missing = [l for l in self._git(self.source, 'rev-list --objects --missing=print target/stable').split('\n')
+                   if l.startswith('?')]
+        self.assertEquals(len(missing), 1)
+        self.assertEquals(self._git(self.source, 'symbolic-ref HEAD').strip(), 'refs/heads/publishStable-temp')
+        # The files of the source branch are still checked out
+        self.assertEquals(sorted(os.listdir(self.source)), ['.git', 'source.txt'])
+
+    def test_add_destination_repo_Shallow_DoesNotKeepFilterForRemote(self):
+        add_destination_repo()
+        self.assertNotEquals(subprocess.call(['git', 'config', '--get', 'remote.target.partialclonefilter']), 0)
+
+    def test_add_destination_repo_NotShallowAfterShallowRun_CompletesHistory(self):
+        add_destination_repo()
+        args.shallow_target_fetch = False
+        add_destination_repo()
+        self.assertEquals(self._git(self.source, 'rev-parse --is-shallow-repository').strip(), 'false')
+        self.assertEquals(self._git(self.source, 'rev-list --count target/stable').strip(), '3')
+        missing = [l for l in self._git(self.source, 'rev-list --objects --missing=print target/stable').split('\n')
+                   if l.startswith('?')]
+        self.assertEquals(missing, [])
+        self.assertNotEquals(subprocess.call(['git', 'config', '--get', 'remote.target.promisor']), 0)
+        self.assertNotEquals(subprocess.call(['git', 'config', '--get', publishStable.SHALLOW_TARGET_CONFIG]), 0)
+        self.assertEquals(sorted(os.listdir(self.source)), ['.git', 'target.txt'])
+
+    def test_add_destination_repo_NotShallowInShallowSourceClone_LeavesSourceHistoryAlone(self):
+        clone = os.path.join(self.root, 'clone')
+        self._git(self.root, 'clone -q --depth 1 file://{0} clone'.format(self.source))
+        os.chdir(clone)
+        args.shallow_target_fetch = False
+        git_mock = mock.patch('publishStable.git_cmd', side_effect=publishStable.git_cmd).start()
+        try:
+            add_destination_repo()
+        finally:
+            mock.patch.stopall()
+        self.assertNotIn(['fetch', '--unshallow', 'target'], [c[0][0] for c in git_mock.call_args_list])
+        self.assertEquals(self._git(clone, 'rev-parse --is-shallow-repository').strip(), 'true')
+
+    def test_get_next_release_TipIsNotARelease_DeepensUntilFound(self):
+        add_destination_repo()
+        self.assertEquals(get_next_release(), 'Release 3')
+        self.assertEquals(self._git(self.source, 'rev-list --count target/stable').strip(), '3')
+
+    def test_get_next_release_NoReleaseWithinDepth_RaiseException(self):
+        args.release_lookup_depth = 1
+        add_destination_repo()
+        self.assertRaises(Exception, get_next_release)
+
+    def test_get_next_release_NotShallowReleaseBeyondDepth_SearchesWholeBranch(self):
+        args.shallow_target_fetch = False
+        args.release_lookup_depth = 1
+        add_destination_repo()
+        self.assertEquals(get_next_release(), 'Release 3')
+
+    def test_parse_next_release_Messages_ReturnAfterNewestRelease(self):
+        self.assertEquals(parse_next_release('Fix\n\nRelease 12\nPackage-Tree: a 0.1.0 123\nRelease 11\n'),
+                          'Release 13')
+        self.assertEquals(parse_next_release('Release candidate\nRelease 1 2\n'), None)
+
+class FakeResponse(object):
+    def __init__(self, status_code, chunks, fail_after=None, headers=None):
+        self.status_code = status_code
+        self.chunks = chunks
+        self.fail_after = fail_after
+        self.headers = headers or {}
+
+    def iter_content(self, chunk_size):
+        for index, chunk in enumerate(self.chunks):
+            if index == self.fail_after:
+                raise IOError("Connection reset")
+            yield chunk
+
+    def raise_for_status(self):
+        raise IOError("Status {0}".format(self.status_code))
+
+    def close(self):
+        pass
+
+class TestRequestPolicy(TestCase):
+    def setUp(self):
+        self.session = mock.Mock()
+        self.delays = []
+        self.policy = RequestPolicy(self.session, min_samples=3, sleep=self.delays.append)
+
+    def _record(self, *durations):
+        for duration in durations:
+            self.policy.latencies.record('registry', duration)
+
+    def test_get_percentile_Samples_ReturnsNearestRank(self):
+        tracker = LatencyTracker()
+        for duration in range(1, 101):
+            tracker.record('registry', duration)
+        self.assertEquals(tracker.get_percentile('registry', 50), 50)
+        self.assertEquals(tracker.get_percentile('registry', 99), 99)
+        self.assertIsNone(tracker.get_percentile('other', 50))
+
+    def test_get_timeout_FewSamples_UseDefault(self):
+        self._record(0.1, 0.1)
+        self.assertEquals(self.policy.get_timeout('registry'), 30.0)
+
+    def test_get_timeout_EnoughSamples_FollowLatencyWithinLimits(self):
+        self._record(1.0, 1.0, 10.0)
+        self.assertEquals(self.policy.get_timeout('registry'), 30.0)
+        # Only the most recent requests count
+        self._record(*[0.1] * 200)
+        self.assertEquals(self.policy.get_timeout('registry'), 2.0)
+
+    def test_request_Get_PassesTimeoutFromHost(self):
+        self._record(1.0, 1.0, 1.0)
+        self.session.get.return_value = mock.Mock(status_code=200)
+        self.policy.request('GET', 'https://registry/package1')
+        self.assertEquals(self.session.get.call_args[1]['timeout'], 3.0)
+
+    def test_request_ServerErrors_RetryWithJitteredDelays(self):
+        self.session.get.side_effect = [mock.Mock(status_code=503), requests.ConnectionError('reset'),
+                                        mock.Mock(status_code=200)]
+        self.assertEquals(self.policy.request('GET', 'https://registry/package1').status_code, 200)
+        self.assertEquals(len(self.delays), 2)
+        self.assertTrue(0 <= self.delays[0] <= 0.5 and 0 <= self.delays[1] <= 1.0)
+
+    def test_request_AlwaysServerError_ReturnLastResponse(self):
+        self.session.get.return_value = mock.Mock(status_code=500)
+        self.assertEquals(self.policy.request('GET', 'https://registry/package1').status_code, 500)
+        self.assertEquals(self.session.get.call_count, 5)
+
+    def test_request_Put_IsNotRetried(self):
+        self.session.put.side_effect = requests.ConnectionError('reset')
+        self.assertRaises(requests.ConnectionError, self.policy.request, 'PUT', 'https://registry/package1')
+        self.assertEquals(self.session.put.call_count, 1)
+
+    def test_request_ManyFailures_OpenCircuit(self):
+        self.session.get.side_effect = requests.ConnectionError('reset')
+        self.assertRaises(requests.ConnectionError, self.policy.request, 'GET', 'https://registry/package1')
+        self.assertRaises(CircuitOpenError, self.policy.request, 'GET', 'https://registry/package2')
+        self.assertEquals(self.session.get.call_count, 5)
+
+    def test_request_SlowHedgedRequest_UseFasterSecondRequest(self):
+        self._record(0.05, 0.05, 0.05)
+        slow, fast = mock.Mock(status_code=200), mock.Mock(status_code=200)
+
+        def get(url, **kwargs):
+            if self.session.get.call_count == 1:
+                time.sleep(0.5)
+                return slow
+            return fast
+        self.session.get.side_effect = get
+        self.assertIs(self.policy.request('GET', 'https://registry/package1', hedge=True), fast)
+        self.assertEquals(self.policy.hedged['registry'], 1)
+
+    def test_circuit_breaker_AfterResetTimeout_LetOneRequestThrough(self):
+        now = [0.0]
+        breaker = CircuitBreaker(failure_threshold=2, reset_timeout=10, clock=lambda: now[0])
+        breaker.record_failure('registry')
+        breaker.record_failure('registry')
+        self.assertFalse(breaker.allow('registry'))
+        now[0] = 10.0
+        self.assertTrue(breaker.allow('registry'))
+        self.assertFalse(breaker.allow('registry'))
+        breaker.record_success('registry')
+        self.assertTrue(breaker.allow('registry'))
+
+class TestGetPackageFromUrl(TestCase):
+    content = 'first chunk|second chunk'
+    shasum = hashlib.sha1(content).hexdigest()
+    integrity = 'sha512-' + base64.b64encode(hashlib.sha512(content).digest())
+
+    def setUp(self):
+        self.download_folder = tempfile.mkdtemp()
+        self.file_path = os.path.join(self.download_folder, 'package.tgz')
+        patch = mock.patch('publishStable.registry_client')
+        self.registry_mock = patch.start()
+        self.registry_mock.policy = RequestPolicy(sleep=lambda delay: None)
+
+    def tearDown(self):
+        mock.patch.stopall()
+        shutil.rmtree(self.download_folder)
+
+    def test_get_package_from_url_CompleteDownload_WritesFile(self):
+        self.registry_mock.get.side_effect = [FakeResponse(200, ['first chunk|', 'second chunk'])]
+        self.assertTrue(get_package_from_url('url', self.file_path, self.shasum, self.integrity))
+        self.assertEquals(open(self.file_path, 'rb').read(), self.content)
+
+    def test_get_package_from_url_InterruptedDownload_ResumesWithRange(self):
+        self.registry_mock.get.side_effect = [FakeResponse(200, ['first chunk|', 'second chunk'], fail_after=1),
+                                              FakeResponse(206, ['second chunk'],
+                                                           headers={'Content-Range': 'bytes 12-23/24'})]
+        self.assertTrue(get_package_from_url('url', self.file_path, self.shasum, self.integrity))
+        self.assertEquals(self.registry_mock.get.call_args[1]['headers'], {'Range': 'bytes=12-'})
+        self.assertEquals(open(self.file_path, 'rb').read(), self.content)
+
+    def test_get_package_from_url_ResumeNotSupported_StartsOver(self):
+        self.registry_mock.get.side_effect = [FakeResponse(200, ['first chunk|', 'second chunk'], fail_after=1),
+                                              FakeResponse(200, ['first chunk|', 'second chunk'])]
+        self.assertTrue(get_package_from_url('url', self.file_path, self.shasum, self.integrity))
+        self.assertEquals(open(self.file_path, 'rb').read(), self.content)
+
+    def test_get_package_from_url_ResumedFromWrongByte_ReportsRequestedByte(self):
+        self.registry_mock.policy.max_attempts = 2
+        self.registry_mock.get.side_effect = [FakeResponse(200, ['first chunk|', 'second chunk'], fail_after=1),
+                                              FakeResponse(206, ['chunk'], headers={'Content-Range': 'bytes 19-23/24'})]
+        self.assertRaisesRegexp(Exception, "didn't resume from byte 12", get_package_from_url, 'url', self.file_path,
+                                self.shasum, self.integrity)
+
+    def test_get_package_from_url_WrongShasum_RaiseException(self):
+        self.registry_mock.get.side_effect = [FakeResponse(200, ['corrupted'])]
+        self.assertRaises(Exception, get_package_from_url, 'url', self.file_path, self.shasum, self.integrity)
+
+class TestTarballCache(TestCase):
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.cache = TarballCache(self.cache_dir, 10)
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def _writer(self, content):
+        def write(path):
+            with open(path, 'wb') as f:
+                f.write(content)
+        return write
+
+    def _failing_writer(self, path):
+        raise IOError("Download failed")
+
+    def test_get_EmptyCache_ReturnNone(self):
+        self.assertIsNone(self.cache.get('package1', '0.0.1', 'sha512-abc'))
+
+    def _add(self, package_name, version, integrity, content):
+        self.cache.add(package_name, version, integrity, self._writer(content)).close()
+        return self.cache.get_path(package_name, version, integrity)
+
+    def test_add_NewTarball_CanBeFoundInCache(self):
+        with self.cache.add('package1', '0.0.1', 'sha512-abc', self._writer('abc')) as tarball:
+            self.assertEquals(tarball.read(), 'abc')
+        with self.cache.get('package1', '0.0.1', 'sha512-abc') as tarball:
+            self.assertEquals(tarball.read(), 'abc')
+
+    def test_get_EvictedWhileOpen_CanStillBeRead(self):
+        self._add('package1', '0.0.1', 'a', '1234')
+        with self.cache.get('package1', '0.0.1', 'a') as tarball:
+            self._add('package2', '0.0.1', 'b', '12345678')
+            self._add('package3', '0.0.1', 'c', '12345678')
+            self.assertIsNone(self.cache.get('package1', '0.0.1', 'a'))
+            self.assertEquals(tarball.read(), '1234')
+
+    def test_get_DifferentIntegrity_ReturnNone(self):
+        self._add('package1', '0.0.1', 'sha512-abc', 'abc')
+        self.assertIsNone(self.cache.get('package1', '0.0.1', 'sha512-def'))
+
+    def test_add_FailingDownload_LeavesNothingInCache(self):
+        self.assertRaises(IOError, self.cache.add, 'package1', '0.0.1', 'sha512-abc', self._failing_writer)
+        self.assertEquals(os.listdir(self.cache_dir), [])
+
+    def test_add_CacheAboveMaxSize_EvictsLeastRecentlyUsed(self):
+        first = self._add('package1', '0.0.1', 'a', '1234')
+        second = self._add('package2', '0.0.1', 'b', '1234')
+        os.utime(first, (1000, 1000))
+        os.utime(second, (2000, 2000))
+        self.cache.get('package1', '0.0.1', 'a').close()
+        third = self._add('package3', '0.0.1', 'c', '1234')
+        self.assertEquals(sorted(os.listdir(self.cache_dir)),
+                          sorted(os.path.basename(p) for p in [first, third]))
+
+    def test_add_TarballLargerThanMaxSize_KeepsNewTarball(self):
+        path = self._add('package1', '0.0.1', 'a', '12345678901234567890')
+        self.assertTrue(os.path.isfile(path))
+
+class TestPackPackage(TestCase):
+    def _pack(self, package_folder):
+        output = io.BytesIO()
+        result = pack_local_package(package_folder, parse_package_json(package_folder), output)
+        return output.getvalue(), result
+
+    def test_pack_package_SamePackageTwice_ReturnsIdenticalTarballs(self):
+        first, first_result = self._pack('./localPackages/package1')
+        second, second_result = self._pack('./installedPackages/package1Clone')
+        self.assertEquals(first, second)
+        self.assertEquals(first_result, second_result)
+
+    def test_pack_package_ExistingPackage_ReturnsShasumOfTarball(self):
+        tarball, result = self._pack('./localPackages/package1')
+        self.assertEquals(result['shasum'], hashlib.sha1(tarball).hexdigest())
+        self.assertEquals(result['size'], len(tarball))
+        self.assertTrue(result['integrity'].startswith('sha512-'))
+
+    def test_pack_package_WithoutOutput_ReturnsSameShasum(self):
+        tarball, result = self._pack('./localPackages/package1')
+        self.assertEquals(pack_package({'testFile.txt': './localPackages/package1/testFile.txt'},
+                                       parse_package_json('./localPackages/package1'))['shasum'], result['shasum'])
+
+    def test_pack_package_PackageWithNodeModules_ReturnsNpmLayout(self):
+        tarball, result = self._pack('./installedPackages/package3')
+        tar = tarfile.open(fileobj=io.BytesIO(tarball), mode='r:gz')
+        members = tar.getmembers()
+        self.assertEquals([m.name for m in members], ['package/package.json', 'package/testFile.txt'])
+        self.assertEquals(set(m.mtime for m in members), set([NPM_PACK_MTIME]))
+        self.assertEquals(json.load(tar.extractfile(members[0])), parse_package_json('./installedPackages/package3'))
+
+class TestIsPackageShasumUnchanged(TestCase):
+    def setUp(self):
+        patch = mock.patch('publishStable.get_published_package_metadata')
+        self.metadata_mock = patch.start()
+        publishStable.args.add_package_as_dependency_to_package = []
+        publishStable.local_packages = {}
+
+    def tearDown(self):
+        mock.patch.stopall()
+
+    def _published_package(self, package_folder):
+        published_package = parse_package_json(package_folder)
+        published_package[publishStable.HASH_MANIFEST_KEY] = create_hash_manifest(package_folder)
+        published_package['dist'] = pack_local_package(package_folder, dict(published_package))
+        return published_package
+
+    def test_is_package_shasum_unchanged_SameFilesAsPublished_ReturnTrue(self):
+        self.metadata_mock.return_value = self._published_package('./installedPackages/package1Clone')
+        self.assertTrue(is_package_shasum_unchanged('./localPackages/package1', 'package1', '0.0.1'))
+
+    def test_is_package_shasum_unchanged_PublishedWithoutManifest_ReturnFalse(self):
+        published_package = self._published_package('./installedPackages/package1Clone')
+        del published_package[publishStable.HASH_MANIFEST_KEY]
+        self.metadata_mock.return_value = published_package
+        self.assertFalse(is_package_shasum_unchanged('./localPackages/package1', 'package1', '0.0.1'))
+
+    def test_is_package_shasum_unchanged_DependencyVersionChanged_ReturnFalse(self):
+        self.metadata_mock.return_value = self._published_package('./installedPackages/package1Clone')
+        publishStable.local_packages = {'package3': '0.2.2'}
+        self.assertFalse(is_package_shasum_unchanged('./localPackages/package1', 'package1', '0.0.1'))
+
+class TestScheduleDependencyGraph(TestCase):
+    def setUp(self):
+        self.dependencies = {'entities': ['collections', 'jobs'], 'jobs': ['collections'], 'collections': [],
+                             'mathematics': []}
+
+    def test_get_dependency_waves_PackagesWithDependencies_ReturnDependenciesFirst(self):
+        self.assertEquals(get_dependency_waves(self.dependencies),
+                          [['collections', 'mathematics'], ['jobs'], ['entities']])
+
+    def test_get_dependency_waves_DependencyOutsideOfGraph_IsIgnored(self):
+        self.assertEquals(get_dependency_waves({'jobs': ['collections']}), [['jobs']])
+
+    def test_get_dependency_waves_CyclicDependencies_RaiseException(self):
+        self.assertRaises(Exception, get_dependency_waves, {'jobs': ['collections'], 'collections': ['jobs']})
+
+    def test_schedule_dependency_graph_AllSucceed_RunInDependencyOrder(self):
+        done = []
+        self.assertEquals(schedule_dependency_graph(self.dependencies, done.append, 4), {})
+        self.assertEquals(done.index('collections') < done.index('jobs') < done.index('entities'), True)
+        self.assertEquals(sorted(done), sorted(self.dependencies.keys()))
+
+    def test_schedule_dependency_graph_DependencyFails_SkipDependentPackages(self):
+        done = []
+
+        def func(package_name):
+            if package_name == 'jobs':
+                raise Exception('Status 500')
+            done.append(package_name)
+
+        failures = schedule_dependency_graph(self.dependencies, func, 4)
+        self.assertEquals(sorted(done), ['collections', 'mathematics'])
+        self.assertEquals(failures['jobs'], 'Status 500')
+        self.assertIn('jobs', failures['entities'])
+
+    def test_schedule_dependency_graph_SlowPackage_OnlyHoldsUpItsDependents(self):
+        done = []
+
+        def func(package_name):
+            if package_name == 'mathematics':
+                time.sleep(0.5)
+            done.append(package_name)
+
+        schedule_dependency_graph(self.dependencies, func, 2)
+        self.assertEquals(done, ['collections', 'jobs', 'entities', 'mathematics'])
+
+    def test_schedule_dependency_graph_PackagesPrintAtTheSameTime_OutputIsNotInterleaved(self):
+        def func(package_name):
+            for i in range(20):
+                print package_name, i
+                time.sleep(0.001)
+
+        stdout = io.BytesIO()
+        with mock.patch('sys.stdout', stdout):
+            schedule_dependency_graph({'jobs': [], 'collections': [], 'mathematics': []}, func, 3)
+            self.assertIs(sys.stdout, stdout)
+        lines = stdout.getvalue().splitlines()
+        for name in ['jobs', 'collections', 'mathematics']:
+            first = lines.index('{0} 0'.format(name))
+            self.assertEquals(lines[first:first + 20], ['{0} {1}'.format(name, i) for i in range(20)])
+
+    def test_schedule_dependency_graph_CyclicDependencies_RunNothing(self):
+        done = []
+        self.assertRaises(Exception, schedule_dependency_graph, {'jobs': ['collections'], 'collections': ['jobs']},
+                          done.append, 4)
+        self.assertEquals(done, [])
+
+class TestGetPackageGraph(TestCase):
+    def setUp(self):
+        self.packages_path = os.path.join(tempfile.mkdtemp(), 'Packages')
+        shutil.copytree('./localPackages', self.packages_path)
+        shutil.copytree(os.path.join(self.packages_path, 'package2'), os.path.join(self.packages_path, 'package3'))
+        mock.patch('publishStable.workspace', Workspace(self.packages_path)).start()
+        self.package_paths = [os.path.join(self.packages_path, n) for n in ['package1', 'package2', 'package3']]
+        args.add_packages_to_manifest = None
+        args.add_package_as_dependency_to_package = []
+
+    def tearDown(self):
+        mock.patch.stopall()
+        shutil.rmtree(os.path.dirname(self.packages_path))
+
+    def test_get_package_graph_LocalDependencyInPackageJson_IsInGraph(self):
+        self.assertEquals(get_package_graph(self.package_paths),
+                          {'package1': ['package3'], 'package2': [], 'package3': []})
+
+    def test_get_package_graph_ManualDependency_IsInGraph(self):
+        args.add_package_as_dependency_to_package = ['package2:package3', 'package2:com.unity.other']
+        self.assertEquals(get_package_graph(self.package_paths)['package2'], ['package3'])
+
+    def test_get_package_graph_AddedToManifest_DependsOnAllOtherPackages(self):
+        args.add_packages_to_manifest = ['package2', 'package3']
+        self.assertEquals(get_package_graph(self.package_paths),
+                          {'package1': ['package3'], 'package2': ['package1'], 'package3': ['package1']})
+
+class TestWorkspace(TestCase):
+    def setUp(self):
+        self.packages_path = os.path.join(tempfile.mkdtemp(), 'Packages')
+        shutil.copytree('./localPackages', self.packages_path)
+        self.workspace = Workspace(self.packages_path)
+        patch = mock.patch('publishStable.workspace', self.workspace)
+        patch.start()
+        args.packages_path = self.packages_path
+        args.publish_registry = 'https://publish-registry'
+        args.add_packages_to_manifest = ['package1']
+        args.add_package_as_dependency_to_package = []
+        publishStable.local_packages = {'package3': '0.2.2'}
+        publishStable.modified_packages = {'package1': '0.0.2'}
+
+    def tearDown(self):
+        mock.patch.stopall()
+        shutil.rmtree(os.path.dirname(self.packages_path))
+
+    def test_modify_json_ModifiedPackage_OnlyChangesFilesInMemory(self):
+        modify_json('package1', '0.0.2')
+        self.assertEquals(parse_package_json(os.path.join(self.packages_path, 'package1'))['version'], '0.0.1')
+        self.assertEquals(self.workspace.get_package_file('package1')['version'], '0.0.2')
+        self.assertEquals(self.workspace.get_package_file('package1')['dependencies'], {'package3': '0.2.2'})
+        self.assertEquals(self.workspace.get_manifest()['dependencies'], {'package1': '0.0.2'})
+        self.assertEquals(self.workspace.get_manifest()['registry'], 'https://publish-registry')
+
+    def test_save_ModifiedPackage_KeepsFilePermissions(self):
+        package_json = os.path.join(self.packages_path, 'package1', 'package.json')
+        os.chmod(package_json, 0o644)
+        modify_json('package1', '0.0.2')
+        self.workspace.save()
+        self.assertEquals(os.stat(package_json).st_mode & 0o777, 0o644)
+
+    def test_save_ModifiedPackage_WritesChangedFilesOnce(self):
+        modify_json('package1', '0.0.2')
+        self.workspace.get_package_file('package2')
+        self.assertEquals(sorted(self.workspace.save()), ['manifest.json', 'package1/package.json'])
+        self.assertEquals(parse_package_json(os.path.join(self.packages_path, 'package1'))['version'], '0.0.2')
+        self.assertEquals(self.workspace.save(), [])
+        self.assertEquals(sorted(os.listdir(self.packages_path)), ['manifest.json', 'package1', 'package2'])
+
+    def test_save_KeysInFile_KeepsOrder(self):
+        modify_json('package1', '0.0.2')
+        self.workspace.save()
+        with open(os.path.join(self.packages_path, 'package1', 'package.json')) as f:
+            keys = [line.split('"')[1] for line in f if line.startswith('    "')]
+        self.assertEquals(keys, ['name', 'version', 'dependencies', 'description', 'keywords'])
+
+    def test_get_diff_ModifiedPackage_ShowsVersionChange(self):
+        modify_json('package1', '0.0.2')
+        diff = self.workspace.get_diff()
+        self.assertIn('--- a/package1/package.json', diff)
+        self.assertIn('-  "version": "0.0.1",', diff)
+        self.assertIn('+    "version": "0.0.2", ', diff)
+
+    def test_forget_package_RemovedPackage_IsNotWritten(self):
+        modify_json('package1', '0.0.2')
+        self.workspace.forget_package('package1')
+        self.assertEquals(self.workspace.save(), ['manifest.json'])
+
 class TestisPackageChanged(TestCase):
-    pass
+    def setUp(self):
+        patch = mock.patch('publishStable.get_published_package_metadata')
+        self.metadata_mock = patch.start()
+        publishStable.args.add_package_as_dependency_to_package = []
+
+    def tearDown(self):
+        mock.patch.stopall()
+
+    def _published_package(self, installed_path):
+        published_package = parse_package_json(installed_path)
+        published_package[publishStable.HASH_MANIFEST_KEY] = create_hash_manifest(installed_path)
+        return published_package
+
+    def test_is_package_changed_from_hash_manifest_PublishedPackageWithoutManifest_ReturnsNone(self):
+        self.metadata_mock.return_value = parse_package_json('./installedPackages/package1Clone')
+        self.assertIsNone(is_package_changed_from_hash_manifest('./localPackages/package1', 'package1', '0.0.1'))
+
+    def test_is_package_changed_from_hash_manifest_NoDifferencesInPackage_ReturnsFalse(self):
+        self.metadata_mock.return_value = self._published_package('./installedPackages/package1Clone')
+        self.assertFalse(is_package_changed_from_hash_manifest('./localPackages/package1', 'package1', '0.0.1'))
+
+    def test_is_package_changed_from_hash_manifest_DifferentDigest_ReturnsTrue(self):
+        published_package = self._published_package('./installedPackages/package1Clone')
+        published_package[publishStable.HASH_MANIFEST_KEY]['digest'] = '0' * 40
+        self.metadata_mock.return_value = published_package
+        self.assertTrue(is_package_changed_from_hash_manifest('./localPackages/package1', 'package1', '0.0.1'))
+
+    def test_is_package_changed_from_hash_manifest_ManifestWithHashPerFile_ReturnsNone(self):
+        published_package = parse_package_json('./installedPackages/package1Clone')
+        published_package[publishStable.HASH_MANIFEST_KEY] = {'format': 2, 'files': {'testFile.txt': '0' * 40}}
+        self.metadata_mock.return_value = published_package
+        self.assertIsNone(is_package_changed_from_hash_manifest('./localPackages/package1', 'package1', '0.0.1'))
+
+    def test_is_package_changed_from_hash_manifest_DifferencesInPackageJSON_ReturnsTrue(self):
+        self.metadata_mock.return_value = self._published_package('./installedPackages/package4')
+        self.assertTrue(is_package_changed_from_hash_manifest('./localPackages/package1', 'package1', '0.0.1'))
+
+    def test_is_package_changed_PublishedPackageWithoutManifest_FallsBackToTarball(self):
+        publishStable.args.change_detection = 'hashes'
+        self.metadata_mock.return_value = {}
+        with mock.patch('publishStable.is_package_changed_from_tarball') as tarball_mock:
+            tarball_mock.return_value = True
+            self.assertTrue(publishStable.is_package_changed('./localPackages/package1', 'package1', '0.0.1'))
+            tarball_mock.assert_called_once_with('./localPackages/package1', 'package1', '0.0.1')
+
+    def test_is_package_changed_ManifestDecides_DoesNotPack(self):
+        publishStable.args.change_detection = 'hashes'
+        self.metadata_mock.return_value = self._published_package('./installedPackages/package1Clone')
+        with mock.patch('publishStable.is_package_shasum_unchanged') as shasum_mock:
+            self.assertFalse(publishStable.is_package_changed('./localPackages/package1', 'package1', '0.0.1'))
+            self.assertFalse(shasum_mock.called)
+
+class TestResolveRepublishDependencies(TestCase):
+    def setUp(self):
+        self.documents = {
+            'view': {
+                'entities': self._document({'0.1.0': {'jobs': '0.1.0', 'collections': '0.1.0', 'other': '1.0.0'}}),
+                'jobs': self._document({'0.1.0': {'collections': '0.1.0', 'burst': '1.0.0'}}),
+                'collections': self._document({'0.1.0': {'burst': '1.0.0'}, '0.2.0': {}}),
+                'burst': self._document({'1.0.0': {}}),
+            },
+            'publish': {
+                'collections': self._document({'0.1.0': {}}),
+                'burst': self._document({'0.9.0': {}}),
+            },
+        }
+        patch = mock.patch('publishStable.registry_client', RegistryClient(npmrc_path=''))
+        self.registry_client = patch.start()
+        fetch_patch = mock.patch.object(self.registry_client, '_fetch_package_document')
+        self.fetch_mock = fetch_patch.start()
+        self.fetch_mock.side_effect = lambda name, registry: self.documents[registry].get(name)
+        publishStable.best_view_registry = 'view'
+        args.max_concurrent_requests = 4
+        args.add_package_as_dependency_to_package = ['entities:jobs', 'entities:collections', 'jobs:burst']
+
+    def tearDown(self):
+        mock.patch.stopall()
+
+    def _document(self, versions):
+        return {'dist-tags': {'latest': sorted(versions.keys())[-1]},
+                'versions': dict((v, {'version': v, 'dependencies': d}) for v, d in versions.iteritems())}
+
+    def test_resolve_republish_dependencies_TrackedDependencies_FollowedTransitively(self):
+        self.assertEquals(resolve_republish_dependencies({'entities': '0.1.0'}),
+                          {'entities': '0.1.0', 'jobs': '0.1.0', 'collections': '0.1.0', 'burst': '1.0.0'})
+
+    def test_resolve_republish_dependencies_SharedDependencies_FetchedOnce(self):
+        resolve_republish_dependencies({'entities': '0.1.0'})
+        self.assertEquals(sorted(c[0][0] for c in self.fetch_mock.call_args_list),
+                          ['burst', 'collections', 'entities', 'jobs'])
+
+    def test_resolve_republish_dependencies_VersionGiven_WinsOverDependencyVersion(self):
+        resolved = resolve_republish_dependencies({'entities': '0.1.0', 'collections': '0.2.0'})
+        self.assertEquals(resolved['collections'], '0.2.0')
+
+    def test_get_packages_missing_in_registry_MissingVersionsAndPackages_ReturnsThem(self):
+        packages = {'entities': '0.1.0', 'jobs': '0.1.0', 'collections': '0.1.0', 'burst': '1.0.0'}
+        self.assertEquals(get_packages_missing_in_registry(packages, 'publish'), ['burst', 'entities', 'jobs'])
 
 class TestGetFilteredDependenciesFromViewRegistry(TestCase):
     def setUp(self):
-        patch = mock.patch('publishStable.npm_cmd')
-        self.npm_mock = patch.start()
-        self.npm_mock.side_effect = npm_mock.npm_cmd
+        patch = mock.patch('publishStable.registry_client', RegistryClient(npmrc_path=''))
+        self.registry_client = patch.start()
+        fetch_patch = mock.patch.object(self.registry_client, '_fetch_package_document')
+        self.fetch_mock = fetch_patch.start()
+        self.fetch_mock.side_effect = npm_mock.fetch_package_document
 
     def tearDown(self):
         mock.patch.stopall()
@@ -0,0 +1,178 @@
+"""
+Runs all of publishStable against fake registries and reports how long it took, so changes to how the publishing
+scripts talk to registries can be measured without a real registry. A source repo with the packages and a bare target
+repo are created in a temporary folder, every package is published to all the fake registries in an older version and
+publishStable is started on it. Run it from this folder with the publishing folder on the PYTHONPATH, like the tests:
+
+    python registry_harness.py --packages 20 --registries 3 --latency 0.05 --bandwidth 2000000
+
+Any arguments after -- are passed on to publishStable.
+"""
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from benchmarks import generate_package
+from fake_registry import FakeRegistry
+from publishStable import HASH_MANIFEST_KEY
+from publishStable import create_hash_manifest
+from publishStable import pack_local_package
+from publishStable import parse_package_json
+
+PUBLISH_STABLE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "publishStable.py")
+PACKAGES_PATH = "Packages"
+PUBLISHED_VERSION = "0.1.0"
+
+
+def _git(repo, argv):
+    return subprocess.check_output(["git", "-C", repo] + argv)
+
+
+def create_source_repo(path, package_count, changed_count, files_per_package):
+    # type: (str, int, int, int) -> list
+    """
+    Creates a repo with a packages folder holding package_count generated packages. Returns (package name, package
+    folder, changed) for all of them, where the first changed_count packages are the ones that should get a new
+    version when they are compared with the registries
+    """
+    packages = []
+    packages_folder = os.path.join(path, PACKAGES_PATH)
+    for i in range(package_count):
+        package_name = "com.unity.harness{0}".format(i)
+        package_folder = os.path.join(packages_folder, package_name)
+        generate_package(package_folder, package_name, file_count=files_per_package, min_size=256,
+                         max_size=256 * 1024, binary_ratio=0.1, crlf_ratio=0.3, seed=i)
+        packages.append((package_name, package_folder, i < changed_count))
+
+    with open(os.path.join(packages_folder, "manifest.json"), 'w') as f:
+        json.dump({"dependencies": dict((name, PUBLISHED_VERSION) for name, folder, changed in packages)}, f,
+                  indent=4)
+
+    _git(path, ["init", "-q"])
+    _git(path, ["config", "user.name", "Registry Harness"])
+    _git(path, ["config", "user.email", "harness@example.com"])
+    _git(path, ["add", "-A"])
+    _git(path, ["commit", "-q", "-m", "Packages"])
+    return packages
+
+
+def publish_existing_versions(registries, packages):
+    # type: (list, list) -> None
+    # Publishes PUBLISHED_VERSION of every package to every registry. The changed packages get a different
+    # description, so they no longer match what is in the repo
+    for package_name, package_folder, changed in packages:
+        package_file = parse_package_json(package_folder)
+        package_file["version"] = PUBLISHED_VERSION
+        package_file[HASH_MANIFEST_KEY] = create_hash_manifest(package_folder)
+        if changed:
+            package_file["description"] += " (changed since)"
+        tarball = tempfile.TemporaryFile()
+        pack_local_package(package_folder, package_file, tarball)
+        tarball.seek(0)
+        data = tarball.read()
+        tarball.close()
+        for registry in registries:
+            registry.add_package(package_file, data)
+
+
+def run(options, publish_stable_args):
+    # type: (argparse.Namespace, list) -> dict
+    root = tempfile.mkdtemp(prefix="publishHarness")
+    registries = [FakeRegistry(options.latency, options.bandwidth, options.error_rate, seed=i).start()
+                  for i in range(options.registries)]
+    try:
+        source = os.path.join(root, "source")
+        target = os.path.join(root, "target.git")
+        os.makedirs(source)
+        changed_count = int(round(options.packages * options.changed_ratio))
+        packages = create_source_repo(source, options.packages, changed_count, options.files_per_package)
+        publish_existing_versions(registries, packages)
+        subprocess.check_output(["git", "init", "-q", "--bare", target])
+
+        command = [sys.executable, PUBLISH_STABLE, "--publish-registry", registries[0].url, "--source-repo", source,
+                   "--target-repo", target, "--target-branch", "stable", "--packages-path", PACKAGES_PATH,
+                   "--tarball-cache-dir", os.path.join(root, "cache")]
+        for registry in registries:
+            command += ["--view-registries", registry.url]
+        command += publish_stable_args
+
+        # A home folder of its own so no .npmrc of the user is picked up
+        environment = dict(os.environ, HOME=root, USERPROFILE=root)
+        log_path = os.path.join(root, "publishStable.log")
+        start_time = time.time()
+        with open(log_path, 'w') as log:
+            exit_code = subprocess.call(command, stdout=log, stderr=subprocess.STDOUT, env=environment)
+        wall_time = time.time() - start_time
+
+        with open(log_path, 'r') as log:
+            output = log.read()
+        if exit_code != 0 or options.verbose:
+            print output
+
+        published = sorted(name for name, document in registries[0].documents.iteritems()
+                           if document["dist-tags"]["latest"] != PUBLISHED_VERSION)
+        return {
+            "packages": options.packages,
+            "changed_packages": changed_count,
+            "published_packages": len(published),
+            "registries": options.registries,
+            "latency": options.latency,
+            "bandwidth": options.bandwidth,
+            "error_rate": options.error_rate,
+            "exit_code": exit_code,
+            "wall_time": round(wall_time, 3),
+            "requests": [registry.get_request_counts() for registry in registries],
+        }
+    finally:
+        for registry in registries:
+            registry.stop()
+        if not options.keep:
+            shutil.rmtree(root, ignore_errors=True)
+        else:
+            print "Kept the repos and the log in {0}".format(root)
+
+
+def main(): # pragma: no cover
+    argv = sys.argv[1:]
+    publish_stable_args = []
+    if "--" in argv:
+        publish_stable_args = argv[argv.index("--") + 1:]
+        argv = argv[:argv.index("--")]
+
+    parser = argparse.ArgumentParser(description="Runs publishStable against fake registries and times it")
+    parser.add_argument('--packages', type=int, default=10, help="How many packages to publish")
+    parser.add_argument('--changed-ratio', type=float, default=0.5, help="The share of the packages that have "
+                                                                         "changed since the published version")
+    parser.add_argument('--files-per-package', type=int, default=50)
+    parser.add_argument('--registries', type=int, default=2, help="How many view registries to use. The first one is "
+                                                                  "also the publish registry")
+    parser.add_argument('--latency', type=float, default=0.0, help="Seconds every request waits before it is "
+                                                                   "answered")
+    parser.add_argument('--bandwidth', type=int, help="Bytes per second responses are sent with")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="The share of requests that fail with a 500")
+    parser.add_argument('--output', help="Write the result as json to this path")
+    parser.add_argument('--keep', action='store_true', help="Don't remove the repos and the log when done")
+    parser.add_argument('--verbose', action='store_true', help="Print the output of publishStable")
+    options = parser.parse_args(argv)
+
+    result = run(options, publish_stable_args)
+    print "Published {0} of {1} packages using {2} registries in {3:.2f}s (exit code {4})".format(
+        result["published_packages"], result["packages"], result["registries"], result["wall_time"],
+        result["exit_code"])
+    for i, counts in enumerate(result["requests"]):
+        print "  Registry {0}: {1}".format(i, ", ".join("{0}: {1}".format(k, v) for k, v in sorted(counts.items())))
+
+    if options.output:
+        with open(options.output, 'w') as f:
+            json.dump(result, f, indent=4, sort_keys=True, separators=(',', ': '))
+            f.write("\n")
+    sys.exit(result["exit_code"])
+
+
+if __name__ == "__main__": # pragma: no cover
+    main()
@@ -0,0 +1,125 @@
+import subprocess
+import threading
+import time
+
+from tracing import tracer
+
+
+BATCH_CHECK_FORMAT = "--batch-check=%(objectname) %(objecttype) %(objectsize)"
+
+
+class GitRunner(object):
+    """
+    Runs git commands from argument lists, without a shell in between, and records how long every call took. Object
+    queries go to a long running git cat-file --batch-check process, so asking for the hash of many objects doesn't
+    start a new git process for each of them. Call close when done to stop that process.
+    """
+
+    def __init__(self, git="git"):
+        # type: (str) -> None
+        self.git = git
+        self.timings = []
+        self._lock = threading.Lock()
+        self._batch_process = None
+        self._batch_lock = threading.Lock()
+
+    def _record(self, label, start_time):
+        with self._lock:
+            self.timings.append((time.time() - start_time, label))
+
+    def run(self, argv, input=None, check=True):
+        # type: (list, str, bool) -> str
+        """
+        Runs git with the arguments in argv and returns what it wrote to stdout. If check is set a failing command
+        raises a subprocess.CalledProcessError with both stdout and stderr as output
+        """
+        return self._run(argv, input, check)[1]
+
+    def run_code_only(self, argv):
+        # type: (list) -> int
+        # Runs git with the arguments in argv and only returns the exit code, all output is thrown away
+        return self._run(argv, None, False)[0]
+
+    def _run(self, argv, input, check):
+        command = [self.git] + list(argv)
+        label = subprocess.list2cmdline(command)
+        print "  Running: {0}".format(label)
+        start_time = time.time()
+        try:
+            with tracer.span("git {0}".format(argv[0]), "subprocess", command=label) as span:
+                process = subprocess.Popen(command, stdin=subprocess.PIPE if input is not None else None,
+                                           stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+                output, error = process.communicate(input)
+                span.set("exit_code", process.returncode)
+        finally:
+            self._record(label, start_time)
+        if check and process.returncode != 0:
+            raise subprocess.CalledProcessError(process.returncode, label, output + error)
+        return process.returncode, output
+
+    def _get_batch_process(self):
+        if self._batch_process is None or self._batch_process.poll() is not None:
+            self._batch_process = subprocess.Popen([self.git, "cat-file", BATCH_CHECK_FORMAT], stdin=subprocess.PIPE,
+                                                   stdout=subprocess.PIPE)
+        return self._batch_process
+
+    def _query(self, name):
+        # Returns the line git prints for the object
+        if "\n" in name:
+            raise ValueError("Object names can't contain new lines: {0!r}".format(name))
+        process = self._get_batch_process()
+        process.stdin.write(name + "\n")
+        process.stdin.flush()
+        header = process.stdout.readline()
+        if not header:
+            raise subprocess.CalledProcessError(process.poll(), "{0} cat-file --batch-check".format(self.git), "")
+        return header.rstrip("\n")
+
+    def get_object_info(self, name):
+        # type: (str) -> tuple
+        """
+        Returns (hash, type, size) of an object, where name can be anything git rev-parse understands, like
+        branch:path/to/folder. Returns None if there is no such object
+        """
+        start_time = time.time()
+        with tracer.span("git cat-file --batch-check", "subprocess", object=name), self._batch_lock:
+            try:
+                header = self._query(name)
+            finally:
+                self._record("git cat-file --batch-check {0}".format(name), start_time)
+        # Objects that aren't found are reported as the name followed by missing, and the name can contain spaces
+        if header.endswith(" missing") or header.endswith(" ambiguous"):
+            return None
+        object_hash, object_type, size = header.split(" ")
+        return object_hash, object_type, int(size)
+
+    def close(self):
+        # type: () -> None
+        if self._batch_process is not None and self._batch_process.poll() is None:
+            self._batch_process.stdin.close()
+            self._batch_process.wait()
+        self._batch_process = None
+
+    def get_report(self, count):
+        # type: (int) -> str
+        """
+        Returns a summary of the count most expensive git calls, and the time spent per git command since one cheap
+        command run many times can cost more than a single slow one
+        """
+        with self._lock:
+            timings = list(self.timings)
+
+        per_command = {}
+        for duration, label in timings:
+            command = label.split(" ")[1] if " " in label else label
+            total, calls = per_command.get(command, (0.0, 0))
+            per_command[command] = (total + duration, calls + 1)
+
+        lines = ["Ran {0} git commands in {1:.2f}s".format(len(timings), sum(d for d, l in timings))]
+        lines.append("Most expensive git commands:")
+        for duration, label in sorted(timings, reverse=True)[:count]:
+            lines.append("  {0:8.3f}s  {1}".format(duration, label))
+        lines.append("Time per git command:")
+        for command, (total, calls) in sorted(per_command.iteritems(), key=lambda c: c[1], reverse=True)[:count]:
+            lines.append("  {0:8.3f}s  {1} ({2} calls)".format(total, command, calls))
+        return "\n".join(lines)
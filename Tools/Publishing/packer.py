@@ -0,0 +1,82 @@
+import base64
+import gzip
+import hashlib
+import io
+import json
+import os
+import tarfile
+
+# npm gives every entry in a packed tarball this modification time (1985-10-26T08:15:00Z), so we do the same
+NPM_PACK_MTIME = 499162500
+PACKAGE_ROOT = "package"
+
+
+class _HashingWriter(object):
+    """
+    File-like object that hashes everything written to it before passing it on to the real output, if there is one
+    """
+
+    def __init__(self, output=None):
+        self.output = output
+        self.sha1 = hashlib.sha1()
+        self.sha512 = hashlib.sha512()
+        self.size = 0
+
+    def write(self, data):
+        self.sha1.update(data)
+        self.sha512.update(data)
+        self.size += len(data)
+        if self.output is not None:
+            self.output.write(data)
+
+    def flush(self):
+        if self.output is not None:
+            self.output.flush()
+
+
+def serialize_package_json(package_file):
+    # type: (dict) -> str
+    # Sorted keys and fixed separators so the same package.json always gives the same bytes
+    return json.dumps(package_file, indent=4, sort_keys=True, separators=(',', ': ')) + "\n"
+
+
+def _tar_info(relative_path, size):
+    info = tarfile.TarInfo("{0}/{1}".format(PACKAGE_ROOT, relative_path))
+    info.size = size
+    info.mtime = NPM_PACK_MTIME
+    info.mode = 0644
+    info.uid = info.gid = 0
+    info.uname = info.gname = ""
+    return info
+
+
+def pack_package(files, package_file, output=None):
+    # type: (dict, dict, file) -> dict
+    """
+    Packs a package the way npm pack lays it out, with everything under package/. files is a dictionary of the path
+    relative to the package (using / as separator) -> path on disk, and package_file is the package.json to put in the
+    tarball. The entries are sorted and get fixed modification times and owners, so packing the same files always
+    gives a byte for byte identical tarball. The tarball is streamed through gzip into output. If no output is given
+    only the shasum, integrity and size of the tarball are computed. Note that, like the rest of the publishing
+    scripts, this doesn't look at .npmignore or the files field in package.json.
+    """
+    writer = _HashingWriter(output)
+    # No file name and a fixed time in the gzip header, otherwise it would differ between runs
+    gzip_file = gzip.GzipFile(filename="", mode="wb", fileobj=writer, mtime=0)
+    tar = tarfile.open(fileobj=gzip_file, mode="w|", format=tarfile.PAX_FORMAT)
+    try:
+        package_json = serialize_package_json(package_file)
+        tar.addfile(_tar_info("package.json", len(package_json)), io.BytesIO(package_json))
+
+        for relative_path in sorted(files.keys()):
+            if relative_path == "package.json":
+                continue
+            with open(files[relative_path], 'rb') as f:
+                tar.addfile(_tar_info(relative_path, os.fstat(f.fileno()).st_size), f)
+    finally:
+        tar.close()
+        gzip_file.close()
+
+    return {"shasum": writer.sha1.hexdigest(),
+            "integrity": "sha512-{0}".format(base64.b64encode(writer.sha512.digest())),
+            "size": writer.size}
@@ -0,0 +1,137 @@
+"""
+Runs several publishStable jobs one after the other in a single process, for releases that publish from more than one
+repo, branch or packages path. The jobs share the registry connections and the package documents fetched from the
+registries, the tarball cache and the file hashes, so the second job doesn't look up or download what the first one
+already did. Git and the manifests are handled per job just like separate runs would, and a combined timing report is
+printed at the end.
+
+    python publishBatch.py jobs.json --trace batch_trace.json
+
+jobs.json lists the publishStable arguments of every job. common_args are put in front of the arguments of each job:
+
+    {
+        "common_args": ["--publish-registry", "https://...", "--view-registries", "https://..."],
+        "jobs": [
+            {"name": "samples", "args": ["--source-repo", "../Samples", "--target-repo", "...",
+                                         "--target-branch", "stable", "--packages-path", "Samples/Packages"]},
+            ...
+        ]
+    }
+"""
+import argparse
+import json
+import sys
+import time
+import traceback
+
+import publishStable
+from git_runner import GitRunner
+from tracing import tracer
+
+
+def load_jobs(path):
+    # type: (str) -> list
+    """
+    Returns (name, arguments) of the jobs in the file at path, with the arguments parsed by publishStable. Every job is
+    parsed before any of them runs, so a mistake in the last job doesn't show up after the first one has pushed
+    """
+    with open(path, 'r') as f:
+        batch = json.load(f)
+
+    jobs = []
+    for index, job in enumerate(batch["jobs"]):
+        name = job.get("name", "job{0}".format(index + 1))
+        argv = [str(a) for a in batch.get("common_args", []) + job["args"]]
+        job_args = publishStable.parseArgumentList(["publishStable.py"] + argv)
+        # The batch writes one trace and one timing report for all of the jobs
+        job_args.trace = None
+        job_args.git_timings = 0
+        jobs.append((name, job_args))
+    return jobs
+
+
+def run_jobs(jobs, keep_going):
+    # type: (list, bool) -> list
+    """
+    Runs the jobs in order and returns a dictionary per job with its name, status, error, wall time and git timings.
+    Unless keep_going is set the jobs after a failed one are skipped
+    """
+    results = []
+    for name, job_args in jobs:
+        if not keep_going and any(r["status"] == "failed" for r in results):
+            results.append({"name": name, "status": "skipped", "error": None, "wall_time": 0.0, "git_timings": []})
+            continue
+
+        print " Job {0} ".format(name).center(80, '=')
+        publishStable.start_job(job_args)
+        status = "ok"
+        error = None
+        start_time = time.time()
+        try:
+            with tracer.span(name, "job"):
+                publishStable.main()
+        except SystemExit as e:
+            # publishStable exits when there was nothing to push, which fails a run on its own as well
+            if e.code not in [0, None]:
+                status = "failed"
+                error = "Exited with {0}".format(e.code)
+        except Exception as e:
+            traceback.print_exc()
+            status = "failed"
+            error = str(e) or type(e).__name__
+        results.append({"name": name, "status": status, "error": error, "wall_time": time.time() - start_time,
+                        "git_timings": list(publishStable.git_runner.timings)})
+    return results
+
+
+def get_report(results, git_timings):
+    # type: (list, int) -> str
+    lines = ["Ran {0} jobs in {1:.2f}s".format(len(results), sum(r["wall_time"] for r in results))]
+    for result in results:
+        line = "  {0:8.2f}s  {1:7}  {2}".format(result["wall_time"], result["status"], result["name"])
+        if result["error"]:
+            line += ": {0}".format(result["error"])
+        lines.append(line)
+
+    if git_timings > 0:
+        # Labelled with the job, since the same command usually runs in every job
+        runner = GitRunner()
+        for result in results:
+            runner.timings.extend((duration, "{0} [{1}]".format(label, result["name"]))
+                                  for duration, label in result["git_timings"])
+        lines.append(runner.get_report(git_timings))
+
+    policy = publishStable.registry_client.policy
+    if policy.latencies.get_hosts():
+        lines.append("Registry requests per host, over all jobs:")
+        lines.append(policy.get_summary())
+    lines.append("File hashes remembered between jobs: {0}".format(len(publishStable.file_hashes)))
+    return "\n".join(lines)
+
+
+def main(): # pragma: no cover
+    parser = argparse.ArgumentParser(description="Runs several publishStable jobs in one process with shared "
+                                                 "registry connections and caches")
+    parser.add_argument('jobs', help="A json file with the publishStable arguments of every job")
+    parser.add_argument('--keep-going', action='store_true', help="Run the remaining jobs when one fails")
+    parser.add_argument('--git-timings', type=int, default=10, help="How many of the most expensive git commands to "
+                                                                    "list in the report. 0 leaves them out")
+    parser.add_argument('--trace', metavar='PATH', help="Write a Chrome trace of all the jobs to PATH")
+    options = parser.parse_args()
+
+    jobs = load_jobs(options.jobs)
+    if options.trace:
+        tracer.enable()
+    results = run_jobs(jobs, options.keep_going)
+
+    print " Batch ".center(80, '=')
+    print get_report(results, options.git_timings)
+    if options.trace:
+        tracer.write_chrome_trace(options.trace)
+        print "Wrote trace to {0}. Time spent per span:".format(options.trace)
+        print tracer.get_summary()
+    sys.exit(0 if all(r["status"] == "ok" for r in results) else -1)
+
+
+if __name__ == "__main__": # pragma: no cover
+    main()
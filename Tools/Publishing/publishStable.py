@@ -1,17 +1,39 @@
 import glob
+import hashlib
 import os
 import subprocess
 import shutil
+import stat
 import sys
 import argparse
+import errno
+import io
 import json
 import tarfile
 import tempfile
-import urllib2
-from fnmatch import fnmatch
+import threading
+import Queue
 from inspect import currentframe, getframeinfo
+from multiprocessing.pool import ThreadPool
+try:
+    from os import scandir
+except ImportError:
+    try:
+        # The scandir backport for python 2, if it is installed
+        from scandir import scandir
+    except ImportError:
+        scandir = None
 from BumpVersion import BumpVersion
-import time
+from packer import pack_package
+from git_runner import GitRunner
+from registry import RegistryClient
+from registry import TarballHashes
+from repo_walker import RepoPathMatcher
+from repo_walker import scan_repository
+from tarball_cache import TarballCache
+from tracing import traced
+from tracing import tracer
+from workspace import Workspace
 import semver
 
 args = argparse.Namespace()
@@ -19,6 +41,37 @@ source_branch = ""
 local_packages = {}
 modified_packages = {}
 best_view_registry = None
+file_hashes = {}
+registry_client = RegistryClient()
+git_runner = GitRunner()
+tarball_cache = None
+workspace = None
+# The registry each package's published version was read from, since packages are processed at the same time
+package_view_registries = {}
+# Guards the state shared between packages that are processed at the same time
+package_lock = threading.RLock()
+published_package_trees = {}
+package_trees = {}
+
+# Key in package.json where we store a digest of the hashes of all files in the package when publishing. Since it is
+# part of the package metadata it can be read from the registry without downloading the tarball. The registry repeats
+# it for every version in the package document, so it is kept to one digest instead of a hash per file
+HASH_MANIFEST_KEY = "publishHashes"
+HASH_MANIFEST_FORMAT = 3
+
+# Files with a NUL byte in the first BINARY_CHECK_SIZE bytes are treated as binary, like git does. Binary files are
+# always compared byte by byte while for text files CRLF and LF line endings are considered equal
+BINARY_CHECK_SIZE = 8000
+COMPARE_CHUNK_SIZE = 1024 * 1024
+HASH_WORKERS = 8
+
+# The release commits we push to the target repo record the git tree of each package folder and the versions of the local
+# packages it depends on in lines like this, so the next run can tell which packages haven't changed at all without
+# looking at the registry
+PACKAGE_TREE_TRAILER = "Package-Tree:"
+
+# Set in the source repo while --shallow-target-fetch has left the history of the target shallow and without its files
+SHALLOW_TARGET_CONFIG = "publishStable.shallowTarget"
 
 def get_packages_folder():
     # type: () -> str
@@ -53,6 +106,9 @@ def compare_package_files(local_path, installed_path, current_version):
     local_package = parse_package_json(local_path)
     installed_package = parse_package_json(installed_path)
 
+    return compare_package_descriptors(local_package, installed_package, current_version)
+
+def compare_package_descriptors(local_package, installed_package, current_version):
     local_package["version"] = current_version
 
     if not compare_json_keys(local_package, installed_package):
@@ -85,123 +141,483 @@ def compare_package_files(local_path, installed_path, current_version):
     print "    Looks the same"
     return True
 
+def _scan_directory(path):
+    # type: (str) -> [(str, bool, int, float)]
+    # Returns name, is directory, size and modification time of each entry with a single stat per entry at most.
+    # Symlinks aren't followed. Like os.walk, links to directories are left out and other links count as files
+    if scandir is not None:
+        for entry in scandir(path):
+            if entry.is_dir(follow_symlinks=False):
+                yield entry.name, True, 0, 0
+            elif not entry.is_symlink() or not entry.is_dir():
+                entry_stat = entry.stat(follow_symlinks=False)
+                yield entry.name, False, entry_stat.st_size, entry_stat.st_mtime
+        return
+
+    for name in os.listdir(path):
+        entry_path = os.path.join(path, name)
+        entry_stat = os.lstat(entry_path)
+        if not stat.S_ISLNK(entry_stat.st_mode) or not os.path.isdir(entry_path):
+            yield name, stat.S_ISDIR(entry_stat.st_mode), entry_stat.st_size, entry_stat.st_mtime
+
+class PackageFile(object):
+    __slots__ = ["path", "size", "mtime", "_hash"]
+
+    def __init__(self, path, size, mtime):
+        self.path = path
+        self.size = size
+        self.mtime = mtime
+        self._hash = None
+
+    def get_hash(self):
+        # type: () -> str
+        if self._hash is None:
+            # Hashes are kept for the whole run, so the same unchanged file never gets hashed twice. The path is made
+            # absolute since a batch of runs can go through several repos
+            key = (os.path.abspath(self.path), self.size, self.mtime)
+            if key not in file_hashes:
+                file_hashes[key] = _hash_file(self.path)
+            self._hash = file_hashes[key]
+        return self._hash
+
+class PackageSnapshot(object):
+    """
+    The files of a package, collected in one pass over the package folder. node_modules folders are skipped as soon as
+    they are found. The files are kept by their path relative to the package with / as separator, and their hashes are
+    only computed when someone asks for them.
+    """
+
+    def __init__(self, path):
+        # type: (str) -> None
+        self.path = os.path.expanduser(path)
+        self.files = {}
+        if os.path.isdir(self.path):
+            self._scan(self.path, "")
+        if "package.json" not in self.files:
+            raise ValueError("{0} is not a package since it has no package.json".format(path))
+        self.package_file = self.files.pop("package.json")
+
+    def _scan(self, folder, relative_folder):
+        for name, is_dir, size, mtime in _scan_directory(folder):
+            if is_dir:
+                if name != "node_modules":
+                    self._scan(os.path.join(folder, name), relative_folder + name + "/")
+                continue
+            self.files[relative_folder + name] = PackageFile(os.path.join(folder, name), size, mtime)
+
+    def __contains__(self, relative_path):
+        return relative_path in self.files
+
+    def get_relative_paths(self):
+        # type: () -> [str]
+        return sorted(self.files.keys())
+
+    def get_hashes(self):
+        # type: () -> dict
+        # hashlib lets go of the GIL for larger chunks, so hashing on several threads helps for packages with big files
+        files = sorted(self.files.iteritems())
+        hashes = _parallel_map(lambda item: item[1].get_hash(), files, HASH_WORKERS)
+        return dict((relative_path, file_hash) for (relative_path, f), file_hash in zip(files, hashes))
+
 def _get_all_files_in_package(path):
-    files = [os.path.relpath(os.path.join(dp, f), path) for dp, dn, fn in os.walk(os.path.expanduser(path)) for f in fn]
-    files.remove("package.json")
-    files = [f for f in files if "node_modules" not in f]
-    return files
-
-def get_package_from_url(tar_url, file_path): # pragma: no cover
-    max_retries = 10
-    attempt = 0
-    retry_delay = 0.1
-    while attempt < max_retries:
-        attempt += 1
-        try:
-            response = urllib2.urlopen(tar_url)
-            with open(file_path, 'wb') as f:
-                f.write(response.read())
-            return True
-        except:
-            if attempt < max_retries:
-                print "  Got exception while downloading {0}. Retrying in {0}sec. (Attempt {1}/{2}".format(tar_url,
-                                                                                                           retry_delay,
-                                                                                                           attempt,
-                                                                                                           max_retries)
-                time.sleep(retry_delay)
-                retry_delay = retry_delay * 2
-            else:
-                print "  Reached maximum retries"
-                raise
+    return [f.replace("/", os.sep) for f in PackageSnapshot(path).get_relative_paths()]
+
+def _is_binary(data):
+    return "\0" in data[:BINARY_CHECK_SIZE]
+
+def _hash_file(path, chunk_size=COMPARE_CHUNK_SIZE):
+    # Hashes text files with CRLF replaced by LF and binary files as they are, reading the file in chunks
+    file_hash = hashlib.sha1()
+    with open(path, 'rb') as f:
+        start = f.read(BINARY_CHECK_SIZE)
+        if _is_binary(start):
+            chunks = _read_chunks(f, chunk_size, start)
+        else:
+            chunks = _read_normalized_chunks(f, chunk_size, start)
+        for chunk in chunks:
+            file_hash.update(chunk)
+    return file_hash.hexdigest()
+
+@traced()
+def create_hash_manifest(package_folder):
+    # type: (str) -> dict
+    return {"format": HASH_MANIFEST_FORMAT, "digest": get_hashes_digest(PackageSnapshot(package_folder).get_hashes())}
+
+def get_hashes_digest(hashes):
+    # type: (dict) -> str
+    # One sha1 over the relative path and hash of every file, which changes when any file is added, removed or changed
+    digest = hashlib.sha1()
+    for relative_path in sorted(hashes.keys()):
+        digest.update("{0}\0{1}\n".format(relative_path, hashes[relative_path]))
+    return digest.hexdigest()
+
+@traced()
+def get_package_from_url(tar_url, file_path, shasum=None, integrity=None):
+    # type: (str, str, str, str) -> bool
+    # Streams the tarball to file_path and resumes where it stopped if the connection breaks on the way
+    chunk_size = 64 * 1024
+    hashes = TarballHashes(shasum, integrity)
+    with open(file_path, 'wb') as f:
+        def download():
+            headers = {}
+            if f.tell() > 0:
+                headers["Range"] = "bytes={0}-".format(f.tell())
+            response = registry_client.get(tar_url, headers=headers, stream=True)
+            try:
+                # 416 means that we already had all of it when the connection broke
+                if response.status_code == 416 and f.tell() > 0:
+                    return
+                if response.status_code == 200 and f.tell() > 0:
+                    print "  {0} doesn't support resuming downloads. Starting over".format(tar_url)
+                    f.seek(0)
+                    f.truncate()
+                    hashes.reset()
+                elif response.status_code == 206 and \
+                        not response.headers.get("Content-Range", "").startswith("bytes {0}-".format(f.tell())):
+                    resume_from = f.tell()
+                    f.seek(0)
+                    f.truncate()
+                    hashes.reset()
+                    raise Exception("{0} didn't resume from byte {1}".format(tar_url, resume_from))
+                elif response.status_code not in [200, 206]:
+                    response.raise_for_status()
+                    raise Exception("Unexpected status {0} when downloading {1}".format(response.status_code,
+                                                                                       tar_url))
+
+                for chunk in response.iter_content(chunk_size):
+                    f.write(chunk)
+                    hashes.update(chunk)
+            finally:
+                response.close()
+
+        registry_client.policy.retry(tar_url, "downloading {0}".format(tar_url), download)
+
+    hashes.verify(tar_url)
+    return True
+
+def get_tarball_cache(): # pragma: no cover
+    global tarball_cache
+    with package_lock:
+        if tarball_cache is None:
+            tarball_cache = TarballCache(args.tarball_cache_dir, args.tarball_cache_size * 1024 * 1024)
+    return tarball_cache
 
+@traced()
 def download_package_tarball(package_name, current_version): # pragma: no cover
-    print "Downloading {0} from {1} to see if we have changed anything".format(package_name, best_view_registry)
-    tar_url = npm_cmd("view {0}@{1} dist.tarball".format(package_name, current_version), best_view_registry).strip()
-    download_path = tempfile.gettempdir()
-    print "  Getting tarball from {0} and saving to {1}".format(tar_url, download_path)
-    file_path = os.path.join(download_path, "{0}.{1}.tar.gz".format(package_name, current_version))
-    if os.path.exists(file_path):
-        os.remove(file_path)
-
-    if get_package_from_url(tar_url, file_path):
-        return file_path
-
-    raise Exception("Something went wrong with the download of the tarball.")
-
-def get_current_package_extracted(package_name, current_version): # pragma: no cover
-    file_path = download_package_tarball(package_name, current_version)
-    print "  Extracting tarball"
-    download_path = os.path.join(os.path.dirname(file_path), "{0}.{1}".format(package_name, current_version))
-    if os.path.exists(download_path):
-        shutil.rmtree(download_path)
-    tar = tarfile.open(file_path, "r:gz")
-    tar.extractall(download_path)
-    tar.close()
-    # installed_path = os.path.abspath(os.path.join("node_modules", package_name))
-    return  os.path.join(download_path, "package")
+    view_registry = get_view_registry(package_name)
+    dist = registry_client.get_version_metadata(package_name, current_version, view_registry)["dist"]
+    integrity = dist.get("integrity", dist.get("shasum"))
+    cache = get_tarball_cache()
+    tarball = cache.get(package_name, current_version, integrity)
+    if tarball:
+        print "Using cached tarball of {0}@{1} from {2}".format(package_name, current_version, tarball.name)
+        return tarball
+
+    print "Downloading {0}@{1} from {2}".format(package_name, current_version, view_registry)
+    print "  Getting tarball from {0} and saving it in {1}".format(dist["tarball"], cache.cache_dir)
+
+    def download(download_path):
+        get_package_from_url(dist["tarball"], download_path, dist.get("shasum"), dist.get("integrity"))
+
+    return cache.add(package_name, current_version, integrity, download)
+
+def _tarball_member_path(member):
+    # npm puts everything in the tarball under a root folder, which is usually called package/
+    split = member.name.replace("\\", "/").split("/", 1)
+    if len(split) != 2:
+        return None
+    return split[1]
+
+def _content_equals_file(member_file, size, package_file):
+    # type: (file, int, PackageFile) -> bool
+    # Compares a file in the tarball, which is size bytes long, with the local one. Both are read in chunks
+    with open(package_file.path, 'rb') as f:
+        return _streams_equal(member_file, f, size == package_file.size)
+
+@traced()
+def compare_tarball_with_folder(tar_stream, package_folder, stop_at_first_mismatch=False):
+    # type: (file, str, bool) -> (list, list, dict)
+    """
+    Reads the package tarball as a stream and compares each file in it with the same file in package_folder, so
+    nothing is ever extracted to disk. Files are matched by path and size first and then by their content with line
+    endings normalized. Returns the matching files, the mismatching files and the package.json found in the tarball
+    """
+    repo_files = dict(PackageSnapshot(package_folder).files)
+
+    match = []
+    mismatch = []
+    installed_package = None
+    tar = tarfile.open(fileobj=tar_stream, mode="r|gz")
+    try:
+        for member in tar:
+            relative_path = _tarball_member_path(member)
+            if not member.isfile() or relative_path is None or "node_modules" in relative_path.split("/")[:-1]:
+                continue
+
+            if relative_path == "package.json":
+                installed_package = json.load(tar.extractfile(member))
+                continue
 
+            if relative_path not in repo_files:
+                mismatch.append(relative_path)
+            elif _content_equals_file(tar.extractfile(member), member.size, repo_files.pop(relative_path)):
+                match.append(relative_path)
+            else:
+                mismatch.append(relative_path)
+
+            if stop_at_first_mismatch and len(mismatch) > 0:
+                return match, mismatch, installed_package
+    finally:
+        tar.close()
+
+    # Whatever is left was never found in the tarball
+    mismatch.extend(sorted(repo_files.keys()))
+    return match, mismatch, installed_package
+
+def get_published_package_metadata(package_name, current_version):
+    # type: (str, str) -> dict
+    return registry_client.get_version_metadata(package_name, current_version, get_view_registry(package_name))
+
+def get_view_registry(package_name):
+    # type: (str) -> str
+    # The registry the published version of the package was read from, or the best one seen so far for other packages
+    return package_view_registries.get(package_name, best_view_registry)
+
+def get_package_tree(package_folder):
+    # type: (str) -> str
+    path = os.path.normpath(package_folder).replace(os.sep, "/")
+    info = git_runner.get_object_info("{0}:{1}".format(source_branch, path))
+    if info is None:
+        return None
+    return info[0]
+
+def get_local_dependency_versions(package_folder):
+    # type: (str) -> str
+    # The versions the local packages this package depends on are published with, like package2@1.0.0,package3@0.2.1.
+    # The package itself is published again when one of them is bumped, even if its own files haven't changed
+    dependencies = parse_package_json(package_folder).get("dependencies", {})
+    versions = ["{0}@{1}".format(d, local_packages[d]) for d in sorted(dependencies.keys()) if d in local_packages]
+    return ",".join(versions) or "-"
+
+def parse_package_trees(release_message):
+    # type: (str) -> dict
+    trees = {}
+    for line in release_message.splitlines():
+        split = line.strip().split(" ")
+        # Releases made before the dependency versions were recorded can't tell if a dependency was bumped since
+        if len(split) != 5 or split[0] != PACKAGE_TREE_TRAILER:
+            continue
+        trees[split[1]] = (split[2], split[3], split[4])
+    return trees
+
+def format_package_trees():
+    # type: () -> str
+    lines = []
+    for package_name in sorted(package_trees.keys()):
+        if package_name not in local_packages or not package_trees[package_name][0]:
+            continue
+        tree, dependency_versions = package_trees[package_name]
+        lines.append("{0} {1} {2} {3} {4}".format(PACKAGE_TREE_TRAILER, package_name, local_packages[package_name],
+                                                  tree, dependency_versions))
+    return "\n".join(lines)
+
+@traced()
+def read_published_package_trees():
+    global published_package_trees
+    if git_cmd_code_only(["rev-parse", "--verify", "-q", "target/{0}".format(args.target_branch)]) != 0:
+        return
+    published_package_trees = parse_package_trees(git_cmd(["log", "-1", "target/{0}".format(args.target_branch),
+                                                           "--pretty=%B"]))
+
+def is_package_tree_unchanged(package_folder, package_name, current_version):
+    # type: (str, str, str) -> bool
+    package_trees[package_name] = (get_package_tree(package_folder), get_local_dependency_versions(package_folder))
+
+    # Extra dependencies are added to package.json while publishing, so they won't show up in the tree
+    manual_dependencies = args.add_package_as_dependency_to_package or []
+    if any(d.startswith("{0}:".format(package_name)) for d in manual_dependencies):
+        return False
+
+    if package_name not in published_package_trees or not package_trees[package_name][0]:
+        return False
+    published_version, published_tree, published_dependency_versions = published_package_trees[package_name]
+    return published_version == current_version and \
+        (published_tree, published_dependency_versions) == package_trees[package_name]
+
+@traced()
 def is_package_changed(package_folder, package_name, current_version):
-    # type: (str) -> bool
+    # type: (str, str, str) -> bool
+    if args.change_detection == "git-tree":
+        if is_package_tree_unchanged(package_folder, package_name, current_version):
+            print "The git tree of {0} is the same as when {1} was published. Nothing has changed".format(
+                package_folder, current_version)
+            return False
 
-    download_path = get_current_package_extracted(package_name, current_version)
-    print "Comparing files between {0} and {1}".format(download_path, package_folder)
+    if args.change_detection in ["git-tree", "hashes"]:
+        changed = is_package_changed_from_hash_manifest(package_folder, package_name, current_version)
+        if changed is not None:
+            return changed
 
-    package_files = _get_all_files_in_package(download_path)
-    repo_files = _get_all_files_in_package(os.path.abspath(package_folder))
+        # Packing the whole package is more expensive than hashing it, so only do it when the manifest can't decide
+        if is_package_shasum_unchanged(package_folder, package_name, current_version):
+            print "Packing {0} as {1} gives the same shasum as the published package. Nothing has changed".format(
+                package_folder, current_version)
+            return False
+        print "  {0}@{1} has no usable hash manifest. Falling back to comparing with the published tarball".format(
+            package_name, current_version)
+
+    return is_package_changed_from_tarball(package_folder, package_name, current_version)
+
+def is_package_shasum_unchanged(package_folder, package_name, current_version):
+    # type: (str, str, str) -> bool
+    # Packing is reproducible, so if we pack the local package the way it would be published and get the same shasum
+    # as the registry has, nothing can have changed. A different shasum doesn't mean anything though, since the
+    # published package might have been packed by npm
+    published_package = get_published_package_metadata(package_name, current_version)
+    published_shasum = published_package.get("dist", {}).get("shasum")
+    if not published_shasum or HASH_MANIFEST_KEY not in published_package:
+        return False
 
-    mismatching_files = list(set(package_files).symmetric_difference(set(repo_files)))
+    package_file = parse_package_json(package_folder)
+    package_file["version"] = current_version
+    _apply_local_package_dependencies(package_name, package_file)
+    package_file[HASH_MANIFEST_KEY] = create_hash_manifest(package_folder)
+    return pack_local_package(package_folder, package_file)["shasum"] == published_shasum
+
+def is_package_changed_from_hash_manifest(package_folder, package_name, current_version):
+    # type: (str, str, str) -> bool
+    # Returns None if the published package doesn't have a hash manifest we can compare with
+    print "Comparing file hashes between {0}@{1} and {2}".format(package_name, current_version, package_folder)
+    published_package = get_published_package_metadata(package_name, current_version)
+    hash_manifest = published_package.get(HASH_MANIFEST_KEY)
+    if not hash_manifest or hash_manifest.get("format") != HASH_MANIFEST_FORMAT:
+        return None
+
+    if create_hash_manifest(os.path.abspath(package_folder))["digest"] != hash_manifest.get("digest"):
+        print "  The files have changed compared to the currently published package"
+        return True
 
-    if len(mismatching_files) > 0:
-        print "  The number of files don't match. {0} mismatching files".format(len(mismatching_files))
+    print "  Comparing package files locally with published:"
+    if not compare_package_descriptors(parse_package_json(package_folder), published_package, current_version):
+        print "{0}/package.json and {1}@{2} are not the same".format(package_folder, package_name, current_version)
         return True
 
-    match, mismatch, errors = cmp_directories_ignore_line_endings(package_folder, download_path, repo_files)
+    print "Nothing has changed"
+    return False
 
-    if len(mismatch) == 0 and len(errors) == 0:
-        if compare_package_files(package_folder, download_path, current_version):
-            print "Nothing has changed"
-            return False
-        else:
-            print "{0}/package.json and {1}/package.json are not the same".format(package_folder,
-                                                                                  download_path)
-            return True
-    print "  The following files have changed compared to the currently published package:"
-    for m in mismatch:
-        print "    {0}".format(m)
-    return True
-    pass
+def is_package_changed_from_tarball(package_folder, package_name, current_version):
+    # type: (str, str, str) -> bool
+    print "Comparing files between {0}@{1} and {2}".format(package_name, current_version, package_folder)
+    tar_stream = download_package_tarball(package_name, current_version)
+    try:
+        match, mismatch, installed_package = compare_tarball_with_folder(tar_stream, os.path.abspath(package_folder),
+                                                                         stop_at_first_mismatch=True)
+    finally:
+        tar_stream.close()
+
+    if len(mismatch) > 0:
+        print "  The following files have changed compared to the currently published package:"
+        for m in mismatch:
+            print "    {0}".format(m)
+        return True
+
+    print "  Comparing package files locally with published:"
+    if installed_package is None or \
+            not compare_package_descriptors(parse_package_json(package_folder), installed_package, current_version):
+        print "{0}/package.json and {1}@{2} are not the same".format(package_folder, package_name, current_version)
+        return True
 
-def cmp_directories_ignore_line_endings(first, second, common_files):
+    print "Nothing has changed"
+    return False
+
+def cmp_directories_ignore_line_endings(first, second, common_files, max_workers=8):
     match = []
     mismatch = []
     errors = []
 
-    for common in common_files:
-        first_path = os.path.join(first, common)
-        second_path = os.path.join(second, common)
-        if not os.path.exists(first_path):
-            mismatch.append(common)
-            continue
-        if not os.path.exists(second_path):
-            mismatch.append(common)
-            continue
+    def compare(common):
+        try:
+            return cmp_files(os.path.join(first, common), os.path.join(second, common))
+        except (IOError, OSError) as e:
+            if e.errno == errno.ENOENT:
+                return False
+            return e
 
-        if not cmp_files(first_path, second_path):
+    results = _parallel_map(compare, common_files, max_workers)
+    for common, result in zip(common_files, results):
+        if result is True:
+            match.append(common)
+        elif result is False:
             mismatch.append(common)
-            continue
-        match.append(common)
+        else:
+            errors.append(common)
 
     return match, mismatch, errors
 
-def cmp_files(f1, f2):
-    line1 = line2 = ' '
-    with open(f1, 'r') as f1, open(f2, 'r') as f2:
-        while line1 != '' and line2 != '':
-            line1 = f1.readline().rstrip("\n\r")
-            line2 = f2.readline().rstrip("\n\r")
-            if line1 != line2:
-                return False
-    return True
+def _read_chunks(f, chunk_size, start=""):
+    # start is what was already read from f
+    if start:
+        yield start
+    for chunk in iter(lambda: f.read(chunk_size), ""):
+        yield chunk
+
+def _read_normalized_chunks(f, chunk_size, start=""):
+    pending = ""
+    for chunk in _read_chunks(f, chunk_size, start):
+        chunk = pending + chunk
+        pending = ""
+        # A \r at the end of the chunk might be followed by a \n in the next one
+        if chunk.endswith("\r"):
+            pending = "\r"
+            chunk = chunk[:-1]
+        yield chunk.replace("\r\n", "\n")
+    if pending:
+        yield pending
+
+def _next_non_empty(chunks):
+    for chunk in chunks:
+        if chunk:
+            return chunk
+    return None
+
+def _chunks_equal(first_chunks, second_chunks):
+    # The chunks of the two files don't have to line up, so we compare whatever the two buffers have in common
+    first_buffer = second_buffer = ""
+    while True:
+        if not first_buffer:
+            first_buffer = _next_non_empty(first_chunks)
+        if not second_buffer:
+            second_buffer = _next_non_empty(second_chunks)
+        if first_buffer is None or second_buffer is None:
+            return first_buffer is None and second_buffer is None
+
+        common_length = min(len(first_buffer), len(second_buffer))
+        if first_buffer[:common_length] != second_buffer[:common_length]:
+            return False
+        first_buffer = first_buffer[common_length:]
+        second_buffer = second_buffer[common_length:]
+
+def _streams_equal(first, second, same_size, chunk_size=COMPARE_CHUNK_SIZE):
+    # type: (file, file, bool, int) -> bool
+    """
+    Reads two files in chunks from the start to the end, which also works for files in a tarball stream, and compares
+    them where CRLF and LF line endings are considered to be the same. Binary files are only ever compared byte for
+    byte, so they can only be equal if same_size is set
+    """
+    first_start = first.read(BINARY_CHECK_SIZE)
+    second_start = second.read(BINARY_CHECK_SIZE)
+    if _is_binary(first_start) or _is_binary(second_start):
+        return same_size and _chunks_equal(_read_chunks(first, chunk_size, first_start),
+                                           _read_chunks(second, chunk_size, second_start))
+    return _chunks_equal(_read_normalized_chunks(first, chunk_size, first_start),
+                         _read_normalized_chunks(second, chunk_size, second_start))
+
+def cmp_files(f1, f2, chunk_size=COMPARE_CHUNK_SIZE):
+    # type: (str, str, int) -> bool
+    # Compares two files where CRLF and LF line endings are considered to be the same, see _streams_equal
+    with open(f1, 'rb') as first, open(f2, 'rb') as second:
+        same_size = os.fstat(first.fileno()).st_size == os.fstat(second.fileno()).st_size
+        return _streams_equal(first, second, same_size, chunk_size)
 
 def is_preview(version_split):
     if version_split.prerelease:
@@ -248,21 +664,27 @@ def increase_version(version, bumpFlag):
 
     return new_version
 
-def _get_version_in_registry(package_name, registry):
+def _parallel_map(func, items, max_workers):
+    # type: (callable, list, int) -> list
+    # Runs func for every item on a bounded pool of threads and returns the results in the same order as the items
+    items = list(items)
+    if len(items) <= 1 or max_workers <= 1:
+        return [func(item) for item in items]
+
+    pool = ThreadPool(min(max_workers, len(items)))
     try:
-        version = npm_cmd("view {0} version".format(package_name), registry).strip()
+        # Waiting with a timeout keeps the main thread responsive to ctrl+c in python 2
+        return pool.map_async(func, items).get(60 * 60 * 24)
+    finally:
+        pool.terminate()
 
-    # Hack for sinopia which returns 404 when a package doesn't exist, whereas no other registry does
-    except subprocess.CalledProcessError as e:
-        if "is not in the npm registry" in e.output:
-            version = ""
-        else:
-            raise e
-    return version
+def _get_version_in_registry(package_name, registry):
+    return registry_client.get_latest_version(package_name, registry)
 
 def is_local_package(package_name): # pragma: no cover
     return os.path.isdir("{0}/{1}".format(args.packages_path, package_name))
 
+@traced()
 def get_package_version(package_name):
     # type: (str) -> str
 
@@ -274,8 +696,12 @@ def get_package_version(package_name):
     if best_view_registry is not None:
         view_registry_locked = True
     highest_version_trimmed = highest_version.split('.')
-    for registry in args.view_registries:
-        version = _get_version_in_registry(package_name, registry)
+
+    # All registries are queried at the same time, but the versions are looked at in the order the registries were
+    # given so the result is the same as when querying them one by one
+    versions = _parallel_map(lambda r: _get_version_in_registry(package_name, r), args.view_registries,
+                             args.max_concurrent_requests)
+    for registry, version in zip(args.view_registries, versions):
         if not version:
             # Package didn't exist in the registry
             continue
@@ -296,76 +722,202 @@ def get_package_version(package_name):
     #                    "found there ({3}). This needs to be investigated because this shouldn't "
     #                    "happen".format(best_view_registry, package_name, new_registry, highest_version))
 
-    best_view_registry = new_registry
+    with package_lock:
+        best_view_registry = new_registry
+        package_view_registries[package_name] = new_registry
 
     print "{0} was selected as the best registry to read from since it had the highest package version for {1} ({2})" \
-        .format(best_view_registry, package_name, highest_version)
+        .format(new_registry, package_name, highest_version)
 
     return highest_version
 
 
+@traced()
+def pack_local_package(package_folder, package_file, output=None):
+    # type: (str, dict, file) -> dict
+    return pack_package(dict((p, f.path) for p, f in PackageSnapshot(package_folder).files.iteritems()), package_file,
+                        output)
+
+@traced()
 def publish_new_package(package_name, version):
     # type: (str, str) -> None
-    previous_cwd = os.getcwd()
-    try:
+    write_hash_manifest(package_name)
+    package_folder = "{0}/{1}".format(args.packages_path, package_name)
+    package_file = get_workspace().get_package_file(package_name)
+    print "Packing {0} as version {1}".format(package_name, version)
+    tarball = io.BytesIO()
+    pack_local_package(package_folder, package_file, tarball)
+    registry_client.publish(package_file, tarball.getvalue(), args.publish_registry)
+    print "Published {0}@{1} to {2}".format(package_name, version, args.publish_registry)
+
+
+def get_dependency_waves(dependencies):
+    # type: (dict) -> list
+    """
+    dependencies is a dictionary of package name -> names of the packages it depends on. Dependencies that aren't keys
+    of the dictionary are ignored. Returns the packages grouped in waves, where the packages of a wave only depend on
+    packages in earlier waves. Raises an exception if some of the packages depend on each other
+    """
+    waves = []
+    remaining = dict((name, set(deps) & set(dependencies.keys())) for name, deps in dependencies.iteritems())
+    while remaining:
+        wave = sorted(name for name, deps in remaining.iteritems() if not deps)
+        if not wave:
+            raise Exception("The packages {0} depend on each other so they can't be processed in order"
+                            .format(", ".join(sorted(remaining.keys()))))
+        for name in wave:
+            remaining.pop(name)
+        for deps in remaining.itervalues():
+            deps.difference_update(wave)
+        waves.append(wave)
+    return waves
+
+
+class PackageOutput(object):
+    """
+    Stands in for stdout while packages are processed on worker threads. What a package prints is buffered and written
+    in one piece when the package is done, so the output of packages processed at the same time doesn't interleave.
+    Output from threads that aren't processing a package is written right away.
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+    def write(self, text):
+        buffered = getattr(self.local, "buffered", None)
+        if buffered is not None:
+            buffered.append(text)
+            return
+        with self.lock:
+            self.stream.write(text)
+
+    def flush(self):
+        with self.lock:
+            self.stream.flush()
+
+    def run(self, func, *func_args):
+        self.local.buffered = []
+        try:
+            return func(*func_args)
+        finally:
+            output = "".join(self.local.buffered)
+            self.local.buffered = None
+            with self.lock:
+                self.stream.write(output)
+                self.stream.flush()
+
+def schedule_dependency_graph(dependencies, func, max_workers):
+    # type: (dict, callable, int) -> dict
+    """
+    Calls func for every package in dependencies (see get_dependency_waves) with at most max_workers running at the
+    same time. A package is started as soon as all the packages it depends on are done, so one slow package only holds
+    up the packages that depend on it. Returns a dictionary of package name -> error for the packages that failed or
+    were skipped because a dependency failed
+    """
+    get_dependency_waves(dependencies)
+    waiting = dict((name, set(deps) & set(dependencies.keys())) for name, deps in dependencies.iteritems())
+    dependents = dict((name, []) for name in dependencies)
+    for name, deps in waiting.iteritems():
+        for dependency in deps:
+            dependents[dependency].append(name)
+
+    failures = {}
+    failed_dependencies = {}
+    finished = Queue.Queue()
+    running = [0]
+    if not dependencies:
+        return failures
+    pool = ThreadPool(max(1, min(max_workers, len(dependencies))))
+    previous_stdout = sys.stdout
+    output = sys.stdout if isinstance(sys.stdout, PackageOutput) else PackageOutput(sys.stdout)
+    sys.stdout = output
+
+    def run(name):
+        try:
+            with tracer.span(name, "package"):
+                output.run(func, name)
+            finished.put((name, None))
+        except Exception as e:
+            finished.put((name, str(e) or type(e).__name__))
+
+    def start(name):
+        running[0] += 1
+        pool.apply_async(run, (name,))
 
-        os.chdir("{0}/{1}".format(args.packages_path, package_name))
-        print "Packing as version {0}".format(version)
-        package_archive = npm_cmd("pack .", None).strip()
-        print "Publishing {0} to {1}".format(package_archive, args.publish_registry)
-        npm_cmd("publish {0}".format(package_archive), args.publish_registry)
-        os.remove(package_archive)
+    try:
+        for name in sorted(n for n, deps in waiting.iteritems() if not deps):
+            start(name)
+
+        while running[0] > 0:
+            # Waiting with a timeout keeps the main thread responsive to ctrl+c in python 2
+            completed = [finished.get(True, 60 * 60 * 24)]
+            running[0] -= 1
+            while completed:
+                name, error = completed.pop()
+                if error is not None:
+                    failures[name] = error
+                for dependent in sorted(dependents[name]):
+                    waiting[dependent].discard(name)
+                    if error is not None:
+                        failed_dependencies.setdefault(dependent, name)
+                    if waiting[dependent]:
+                        continue
+                    if dependent in failed_dependencies:
+                        completed.append((dependent, "Skipped since the dependency {0} failed".format(
+                            failed_dependencies[dependent])))
+                    else:
+                        start(dependent)
     finally:
-        os.chdir(previous_cwd)
-    pass
+        pool.terminate()
+        sys.stdout = previous_stdout
+    return failures
 
 
-def _modify_manifest_registry():
-    modified = False
-    with open("{0}/manifest.json".format(args.packages_path), 'r') as f:
-        manifest = json.load(f)
+def get_workspace(): # pragma: no cover
+    global workspace
+    with package_lock:
+        if workspace is None:
+            workspace = Workspace(args.packages_path)
+    return workspace
 
-    if 'registry' not in manifest or (manifest['registry'] != args.publish_registry):
-        manifest['registry'] = args.publish_registry
-        modified = True
 
-    if modified:
-        with open("{0}/manifest.json".format(args.packages_path), 'w') as outfile:
-            json.dump(manifest, outfile, indent=4)
+@traced()
+def save_workspace(): # pragma: no cover
+    current_workspace = get_workspace()
+    if args.dry_run:
+        diff = current_workspace.get_diff()
+        print "The following changes will be made to the manifest and package files:"
+        print diff if diff else "  None"
+    for path in current_workspace.save():
+        print "Wrote {0}".format(os.path.join(args.packages_path, path))
 
 
-def _modify_manifest_for_package(package_name, version):
-    with open("{0}/manifest.json".format(args.packages_path), 'r') as f:
-        manifest = json.load(f)
+def write_hash_manifest(package_name):
+    # type: (str) -> None
+    package_folder = "{0}/{1}".format(args.packages_path, package_name)
+    get_workspace().get_package_file(package_name)[HASH_MANIFEST_KEY] = create_hash_manifest(package_folder)
 
-    dependencies = {}
-    if "dependencies" in manifest:
-        dependencies = manifest["dependencies"]
-    modified = False
-    for key, value in dependencies.iteritems():
-        if key != package_name:
-            continue
-        modified = True
-        manifest["dependencies"][package_name] = version
 
-    if not modified and args.add_packages_to_manifest and package_name in args.add_packages_to_manifest:
-        print "Adding {0} to the manifest.json".format(package_name)
-        manifest["dependencies"][package_name] = version
-        modified = True
+def _modify_manifest_registry():
+    get_workspace().get_manifest()['registry'] = args.publish_registry
 
-    if modified:
-        with open("{0}/manifest.json".format(args.packages_path), 'w') as outfile:
-            json.dump(manifest, outfile, indent=4)
 
+def _modify_manifest_for_package(package_name, version):
+    manifest = get_workspace().get_manifest()
+    if package_name in manifest.get("dependencies", {}):
+        manifest["dependencies"][package_name] = version
+    elif args.add_packages_to_manifest and package_name in args.add_packages_to_manifest:
+        print "Adding {0} to the manifest.json".format(package_name)
+        manifest.setdefault("dependencies", {})[package_name] = version
 
-def _modify_package_file_dependencies(package_name):
-    """
-    We check all modified packages and see if the current package has a dependency to it. If so then we update the
-    version
-    """
-    with open("{0}/{1}/package.json".format(args.packages_path, package_name), 'r') as f:
-        package_file = json.load(f)
-    modified = False
+
+def _apply_local_package_dependencies(package_name, package_file):
+    # type: (str, dict) -> bool
     dependencies = {}
     if "dependencies" in package_file:
         dependencies = package_file["dependencies"]
@@ -375,23 +927,25 @@ def _modify_package_file_dependencies(package_name):
                            for dep in args.add_package_as_dependency_to_package
                            if dep.startswith("{0}:".format(package_name))]
 
-    for modified_package_name, modified_version in local_packages.iteritems():
+    modified = False
+    # A copy, since other packages might be adding their versions while this one is processed
+    for modified_package_name, modified_version in local_packages.items():
         if modified_package_name in dependencies or modified_package_name in manual_dependencies:
-            package_file["dependencies"][modified_package_name] = modified_version
+            package_file.setdefault("dependencies", {})[modified_package_name] = modified_version
             modified = True
+    return modified
 
-    if modified:
-        with open("{0}/{1}/package.json".format(args.packages_path, package_name), 'w') as outfile:
-            json.dump(package_file, outfile, indent=4)
+
+def _modify_package_file_dependencies(package_name):
+    """
+    We check all modified packages and see if the current package has a dependency to it. If so then we update the
+    version
+    """
+    _apply_local_package_dependencies(package_name, get_workspace().get_package_file(package_name))
 
 
 def _modify_package_version(package_name, version):
-    previous_cwd = os.getcwd()
-    try:
-        os.chdir("{0}/{1}".format(args.packages_path, package_name))
-        npm_cmd("--no-git-tag-version version {0}".format(version), None).strip()
-    finally:
-        os.chdir(previous_cwd)
+    get_workspace().get_package_file(package_name)["version"] = version
 
 
 def modify_json(package_name, version):
@@ -402,48 +956,70 @@ def modify_json(package_name, version):
     _modify_package_file_dependencies(package_name)
 
 
+def get_project_manifests():
+    # type: () -> [str]
+    # The Packages/manifest.json of every unity project in the repo. Asking git is a lot faster than walking the whole
+    # repo, and also finds projects that haven't been committed yet
+    output = git_cmd(["ls-files", "-z", "--cached", "--others", "--exclude-standard", "--", "*Packages/manifest.json"])
+    manifests = set()
+    for path in output.split("\0"):
+        if not path:
+            continue
+        path = os.path.normpath(path)
+        if os.path.basename(os.path.dirname(path)) == "Packages" and os.path.isfile(path):
+            manifests.add(path)
+    return sorted(manifests)
+
+
+@traced()
 def scatter_manifest():
     # Since we might have multiple unity projects in the same repo that should have the same manifest, we find them
     # all and update them
     shared_manifest = os.path.normpath(os.path.join(args.packages_path, "manifest.json"))
-    for root, d, f in os.walk('.'):
-        for path in f:
-            p = os.path.join(root, path)
-            if fnmatch(p, "**/Packages/manifest.json") and os.path.normpath(args.packages_path) not in p:
-                print "Replacing manifest in {0} with {1}".format(p, shared_manifest)
-                shutil.copy(shared_manifest, p)
-                git_cmd("add {0}".format(p))
-    pass
-
-
-def strip_unwanted():
-    if not args.strip_from_commit:
-        return
-    for path in args.strip_from_commit:
-        for p in glob.glob(path):
-            if os.path.isdir(p):
-                print "Tried to remove folder {0}".format(p)
-                shutil.rmtree(p)
-            elif os.path.isfile(p):
-                print "Tried to remove file {0}".format(p)
-                os.remove(p)
-
-
-def sanity_check_files():
-    hidden_paths = []
-    for root, d, f in os.walk('.'):
-        for path in d:
-            p = os.path.join(root, path)
-            if path.startswith(".") and ".git" != path:
-                if args.whitelist_hidden_paths and path in args.whitelist_hidden_paths:
-                    continue
-                hidden_paths.append(p)
-        for path in f:
-            p = os.path.join(root, path)
-            if path.startswith("."):
-                if args.whitelist_hidden_paths and path in args.whitelist_hidden_paths:
+    with open(shared_manifest, 'rb') as f:
+        shared_content = f.read()
+
+    replaced = []
+    for p in get_project_manifests():
+        if p == shared_manifest:
+            continue
+        if os.path.getsize(p) == len(shared_content):
+            with open(p, 'rb') as f:
+                if f.read() == shared_content:
                     continue
-                hidden_paths.append(p)
+        print "Replacing manifest in {0} with {1}".format(p, shared_manifest)
+        with open(p, 'wb') as f:
+            f.write(shared_content)
+        replaced.append(p)
+
+    if replaced:
+        git_cmd(["add", "--"] + replaced)
+
+
+@traced()
+def strip_unwanted_and_check_files():
+    # type: () -> None
+    """
+    Removes everything matching --strip-from-commit from the index and the working tree and fails the run if there
+    are hidden paths left that aren't whitelisted. Both are found in the same pass over the files in the index, see
+    scan_repository
+    """
+    paths = [p for p in git_cmd(["ls-files", "-z"]).split("\0") if p]
+    matcher = RepoPathMatcher(args.strip_from_commit, args.whitelist_hidden_paths)
+    to_strip, hidden_paths = scan_repository(matcher, ".", paths)
+
+    if to_strip:
+        stripped_files = [p for p in paths if any(p == s or p.startswith(s + "/") for s in to_strip)]
+        git_cmd_with_input(["update-index", "--force-remove", "-z", "--stdin"],
+                           "".join(p + "\0" for p in stripped_files))
+
+    for p in to_strip:
+        if os.path.isdir(p):
+            print "Tried to remove folder {0}".format(p)
+            shutil.rmtree(p)
+        elif os.path.isfile(p):
+            print "Tried to remove file {0}".format(p)
+            os.remove(p)
 
     if len(hidden_paths) > 0:
         print "There are hidden paths in the repo that aren't white listed. Failing run. Please use " \
@@ -453,123 +1029,223 @@ def sanity_check_files():
         raise Exception("Unwanted file found in repo")
 
 
+@traced()
 def squash_commits():
     # We don't actually squash it since we just want whatever is in the source branch right now and add that as a new
-    # commit to the target branch. So we delete everything in our publishing branch and then checkout everything
-    # from the source branch and commit anything that changed.
-    removed = []
-    for d in os.listdir("."):
-        if ".git" in d:
-            continue
-        print "Deleting {0}".format(d)
-        if os.path.isdir(d):
-            shutil.rmtree(d)
-        else:
-            os.remove(d)
-            removed.append(d)
-
-    for d in removed:
-        git_cmd("rm {0}".format(d))
-
-    git_cmd("checkout {0} -- .".format(source_branch))
-
-    strip_unwanted()
+    # commit to the target branch. read-tree switches the index and the working tree to the tree of the source branch,
+    # only touching the files that differ, and the commit is then created straight from the index.
+    git_cmd(["read-tree", "--reset", "-u", source_branch])
+    # Anything that isn't in the source branch, like build output left from earlier runs, shouldn't end up in packages
+    git_cmd(["clean", "-ffdxq"])
 
-    sanity_check_files()
+    strip_unwanted_and_check_files()
 
-    git_cmd("add -A")
-
-    git_cmd("commit -m \"Current squash\" --allow-empty")
-    pass
+    parents = []
+    if git_cmd_code_only(["rev-parse", "--verify", "-q", "HEAD"]) == 0:
+        parents.append(git_cmd(["rev-parse", "HEAD"]).strip())
+    commit_index("Current squash", parents)
 
 
+@traced()
 def create_commit():
     # type: () -> bool
 
     print "Committing changes since merge"
-    exists = git_cmd_code_only("fetch target {0}".format(args.target_branch))
+    if args.shallow_target_fetch:
+        exists = fetch_target_branch(["--depth", "1"])
+    else:
+        exists = git_cmd_code_only(["fetch", "target", args.target_branch]) == 0
 
-    if exists != 0:
-        git_cmd("commit -m \"Release 1\" --amend")
+    if not exists:
+        commit_release("Release 1")
         return True
 
-    previous_releases = git_cmd("log target/{0} --pretty=%B".format(args.target_branch)).strip().split('\n')
-    next_release = ""
-    for previous_release in previous_releases:
-        if not previous_release.startswith("Release "):
+    commit_release(get_next_release())
+
+    # Checking if the last two commits in this branch have the same tree. If so nothing changed and we shouldn't push
+    if not is_head_tree_changed():
+        print "Nothing has changed at all. Won't push commit"
+        return False
+    return True
+
+
+def parse_next_release(messages):
+    # type: (str) -> str
+    # messages is the output of git log --pretty=%B, newest first. Returns the release after the newest one in it
+    for line in messages.strip().split('\n'):
+        if not line.startswith("Release "):
             continue
-        split = previous_release.split(" ")
+        split = line.split(" ")
         if len(split) != 2:
             continue
         if not split[1].isdigit():
             continue
+        return "Release {0}".format(int(split[1]) + 1)
+    return None
 
-        next_release = "Release {0}".format(int(split[1]) + 1)
-        break
-
-    git_cmd("commit -m \"{0}\" --amend --allow-empty".format(next_release))
 
-    # Checking if the last two commits in this branch has any changes between them. If no then we shouldn't push
-    anything_changed = git_cmd("diff @~..@")
-    if not anything_changed.strip():
-        print "Nothing has changed at all. Won't push commit"
-        return False
-    return True
+def get_next_release():
+    # type: () -> str
+    """
+    Looks for the newest release in the last --release-lookup-depth commits of the target branch. That is normally its
+    newest commit, so with --shallow-target-fetch only that commit is there at first and more history is only fetched
+    when it isn't a release. Without it the whole branch is fetched anyway, so all of it is searched if needed
+    """
+    log = ["log", "-n", str(args.release_lookup_depth), "target/{0}".format(args.target_branch), "--pretty=%B"]
+    next_release = parse_next_release(git_cmd(log))
+    if next_release is None and args.shallow_target_fetch and args.release_lookup_depth > 1:
+        print "The newest commit of target/{0} isn't a release. Fetching up to {1} commits to find one".format(
+            args.target_branch, args.release_lookup_depth)
+        fetch_target_branch(["--deepen", str(args.release_lookup_depth - 1)])
+        next_release = parse_next_release(git_cmd(log))
+    elif next_release is None and not args.shallow_target_fetch:
+        print "No release in the last {0} commits of target/{1}. Searching all of it".format(
+            args.release_lookup_depth, args.target_branch)
+        next_release = parse_next_release(git_cmd(["log", "target/{0}".format(args.target_branch), "--pretty=%B"]))
+    if next_release is None and args.shallow_target_fetch:
+        raise Exception("No release found in the last {0} commits of target/{1}. Use a higher --release-lookup-depth "
+                        "if it is further back".format(args.release_lookup_depth, args.target_branch))
+    if next_release is None:
+        raise Exception("No release found in target/{0}".format(args.target_branch))
+    return next_release
+
+
+def fetch_target_branch(options):
+    # type: (list) -> bool
+    """
+    Fetches only the target branch into target/<branch> for --shallow-target-fetch, without the blobs since nothing
+    reads the files of the target, and returns whether it exists. options says how much history to fetch. Servers that
+    don't support filters send the blobs anyway
+    """
+    refspec = "+refs/heads/{0}:refs/remotes/target/{0}".format(args.target_branch)
+    exists = git_cmd_code_only(["fetch"] + options + ["--filter=blob:none", "target", refspec]) == 0
+    # git remembers the filter for the remote and would leave out the blobs in every later fetch from it as well.
+    # remote.target.promisor has to stay while blobs are missing, complete_target_history removes it again
+    git_cmd_code_only(["config", "--unset", "remote.target.partialclonefilter"])
+    # Marks the history of the target as ours to complete, a shallow clone of the source repo is none of our business
+    git_cmd(["config", SHALLOW_TARGET_CONFIG, "true"])
+    return exists
+
+
+def complete_target_history():
+    # type: () -> None
+    """
+    Undoes what --shallow-target-fetch left in the repo in an earlier run. The history it didn't fetch is fetched, since
+    the release lookup and checkout of the target need it, and so are the blobs it left out, all at once instead of
+    one at a time while checking out. Repos that --shallow-target-fetch never touched are left alone
+    """
+    if git_cmd_code_only(["config", "--get", SHALLOW_TARGET_CONFIG]) != 0:
+        return
+    if git_cmd(["rev-parse", "--is-shallow-repository"]).strip() == "true":
+        git_cmd(["fetch", "--unshallow", "target"])
+    if git_cmd_code_only(["config", "--get", "remote.target.promisor"]) == 0:
+        git_cmd_code_only(["config", "--unset", "remote.target.partialclonefilter"])
+        git_cmd(["fetch", "--refetch", "target"])
+        git_cmd(["config", "--unset", "remote.target.promisor"])
+    git_cmd(["config", "--unset", SHALLOW_TARGET_CONFIG])
 
 
-def git_cmd(cmd):
-    formatted_cmd = "git {0}".format(cmd)
-    print "  Running: {0}".format(formatted_cmd)
-    return subprocess.check_output(formatted_cmd, shell=True, stderr=subprocess.STDOUT)
+def is_head_tree_changed():
+    # type: () -> bool
+    previous_tree, tree = git_cmd(["rev-parse", "HEAD~1^{tree}", "HEAD^{tree}"]).split()
+    return previous_tree != tree
+
+
+def commit_release(release):
+    # type: (str) -> None
+    # Replaces the squash commit with the release commit, like git commit --amend does
+    if not release.strip():
+        raise Exception("Aborting commit due to empty release name")
+    message = release
+    package_trees_message = format_package_trees()
+    if package_trees_message:
+        message += "\n\n" + package_trees_message
+
+    commit_index(message, git_cmd(["rev-parse", "HEAD^@"]).split())
+
+
+def commit_index(message, parents):
+    # type: (str, list) -> str
+    # Commits whatever is in the index with the given parents and moves the current branch to the new commit. Unlike
+    # git commit, commit-tree accepts an empty message, so that is checked here
+    if not message.strip():
+        raise Exception("Aborting commit due to empty commit message")
+    tree = git_cmd(["write-tree"]).strip()
+    handle, message_path = tempfile.mkstemp(suffix=".txt")
+    try:
+        with os.fdopen(handle, 'w') as f:
+            f.write(message)
+        parent_args = []
+        for parent in parents:
+            parent_args += ["-p", parent]
+        commit = git_cmd(["commit-tree", tree] + parent_args + ["-F", message_path]).strip()
+    finally:
+        os.remove(message_path)
+    git_cmd(["update-ref", "HEAD", commit])
+    return commit
 
 
-def git_cmd_code_only(cmd):
-    formatted_cmd = "git {0}".format(cmd)
-    print "  Running: {0}".format(formatted_cmd)
-    with open(os.devnull, 'w') as devnull:
-        return subprocess.call(formatted_cmd, shell=True, stderr=devnull, stdout=devnull)
+def git_cmd(argv):
+    # type: (list) -> str
+    return git_runner.run(argv)
 
 
-def npm_cmd(cmd, registry):
-    registry_cmd = ''
-    if registry:
-        registry_cmd = "--registry {0}".format(registry)
+def git_cmd_with_input(argv, data):
+    # type: (list, str) -> str
+    return git_runner.run(argv, input=data)
 
-    formatted_cmd = 'npm {0} {1}'.format(cmd, registry_cmd)
 
-    print "  Running: {0}".format(formatted_cmd)
-    return subprocess.check_output(formatted_cmd, shell=True, stderr=subprocess.STDOUT)
+def git_cmd_code_only(argv):
+    # type: (list) -> int
+    return git_runner.run_code_only(argv)
 
 
+@traced()
 def add_destination_repo():
     print "Adding {0} as remote 'target' to repo".format(args.target_repo)
-    remote = git_cmd("remote")
+    remote = git_cmd(["remote"])
 
     if "target" in remote:
-        remote_url = git_cmd("config --get remote.target.url").strip()
+        remote_url = git_cmd(["config", "--get", "remote.target.url"]).strip()
         if remote_url != args.target_repo:
-            git_cmd("remote rm target")
+            git_cmd(["remote", "rm", "target"])
             remote = ""
 
     if "target" not in remote:
-        git_cmd("remote add target {0}".format(args.target_repo))
+        git_cmd(["remote", "add", "target", args.target_repo])
 
-    git_cmd("fetch target")
-    branches = git_cmd("ls-remote --heads target")
-    local_branches = git_cmd("branch")
+    if args.shallow_target_fetch:
+        # Only the branch we push to is of interest, and only its newest commit
+        branches = git_cmd(["ls-remote", "--heads", "target", "refs/heads/{0}".format(args.target_branch)])
+        if branches and not fetch_target_branch(["--depth", "1"]):
+            raise Exception("Could not fetch {0} from {1}".format(args.target_branch, args.target_repo))
+    else:
+        complete_target_history()
+        git_cmd(["fetch", "target"])
+        branches = git_cmd(["ls-remote", "--heads", "target"])
+    local_branches = git_cmd(["branch"])
 
     # Lets just always remove it so we stay clean
     if "publishStable-temp" in local_branches:
-        git_cmd("checkout {0}".format(source_branch))
-        git_cmd("branch -D publishStable-temp")
-
-    if "refs/heads/{0}".format(args.target_branch) in branches:
-        git_cmd("checkout -b publishStable-temp --track target/{0}".format(args.target_branch))
+        git_cmd(["checkout", source_branch])
+        git_cmd(["branch", "-D", "publishStable-temp"])
+
+    if "refs/heads/{0}".format(args.target_branch) in branches and args.shallow_target_fetch:
+        # Checking out the target would download all of its files, only for the squash to replace them with the ones
+        # of the source branch. Pointing HEAD at the new branch leaves the checkout of the source branch as it is
+        git_cmd(["update-ref", "refs/heads/publishStable-temp", "target/{0}".format(args.target_branch)])
+        git_cmd(["symbolic-ref", "HEAD", "refs/heads/publishStable-temp"])
+    elif "refs/heads/{0}".format(args.target_branch) in branches:
+        git_cmd(["checkout", "-b", "publishStable-temp", "--track", "target/{0}".format(args.target_branch)])
     else:
-        git_cmd("checkout --orphan publishStable-temp")
+        git_cmd(["checkout", "--orphan", "publishStable-temp"])
 
 
-def process_package(package_path, package_name, root_clone):
+def process_package(package_path, package_name):
+    """
+    Decides which version of the package goes into the project and whether it needs to be published. Packages can be
+    processed at the same time, but only once all the local packages they depend on have been processed
+    """
     current_package_version = get_package_version(package_name)
     changed = is_package_changed(package_path, package_name, current_package_version)
     if changed is True:
@@ -584,37 +1260,74 @@ def process_package(package_path, package_name, root_clone):
                   "Failing run ".format(package_name)
             raise Exception("Tried to publish modified packages when --only-publish-existing-packages was set")
         new_package_version = increase_version(current_package_version, BumpVersion.PREVIEW)
-        local_packages[package_name] = new_package_version
-        modified_packages[package_name] = new_package_version
-        modify_json(package_name, new_package_version)
+        with package_lock:
+            local_packages[package_name] = new_package_version
+            modified_packages[package_name] = new_package_version
+            modify_json(package_name, new_package_version)
     else:
         print "No change detected in the repo. The current version of {0} ({1}) will be used in the project" \
             .format(package_name, current_package_version)
-        local_packages[package_name] = current_package_version
         published_version = _get_version_in_registry(package_name, args.publish_registry)
-        if published_version != current_package_version:
-            print "The version of this package does not exist on the publish registry, so will publish anyway with " \
-                  "the current version "
-            modified_packages[package_name] = current_package_version
-        modify_json(package_name, current_package_version)
+        with package_lock:
+            local_packages[package_name] = current_package_version
+            if published_version != current_package_version:
+                print "The version of this package does not exist on the publish registry, so will publish anyway " \
+                      "with the current version "
+                modified_packages[package_name] = current_package_version
+            modify_json(package_name, current_package_version)
 
-    os.chdir(root_clone)
     print ''.ljust(80, '#')
 
+def get_package_graph(package_paths):
+    # type: (list) -> dict
+    """
+    Returns a dictionary of package name -> names of the local packages it has to be processed after. Those are the
+    local packages in its package.json, the ones added with --add-package-as-dependency-to-package and, for packages
+    in --add-packages-to-manifest, every package that isn't added to the manifest
+    """
+    package_names = [os.path.basename(os.path.normpath(p)) for p in package_paths]
+    added_to_manifest = [n for n in package_names if n in (args.add_packages_to_manifest or [])]
+    graph = {}
+    for package_name in package_names:
+        dependencies = set(get_local_dependencies(package_name, package_names))
+        for dependency in args.add_package_as_dependency_to_package:
+            if dependency.startswith("{0}:".format(package_name)) and dependency.split(":")[1] in package_names:
+                dependencies.add(dependency.split(":")[1])
+        if package_name in added_to_manifest:
+            dependencies.update(n for n in package_names if n not in added_to_manifest)
+        dependencies.discard(package_name)
+        graph[package_name] = sorted(dependencies)
+    return graph
+
+def get_local_dependencies(package_name, package_names):
+    # type: (str, list) -> list
+    package_file = get_workspace().get_package_file(package_name)
+    return [d for d in package_file.get("dependencies", {}) if d in package_names]
+
+@traced()
 def publish_modified_packages(): # pragma: no cover
-    for package_name, version in modified_packages.iteritems():
-        if not args.dry_run:
-            publish_new_package(package_name, version)
-
+    if args.dry_run or not modified_packages:
+        return
+    dependencies = dict((package_name, get_local_dependencies(package_name, modified_packages.keys()))
+                        for package_name in modified_packages)
+    failures = schedule_dependency_graph(dependencies, lambda p: publish_new_package(p, modified_packages[p]),
+                                         args.publish_concurrency)
+    if failures:
+        print "Publishing failed for the following packages:"
+        for package_name in sorted(failures.keys()):
+            print "  {0}@{1}: {2}".format(package_name, modified_packages[package_name], failures[package_name])
+        raise Exception("Failed to publish {0} of {1} packages".format(len(failures), len(modified_packages)))
+
+@traced()
 def remove_package_folders(): # pragma: no cover
     if args.dry_run:
         return
     for package_name, version in local_packages.iteritems():
         shutil.rmtree("./{0}/{1}".format(args.packages_path, package_name))
+        get_workspace().forget_package(package_name)
 
 def get_version_from_manifest(package_name): # pragma: no cover
-    with open("{0}/manifest.json".format(args.packages_path), 'r') as f:
-        manifest = json.load(f)
+    manifest = get_workspace().get_manifest()
 
     if package_name not in manifest["dependencies"]:
         raise Exception(
@@ -623,16 +1336,11 @@ def get_version_from_manifest(package_name): # pragma: no cover
     return manifest["dependencies"][package_name]
 
 def get_registry_from_manifest(): # pragma: no cover
-    with open("{0}/manifest.json".format(args.packages_path), 'r') as f:
-        manifest = json.load(f)
-
-    return manifest["registry"]
+    return get_workspace().get_manifest()["registry"]
 
 def get_filtered_dependencies_from_view_registry(package_name, package_version):
     dependencies = {}
-    result_string = npm_cmd("view {0}@{1} dependencies".format(package_name, package_version),
-                            best_view_registry).strip().replace("'", '"')
-    j = json.loads(result_string)
+    j = registry_client.get_dependencies(package_name, package_version, best_view_registry)
     tracked_dependencies = [n.split(":")[1] for n in args.add_package_as_dependency_to_package]
     for key, value in j.iteritems():
         if key not in tracked_dependencies:
@@ -640,63 +1348,126 @@ def get_filtered_dependencies_from_view_registry(package_name, package_version):
         dependencies[key] = value
     return dependencies
 
+@traced()
+def resolve_republish_dependencies(packages):
+    # type: (dict) -> dict
+    """
+    packages is a dictionary of package name -> version to start from. Returns those packages together with the
+    dependencies tracked by --add-package-as-dependency-to-package that they need, following the dependencies of the
+    dependencies as well. The metadata of all the packages found in one step is fetched at the same time, and every
+    package@version is only looked at once. The versions in packages always win, otherwise the first version found
+    is used
+    """
+    resolved = dict(packages)
+    visited = set()
+    pending = sorted(packages.iteritems())
+    while pending:
+        visited.update(pending)
+        found = _parallel_map(lambda p: get_filtered_dependencies_from_view_registry(*p), pending,
+                              args.max_concurrent_requests)
+        next_pending = []
+        for dependencies in found:
+            for name, version in sorted(dependencies.iteritems()):
+                version = resolved.setdefault(name, version)
+                if (name, version) not in visited and (name, version) not in next_pending:
+                    next_pending.append((name, version))
+        pending = next_pending
+    return resolved
+
+@traced()
+def get_packages_missing_in_registry(packages, registry):
+    # type: (dict, str) -> list
+    # The names of the packages whose version doesn't exist in the registry, asking for all of them at the same time
+    names = sorted(packages.keys())
+    exists = _parallel_map(lambda n: registry_client.has_version(n, packages[n], registry), names,
+                           args.max_concurrent_requests)
+    return [name for name, found in zip(names, exists) if not found]
+
+@traced()
+def mirror_packages(packages, source_registry):
+    # type: (dict, str) -> dict
+    """
+    Publishes the package versions in packages from source_registry to the publish registry, several at the same time.
+    The tarballs are streamed from one registry to the other without being saved anywhere. Versions the publish
+    registry already has are skipped. Returns a dictionary of package name -> error for the ones that failed
+    """
+    def mirror(package_name):
+        version = packages[package_name]
+        if registry_client.mirror(package_name, version, source_registry, args.publish_registry):
+            print "Mirrored {0}@{1} from {2}".format(package_name, version, source_registry)
+        else:
+            print "{0}@{1} is already in {2}".format(package_name, version, args.publish_registry)
+
+    return schedule_dependency_graph(dict((name, []) for name in packages), mirror, args.publish_concurrency)
+
+def start_job(job_args):
+    # type: (argparse.Namespace) -> None
+    """
+    Forgets everything about the previous run and makes job_args the arguments of the next one, so several runs can be
+    made in one process (see publishBatch.py). The registry client with its connections and package documents, the
+    tarball cache and the file hashes don't depend on the repo and are kept
+    """
+    global source_branch, local_packages, modified_packages, best_view_registry, git_runner, tarball_cache, \
+        workspace, package_view_registries, published_package_trees, package_trees
+    # Updated in place, since other modules hold on to args
+    args.__dict__.clear()
+    args.__dict__.update(vars(job_args))
+
+    source_branch = ""
+    local_packages = {}
+    modified_packages = {}
+    best_view_registry = None
+    package_view_registries = {}
+    published_package_trees = {}
+    package_trees = {}
+    workspace = None
+    git_runner = GitRunner()
+    if tarball_cache is not None and (
+            tarball_cache.cache_dir != os.path.abspath(os.path.expanduser(args.tarball_cache_dir)) or
+            tarball_cache.max_size != args.tarball_cache_size * 1024 * 1024):
+        tarball_cache = None
+
 def main():     # pragma: no cover
     global source_branch
     root_dir = os.getcwd()
-    repo_dir = args.source_repo
+    repo_dir = os.path.abspath(args.source_repo)
+    if args.trace:
+        tracer.enable()
     os.chdir(repo_dir)
+    # The npm commands used to run in the source repo or its package folders, so its .npmrc counts as the project one
+    registry_client.load_npm_config(repo_dir)
 
     # Just a nice sanity check so we refuse to run if this script has modifications in the repo we are running from.
     # While changing this script you will need to setup another local repo to run it against.
-    output = git_cmd("ls-files -m")
+    output = git_cmd(["ls-files", "-m"])
     if os.path.basename(__file__) in output:
         print "You are not allowed to run this script against the repo this script resides in if the file has " \
               "modifications, since these would be lost. "
         print "Please use a secondary repo locally while testing this out."
         sys.exit(-1)
     try:
-        source_branch = git_cmd("rev-parse --abbrev-ref HEAD").strip()
+        source_branch = git_cmd(["rev-parse", "--abbrev-ref", "HEAD"]).strip()
         print "Will now start creating packages for publish from {0} to {1}:{2}" \
             .format(source_branch, args.target_repo, args.target_branch)
-        root_clone = os.getcwd()
         add_destination_repo()
+        read_published_package_trees()
 
         squash_commits()
         packages_folder = args.packages_path
         packages = get_list_of_packages(packages_folder)
         if len(packages) > 0:
-            late_process_packages = []
-
-            for package_path in packages:
-                package_name = os.path.basename(os.path.normpath(package_path))
-                print "### Package Found: {0} in {1}".format(package_name, package_path).ljust(80, '#')
+            package_paths = dict((os.path.basename(os.path.normpath(p)), p) for p in packages)
 
-                if package_path not in late_process_packages and args.add_packages_to_manifest is not None \
-                        and package_name in args.add_packages_to_manifest:
-                    print "Skipping for now since it is to be added to the manifest at the end"
-                    late_process_packages.append(package_path)
-                    continue
-                else:
-                    local_dependencies = [d for d in args.add_package_as_dependency_to_package if
-                                          "{0}:".format(package_name) in d]
-                    should_defer = False
-                    for dep in [l.split(":")[1] for l in local_dependencies]:
-                        if dep not in local_packages:
-                            print "This package has extra dependencies that haven't been processed yet so we add this " \
-                                  "package to late processing. The dependency is: {0}".format(dep)
-                            late_process_packages.append(package_path)
-                            should_defer = True
-                            break
-                    if should_defer:
-                        continue
-
-                process_package(package_path, package_name, root_clone)
+            def process(package_name):
+                print "### Package Found: {0} in {1}".format(package_name, package_paths[package_name]).ljust(80, '#')
+                process_package(package_paths[package_name], package_name)
 
-            for package_path in late_process_packages:
-                package_name = os.path.basename(os.path.normpath(package_path))
-                print "### Package Found to add to manifest: {0} in {1}".format(package_name, package_path).ljust(80,
-                                                                                                                  '#')
-                process_package(package_path, package_name, root_clone)
+            failures = schedule_dependency_graph(get_package_graph(packages), process, args.jobs)
+            if failures:
+                print "Processing failed for the following packages:"
+                for package_name in sorted(failures.keys()):
+                    print "  {0}: {1}".format(package_name, failures[package_name])
+                raise Exception("Failed to process {0} of {1} packages".format(len(failures), len(packages)))
 
             publish_modified_packages()
             remove_package_folders()
@@ -713,10 +1484,8 @@ def main():     # pragma: no cover
             global best_view_registry
             best_view_registry = get_registry_from_manifest()
             print "View registry from manifest is {0}".format(best_view_registry)
-            dependencies = {}
-            for p in args.add_packages_to_manifest:
-                dependencies[p] = get_version_from_manifest(p)
-                dependencies.update(get_filtered_dependencies_from_view_registry(p, dependencies[p]))
+            dependencies = resolve_republish_dependencies(
+                dict((p, get_version_from_manifest(p)) for p in args.add_packages_to_manifest))
             if args.add_package_as_dependency_to_package:
                 for p in args.add_package_as_dependency_to_package:
                     p_split = p.split(":")
@@ -730,23 +1499,24 @@ def main():     # pragma: no cover
                                 p_split[1]))
 
             print "Checking if the correct packages exist in the target registry."
-            for name in dependencies.keys():
-                version = dependencies[name]
-                registry_version = _get_version_in_registry(name, args.publish_registry)
-                if registry_version == version:
-                    dependencies.pop(name)
-                    continue
+            missing = get_packages_missing_in_registry(dependencies, args.publish_registry)
+            for name in missing:
+                # The package documents were just fetched, so this doesn't make another request
                 print "  {0}@{1} is missing in the target registry (the latest one available is '{2}'. Will publish it.".format(
-                    name, version, registry_version)
+                    name, dependencies[name], _get_version_in_registry(name, args.publish_registry))
+            dependencies = dict((name, dependencies[name]) for name in missing)
 
             if len(dependencies) == 0:
                 print "It looks like all packages already exist on the publish_registry. So we don't need to republish anything"
             else:
                 print "The following packages are missing from the publish registry. Will republish them now"
-                for key, value in dependencies.iteritems():
-                    tar_path = download_package_tarball(key, value)
-                    print "Publishing {0}".format(tar_path)
-                    npm_cmd("publish {0}".format(tar_path), args.publish_registry)
+                failures = mirror_packages(dependencies, best_view_registry)
+                if failures:
+                    print "Republishing failed for the following packages:"
+                    for package_name in sorted(failures.keys()):
+                        print "  {0}@{1}: {2}".format(package_name, dependencies[package_name], failures[package_name])
+                    raise Exception("Failed to republish {0} of {1} packages".format(len(failures),
+                                                                                     len(dependencies)))
 
             _modify_manifest_registry()
             for key, value in dependencies.iteritems():
@@ -756,7 +1526,8 @@ def main():     # pragma: no cover
             raise Exception("No package folders found, and --only-publish-existing-packages has not been set. This "
                             "run has failed.")
 
-        git_cmd("add {0}".format(args.packages_path))
+        save_workspace()
+        git_cmd(["add", args.packages_path])
         scatter_manifest()
 
         should_push = create_commit()
@@ -767,7 +1538,7 @@ def main():     # pragma: no cover
                     .format(args.target_branch)
             else:
                 print "Pushing squashed branch publishStable-temp to remote target/{0}".format(args.target_branch)
-                git_cmd("push target publishStable-temp:{0}".format(args.target_branch))
+                git_cmd(["push", "target", "publishStable-temp:{0}".format(args.target_branch)])
         else:
             print "Marking as failed, since we didn't push a commit"
             sys.exit(-1)
@@ -786,10 +1557,22 @@ def main():     # pragma: no cover
         if os.path.isdir("etc"):
             shutil.rmtree("etc")
 
-        git_cmd("checkout {0}".format(source_branch))
+        git_cmd(["checkout", source_branch])
+        git_runner.close()
+
+        if args.git_timings > 0:
+            print git_runner.get_report(args.git_timings)
+        if registry_client.policy.latencies.get_hosts():
+            print "Registry requests per host:"
+            print registry_client.policy.get_summary()
 
         os.chdir(root_dir)
 
+        if args.trace:
+            tracer.write_chrome_trace(args.trace)
+            print "Wrote trace to {0}. Time spent per span:".format(args.trace)
+            print tracer.get_summary()
+
 def parseArgumentList(argList): # pragma: no cover
     parser = argparse.ArgumentParser(description="A tool which finds all internal packages in a Unity project, "
                                                  "publishes them and updates the repo to use them from the upm repo "
@@ -826,7 +1609,7 @@ def parseArgumentList(argList): # pragma: no cover
                                                                        "packages then specify this here in the format "
                                                                        "package_with_dependency:dependency. For "
                                                                        "example com.unity.entities:com.unity.jobs",
-                        action='append')
+                        action='append', default=[])
     parser.add_argument('--dry-run', help="If set the tool will do everything except publishing the new packages and "
                                           "pushing the new commit to the target repo", action='store_true')
     parser.add_argument('--strip-from-commit', action='append', help="Files or folders that should be removed from "
@@ -842,7 +1625,42 @@ def parseArgumentList(argList): # pragma: no cover
                                                                           "starting with a . in the repo. If you want"
                                                                           " these in you need to whitelist these "
                                                                           "files or folders")
-    return parser.parse_args()
+    parser.add_argument('--trace', help="Path to write a Chrome trace of the run to, showing the time spent in each "
+                                        "phase, package and git, npm or http request. It can be opened in "
+                                        "chrome://tracing or Perfetto. A summary is printed at the end as well")
+    parser.add_argument('--git-timings', type=int, default=10,
+                        help="How many of the most expensive git commands to list at the end of the run. 0 turns the "
+                             "list off")
+    parser.add_argument('--max-concurrent-requests', type=int, default=8,
+                        help="The maximum number of requests to the registries that are allowed to run at the same "
+                             "time")
+    parser.add_argument('--shallow-target-fetch', action='store_true',
+                        help="Only fetch the newest commit of the target branch, without its files, instead of the "
+                             "whole target repo. The target server needs to allow filters for the files to be left out. "
+                             "This leaves the local repo shallow and without those files, a later run without the flag "
+                             "fetches what is missing again, which needs git 2.36 or newer")
+    parser.add_argument('--release-lookup-depth', type=int, default=100,
+                        help="How many commits of the target branch to look through for the latest release number")
+    parser.add_argument('--jobs', type=int, default=4,
+                        help="The maximum number of packages that are processed at the same time. A package is "
+                             "always processed after the local packages it depends on")
+    parser.add_argument('--publish-concurrency', type=int, default=4,
+                        help="The maximum number of packages that are uploaded to the publish registry at the same "
+                             "time. A package is always published after the local packages it depends on")
+    parser.add_argument('--tarball-cache-dir', default=os.path.join("~", ".cache", "publishStable", "tarballs"),
+                        help="Where downloaded package tarballs are kept between runs. Several runs on the same "
+                             "machine can share it")
+    parser.add_argument('--tarball-cache-size', type=int, default=1024,
+                        help="The size in MB the tarball cache is allowed to grow to before the least recently used "
+                             "tarballs are removed")
+    parser.add_argument('--change-detection', choices=['git-tree', 'hashes', 'tarball'], default='git-tree',
+                        help="How to find out if a package has changed since the published version. 'git-tree' "
+                             "compares the git tree of the package folder with the one recorded in the last release "
+                             "commit on the target branch and falls back to 'hashes' if it moved. 'hashes' compares "
+                             "the file hashes stored in the published package.json with the local files and only "
+                             "downloads the tarball if the published package has no hashes. 'tarball' always "
+                             "downloads and compares the published tarball")
+    return parser.parse_args(argList[1:])
 
 if __name__ == "__main__":      # pragma: no cover
     args = parseArgumentList(sys.argv)
@@ -0,0 +1,434 @@
+import base64
+import hashlib
+import json
+import os
+import re
+import threading
+import urllib
+
+import requests
+
+from request_policy import CircuitOpenError
+from request_policy import RequestPolicy
+from tracing import tracer
+
+# Tarballs that can't be streamed while they are mirrored are read into memory first, up to this size
+MAX_BUFFERED_TARBALL_SIZE = 256 * 1024 * 1024
+
+class RegistryError(Exception):
+    pass
+
+
+class TarballHashes(object):
+    """
+    Hashes a tarball while it is being downloaded and checks the result against the shasum and integrity the registry
+    has for it, so the file doesn't have to be read again after the download
+    """
+
+    def __init__(self, shasum=None, integrity=None):
+        # type: (str, str) -> None
+        self.expected = []
+        if shasum:
+            self.expected.append(("sha1", shasum, lambda h: h.hexdigest()))
+        # integrity is a subresource integrity string like sha512-<base64>, possibly with several hashes
+        for entry in (integrity or "").split():
+            algorithm, _, expected = entry.partition("-")
+            if algorithm in ["sha1", "sha256", "sha384", "sha512"]:
+                self.expected.append((algorithm, expected, lambda h: base64.b64encode(h.digest())))
+        self.reset()
+
+    def reset(self):
+        self.hashes = [hashlib.new(algorithm) for algorithm, expected, digest in self.expected]
+
+    def update(self, chunk):
+        for h in self.hashes:
+            h.update(chunk)
+
+    def verify(self, description):
+        for h, (algorithm, expected, digest) in zip(self.hashes, self.expected):
+            if digest(h) != expected:
+                raise Exception("The {0} of {1} is {2} but the registry says it should be {3}".format(
+                    algorithm, description, digest(h), expected))
+
+
+class StreamingPublishBody(object):
+    """
+    The body of a publish request for a tarball that is still being downloaded. It is read like a file by the http
+    library and produces the same json as create_publish_document, but with the attachment first so the tarball can be
+    base64 encoded as it arrives. The rest of the document only follows once the whole tarball has been checked against
+    hashes, so if it doesn't match the request is broken off before the registry has a complete document. Only one
+    chunk of the tarball is held in memory at a time.
+    """
+
+    def __init__(self, document, attachment_name, chunks, tarball_size, hashes, description):
+        # type: (dict, str, iter, int, TarballHashes, str) -> None
+        attachment = json.dumps({"content_type": "application/octet-stream", "length": tarball_size})
+        self._prefix = '{{"_attachments": {{{0}: {1}, "data": "'.format(json.dumps(attachment_name), attachment[:-1])
+        self._suffix = '"}}, ' + json.dumps(document)[1:]
+        self._chunks = iter(chunks)
+        self._tarball_size = tarball_size
+        self._hashes = hashes
+        self._description = description
+        self._received = 0
+        # Bytes that didn't make up a whole base64 group yet, and encoded output that hasn't been read
+        self._remainder = ""
+        self._buffer = self._prefix
+        self._done = False
+
+    def __len__(self):
+        return len(self._prefix) + (self._tarball_size + 2) / 3 * 4 + len(self._suffix)
+
+    def _fill(self):
+        chunk = next(self._chunks, None)
+        if chunk is None:
+            if self._received != self._tarball_size:
+                raise RegistryError("Got {0} bytes of {1} but expected {2}".format(self._received, self._description,
+                                                                                  self._tarball_size))
+            self._hashes.verify(self._description)
+            self._buffer += base64.b64encode(self._remainder) + self._suffix
+            self._remainder = ""
+            self._done = True
+            return
+
+        self._received += len(chunk)
+        if self._received > self._tarball_size:
+            raise RegistryError("Got more than the expected {0} bytes of {1}".format(self._tarball_size,
+                                                                                    self._description))
+        self._hashes.update(chunk)
+        data = self._remainder + chunk
+        whole = len(data) - len(data) % 3
+        self._buffer += base64.b64encode(data[:whole])
+        self._remainder = data[whole:]
+
+    def read(self, size=-1):
+        # type: (int) -> str
+        while not self._done and (size < 0 or len(self._buffer) < size):
+            self._fill()
+        if size < 0:
+            size = len(self._buffer)
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+
+def _expand_environment_variables(value):
+    # npm allows ${VARIABLE} in .npmrc, mostly used for tokens on CI machines
+    return re.sub(r"\$\{([^}]+)\}", lambda m: os.environ.get(m.group(1), ""), value)
+
+
+def read_npmrc_credentials(npmrc_path):
+    # type: (str) -> dict
+    """
+    Returns the credentials found in the .npmrc as a dictionary of registry url without the scheme
+    (//host/path/) -> (key, value), where key is either _authToken or _auth
+    """
+    credentials = {}
+    if not npmrc_path or not os.path.isfile(npmrc_path):
+        return credentials
+
+    with open(npmrc_path, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if not line.startswith("//") or "=" not in line:
+                continue
+            key, value = line.split("=", 1)
+            if ":" not in key:
+                continue
+            registry, setting = key.rsplit(":", 1)
+            if setting not in ["_authToken", "_auth"]:
+                continue
+            credentials[registry.rstrip("/") + "/"] = (setting, _expand_environment_variables(value.strip()))
+    return credentials
+
+
+def _get_npm_setting_from_environment(name):
+    # type: (str) -> str
+    # npm takes its settings from npm_config_<name> environment variables, without caring about the case
+    for key, value in os.environ.iteritems():
+        if key.lower() == "npm_config_" + name and value:
+            return value
+    return None
+
+
+def get_npmrc_paths(project_dir):
+    # type: (str) -> list
+    """
+    Returns the .npmrc files npm reads, from the highest precedence to the lowest: the one in project_dir, the user
+    config, which is ~/.npmrc unless NPM_CONFIG_USERCONFIG says otherwise, and the global config if
+    NPM_CONFIG_GLOBALCONFIG is set. npm's own default for the global config depends on where npm is installed, so that
+    one can't be found without npm
+    """
+    paths = [os.path.join(project_dir, ".npmrc")]
+    user_config = _get_npm_setting_from_environment("userconfig") or os.path.join("~", ".npmrc")
+    paths.append(os.path.expanduser(user_config))
+    global_config = _get_npm_setting_from_environment("globalconfig")
+    if global_config:
+        paths.append(os.path.expanduser(global_config))
+    return paths
+
+
+def read_npm_config_credentials(npmrc_paths):
+    # type: (list) -> dict
+    # The credentials of all the .npmrc files in npmrc_paths, where the earlier files win like in npm
+    credentials = {}
+    for npmrc_path in reversed(npmrc_paths):
+        credentials.update(read_npmrc_credentials(npmrc_path))
+    return credentials
+
+
+class RegistryClient(object):
+    """
+    Talks to npm registries over http instead of starting an npm process for every query. The metadata document of a
+    package is fetched once per registry and kept in memory for the rest of the run, so the version, tarball url and
+    dependencies of a package all come from the same request. All requests go through a RequestPolicy, which picks
+    timeouts, retries lookups and hedges slow ones.
+    """
+
+    def __init__(self, npmrc_path=None):
+        # Without npmrc_path the credentials come from the same .npmrc files npm would read in the current folder
+        if npmrc_path is None:
+            self.load_npm_config(os.getcwd())
+        else:
+            self._credentials = read_npmrc_credentials(npmrc_path)
+        self._session = requests.Session()
+        self.policy = RequestPolicy(self._session)
+        self._documents = {}
+        self._document_locks = {}
+        self._lock = threading.Lock()
+
+    def load_npm_config(self, project_dir):
+        # type: (str) -> None
+        # Reads the credentials again for running in project_dir, like npm does when it is started there
+        self._credentials = read_npm_config_credentials(get_npmrc_paths(project_dir))
+
+    def get_headers(self, registry):
+        # type: (str) -> dict
+        headers = {"Accept": "application/json"}
+        registry_without_scheme = registry.split(":", 1)[-1].rstrip("/") + "/"
+        # Like npm, the most specific registry url wins when several match
+        matching = [r for r in self._credentials if registry_without_scheme.startswith(r)]
+        if not matching:
+            return headers
+        setting, value = self._credentials[max(matching, key=len)]
+        if setting == "_authToken":
+            headers["Authorization"] = "Bearer {0}".format(value)
+        else:
+            headers["Authorization"] = "Basic {0}".format(value)
+        return headers
+
+    def get(self, url, headers=None, stream=False):
+        # type: (str, dict, bool) -> requests.Response
+        """
+        Plain GET through the pooled session, with the credentials of the registry the url belongs to. It isn't retried,
+        since callers streaming the response have to decide how to continue, see RequestPolicy.retry
+        """
+        request_headers = self.get_headers(url)
+        request_headers.update(headers or {})
+        with tracer.span("GET", "http", url=url) as span:
+            response = self.policy.request("GET", url, retry=False, headers=request_headers, stream=stream)
+            span.set("status", response.status_code)
+        return response
+
+    def get_package_url(self, package_name, registry):
+        # type: (str, str) -> str
+        # Scoped packages keep the @ but need the / encoded
+        return "{0}/{1}".format(registry.rstrip("/"), urllib.quote(package_name, safe="@"))
+
+    def _fetch_package_document(self, package_name, registry):
+        # type: (str, str) -> dict
+        url = self.get_package_url(package_name, registry)
+        print "  Getting {0}".format(url)
+        try:
+            with tracer.span("GET package document", "http", url=url) as span:
+                response = self.policy.request("GET", url, hedge=True, headers=self.get_headers(registry))
+                span.set("status", response.status_code)
+        except (requests.RequestException, CircuitOpenError) as e:
+            raise RegistryError("Could not reach {0}: {1}".format(registry, e))
+
+        # Registries answer 404 when the package has never been published there
+        if response.status_code == 404:
+            return None
+        if response.status_code != 200:
+            raise RegistryError("Getting {0} from {1} failed with status {2}".format(package_name, registry,
+                                                                                      response.status_code))
+        return response.json()
+
+    def get_package_document(self, package_name, registry):
+        # type: (str, str) -> dict
+        key = (registry.rstrip("/"), package_name)
+        with self._lock:
+            document_lock = self._document_locks.setdefault(key, threading.Lock())
+
+        # Only one thread fetches a given document, the others wait for it and read it from the cache
+        with document_lock:
+            if key not in self._documents:
+                self._documents[key] = self._fetch_package_document(package_name, registry)
+            return self._documents[key]
+
+    def forget_package_document(self, package_name, registry):
+        # type: (str, str) -> None
+        with self._lock:
+            self._documents.pop((registry.rstrip("/"), package_name), None)
+
+    def get_latest_version(self, package_name, registry):
+        # type: (str, str) -> str
+        # Same as 'npm view <package> version'. Returns an empty string if the package doesn't exist in the registry
+        document = self.get_package_document(package_name, registry)
+        if not document:
+            return ""
+        return document.get("dist-tags", {}).get("latest", "")
+
+    def has_version(self, package_name, version, registry):
+        # type: (str, str, str) -> bool
+        document = self.get_package_document(package_name, registry)
+        return document is not None and version in document.get("versions", {})
+
+    def get_version_metadata(self, package_name, version, registry):
+        # type: (str, str, str) -> dict
+        if not self.has_version(package_name, version, registry):
+            raise RegistryError("{0}@{1} does not exist in {2}".format(package_name, version, registry))
+        return self.get_package_document(package_name, registry)["versions"][version]
+
+    def get_dependencies(self, package_name, version, registry):
+        # type: (str, str, str) -> dict
+        return self.get_version_metadata(package_name, version, registry).get("dependencies", {})
+
+    def get_new_tarball_url(self, package_name, version, registry):
+        # type: (str, str, str) -> str
+        # Where the registry will serve the tarball of a version we publish, the same url npm publish puts in dist
+        return "{0}/-/{1}-{2}.tgz".format(self.get_package_url(package_name, registry), package_name.split("/")[-1],
+                                          version)
+
+    def _create_publish_document(self, package_file, dist, registry):
+        # type: (dict, dict, str) -> tuple
+        # The publish document without the attachment, and the name the attachment goes by
+        package_name = package_file["name"]
+        version = package_file["version"]
+        tarball_url = self.get_new_tarball_url(package_name, version, registry)
+
+        version_document = dict(package_file)
+        version_document["_id"] = "{0}@{1}".format(package_name, version)
+        version_document["dist"] = dict(dist, tarball=tarball_url)
+
+        document = {
+            "_id": package_name,
+            "name": package_name,
+            "description": package_file.get("description", ""),
+            "dist-tags": {"latest": version},
+            "versions": {version: version_document},
+            "readme": package_file.get("readme", ""),
+        }
+        return document, tarball_url.rsplit("/", 1)[-1]
+
+    def create_publish_document(self, package_file, tarball, registry):
+        # type: (dict, str, str) -> dict
+        """
+        Builds the document npm publish sends to the registry: the package.json of the new version with the dist
+        information added, and the tarball itself base64 encoded as an attachment
+        """
+        document, attachment_name = self._create_publish_document(package_file, {
+            "shasum": hashlib.sha1(tarball).hexdigest(),
+            "integrity": "sha512-{0}".format(base64.b64encode(hashlib.sha512(tarball).digest())),
+        }, registry)
+        document["_attachments"] = {
+            attachment_name: {
+                "content_type": "application/octet-stream",
+                "data": base64.b64encode(tarball),
+                "length": len(tarball),
+            }
+        }
+        return document
+
+    def _put_package(self, package_name, version, registry, data, size):
+        url = self.get_package_url(package_name, registry)
+        headers = self.get_headers(registry)
+        headers["Content-Type"] = "application/json"
+        print "  Putting {0}@{1} to {2}".format(package_name, version, url)
+        try:
+            with tracer.span("PUT package", "http", url=url, size=size) as span:
+                response = self.policy.request("PUT", url, data=data, headers=headers)
+                span.set("status", response.status_code)
+        except (requests.RequestException, CircuitOpenError) as e:
+            raise RegistryError("Could not reach {0}: {1}".format(registry, e))
+
+        if response.status_code not in [200, 201]:
+            raise RegistryError("Publishing {0}@{1} to {2} failed with status {3}: {4}".format(
+                package_name, version, registry, response.status_code, response.text))
+
+        # The cached document doesn't have the new version
+        self.forget_package_document(package_name, registry)
+
+    def publish(self, package_file, tarball, registry):
+        # type: (dict, str, str) -> None
+        # Same as 'npm publish <tarball>', package_file being the package.json that was packed into the tarball
+        document = self.create_publish_document(package_file, tarball, registry)
+        self._put_package(package_file["name"], package_file["version"], registry, json.dumps(document), len(tarball))
+
+    def mirror(self, package_name, version, source_registry, target_registry, chunk_size=64 * 1024,
+               max_buffered_size=MAX_BUFFERED_TARBALL_SIZE):
+        # type: (str, str, str, str, int, int) -> bool
+        """
+        Publishes package_name@version from source_registry to target_registry, streaming the tarball from the download
+        straight into the publish request (see StreamingPublishBody) so it never ends up on disk or in memory as a
+        whole. The size of the publish request has to be known up front, so if the source doesn't send the plain size
+        of the tarball it is downloaded into memory first, as long as it isn't larger than max_buffered_size. Returns
+        False without publishing anything if the target already has the version
+        """
+        if self.has_version(package_name, version, target_registry):
+            return False
+
+        version_document = self.get_version_metadata(package_name, version, source_registry)
+        dist = version_document.get("dist", {})
+        description = "{0}@{1} from {2}".format(package_name, version, source_registry)
+        if not dist.get("shasum"):
+            raise RegistryError("{0} has no shasum, so it can't be checked while it is mirrored".format(description))
+        package_file = dict((k, v) for k, v in version_document.iteritems() if not k.startswith("_") and k != "dist")
+        document, attachment_name = self._create_publish_document(
+            package_file, dict((k, dist[k]) for k in ["shasum", "integrity"] if k in dist), target_registry)
+
+        def get_tarball():
+            # Returns the open response when the tarball can be streamed, otherwise the downloaded tarball, or None for
+            # both if it is too large to download into memory
+            response = self.get(dist["tarball"], stream=True)
+            if response.status_code != 200:
+                response.close()
+                raise requests.HTTPError("Getting the tarball of {0} failed with status {1}".format(
+                    description, response.status_code), response=response)
+            if "Content-Length" in response.headers and \
+                    response.headers.get("Content-Encoding", "identity") == "identity":
+                return response, None
+
+            try:
+                chunks = []
+                size = 0
+                for chunk in response.iter_content(chunk_size):
+                    size += len(chunk)
+                    if size > max_buffered_size:
+                        return None, None
+                    chunks.append(chunk)
+                return None, "".join(chunks)
+            finally:
+                response.close()
+
+        try:
+            response, tarball = self.policy.retry(dist["tarball"], "getting the tarball of {0}".format(description),
+                                                  get_tarball)
+        except (requests.RequestException, CircuitOpenError) as e:
+            raise RegistryError(str(e))
+
+        hashes = TarballHashes(dist["shasum"], dist.get("integrity"))
+        if response is None:
+            if tarball is None:
+                raise RegistryError("The tarball of {0} has no plain Content-Length and is larger than {1} bytes, so it "
+                                    "can't be mirrored".format(description, max_buffered_size))
+            body = StreamingPublishBody(document, attachment_name, [tarball], len(tarball), hashes, description)
+            self._put_package(package_name, version, target_registry, body, len(tarball))
+            return True
+
+        try:
+            tarball_size = int(response.headers["Content-Length"])
+            body = StreamingPublishBody(document, attachment_name, response.iter_content(chunk_size), tarball_size,
+                                        hashes, description)
+            self._put_package(package_name, version, target_registry, body, tarball_size)
+        finally:
+            response.close()
+        return True
@@ -0,0 +1,121 @@
+import os
+import re
+
+STRIP = "strip"
+HIDDEN = "hidden"
+IGNORE = "ignore"
+
+
+def _translate_component(component):
+    # type: (str) -> str
+    # Like fnmatch.translate, but * and ? never match a / so the pattern works on whole paths the way glob does
+    regex = ""
+    i = 0
+    while i < len(component):
+        c = component[i]
+        i += 1
+        if c == "*":
+            regex += "[^/]*"
+        elif c == "?":
+            regex += "[^/]"
+        elif c == "[":
+            j = i
+            if j < len(component) and component[j] == "!":
+                j += 1
+            if j < len(component) and component[j] == "]":
+                j += 1
+            while j < len(component) and component[j] != "]":
+                j += 1
+            if j >= len(component):
+                regex += "\\["
+            else:
+                characters = component[i:j].replace("\\", "\\\\")
+                i = j + 1
+                if characters.startswith("!"):
+                    characters = "^" + characters[1:]
+                elif characters.startswith("^"):
+                    characters = "\\" + characters
+                regex += "[{0}]".format(characters)
+        else:
+            regex += re.escape(c)
+
+    # glob doesn't let wildcards match names starting with a dot unless the pattern starts with one too
+    if not component.startswith("."):
+        regex = "(?!\\.)" + regex
+    return regex
+
+
+def _translate_pattern(pattern):
+    # type: (str) -> str
+    components = [c for c in pattern.replace("\\", "/").split("/") if c not in ["", "."]]
+    return "/".join(_translate_component(c) for c in components)
+
+
+class RepoPathMatcher(object):
+    """
+    The --strip-from-commit patterns and the --whitelist-hidden-paths names compiled into one matcher. The strip
+    patterns are glob patterns relative to the root of the repo and are all combined into a single regular expression.
+    Hidden paths are files and folders whose name starts with a dot, apart from the .git folder and whitelisted names.
+    """
+
+    def __init__(self, strip_patterns, whitelisted_hidden_names):
+        # type: (list, list) -> None
+        patterns = [p for p in (_translate_pattern(p) for p in strip_patterns or []) if p]
+        self._strip = None
+        if patterns:
+            self._strip = re.compile("(?:{0})\\Z".format("|".join(patterns)))
+        self._whitelist = set(whitelisted_hidden_names or [])
+
+    def match(self, relative_path, name, is_dir):
+        # type: (str, str, bool) -> str
+        """
+        Returns STRIP, HIDDEN or IGNORE for paths that shouldn't be looked into any further, and None for everything
+        else. relative_path uses / as separator
+        """
+        if self._strip is not None and self._strip.match(relative_path):
+            return STRIP
+        if not name.startswith("."):
+            return None
+        if name in self._whitelist or (is_dir and name == ".git"):
+            return IGNORE
+        return HIDDEN
+
+
+def scan_repository(matcher, root=".", paths=None):
+    # type: (RepoPathMatcher, str, list) -> tuple
+    """
+    Finds the paths to strip and the hidden paths in one pass over the repo. Returns both as sorted lists of paths
+    relative to root using / as separator. A folder that matches is reported once and its content is never looked at.
+    The folder is walked unless paths is given, which should be a list of file paths relative to root like git
+    ls-files prints them.
+    """
+    found = {STRIP: [], HIDDEN: []}
+
+    def visit(relative_path, name, is_dir):
+        result = matcher.match(relative_path, name, is_dir)
+        if result in found:
+            found[result].append(relative_path)
+        return result is None
+
+    if paths is None:
+        for folder, dirs, files in os.walk(root):
+            relative_folder = os.path.relpath(folder, root).replace(os.sep, "/")
+            prefix = "" if relative_folder == "." else relative_folder + "/"
+            # Removing folders from dirs stops os.walk from going into them
+            dirs[:] = [d for d in dirs if visit(prefix + d, d, True)]
+            for f in files:
+                visit(prefix + f, f, False)
+    else:
+        visited_folders = {}
+        for path in paths:
+            components = path.split("/")
+            for i in range(len(components) - 1):
+                folder = "/".join(components[:i + 1])
+                if folder not in visited_folders:
+                    visited_folders[folder] = visit(folder, components[i], True)
+                if not visited_folders[folder]:
+                    break
+            else:
+                visit(path, components[-1], False)
+
+    return sorted(found[STRIP]), sorted(found[HIDDEN])
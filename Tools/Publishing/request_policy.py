@@ -0,0 +1,312 @@
+"""
+Timeouts, retries, hedging and circuit breaking for the http requests the CI and publishing scripts make to registries
+and Artifactory. The CI scripts import it through the Tools package, so both behave the same when a server gets slow or
+goes away.
+"""
+import collections
+import math
+import random
+import threading
+import time
+import urlparse
+
+import requests
+
+IDEMPOTENT_METHODS = ["GET", "HEAD", "OPTIONS"]
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+class LatencyTracker(object):
+    """
+    Remembers how long the last window requests to every host took, so timeouts and hedging can follow what is normal
+    for that host instead of a fixed guess
+    """
+
+    def __init__(self, window=200):
+        # type: (int) -> None
+        self.window = window
+        self._samples = {}
+        self._lock = threading.Lock()
+
+    def record(self, host, duration):
+        # type: (str, float) -> None
+        with self._lock:
+            self._samples.setdefault(host, collections.deque(maxlen=self.window)).append(duration)
+
+    def get_count(self, host):
+        # type: (str) -> int
+        with self._lock:
+            return len(self._samples.get(host, []))
+
+    def get_percentile(self, host, percentile):
+        # type: (str, float) -> float
+        # The nearest rank percentile of the remembered durations, or None if there are none
+        with self._lock:
+            samples = sorted(self._samples.get(host, []))
+        if not samples:
+            return None
+        index = int(math.ceil(percentile / 100.0 * len(samples))) - 1
+        return samples[max(0, min(index, len(samples) - 1))]
+
+    def get_hosts(self):
+        # type: () -> list
+        with self._lock:
+            return sorted(self._samples.keys())
+
+
+class CircuitBreaker(object):
+    """
+    Stops requests to a host after failure_threshold failures in a row, so a server that is down fails the run quickly
+    instead of every request waiting for its own timeouts and retries. After reset_timeout seconds one request is let
+    through again, and the host is back to normal if it succeeds.
+    """
+
+    def __init__(self, failure_threshold=5, reset_timeout=30.0, clock=time.time):
+        # type: (int, float, callable) -> None
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._clock = clock
+        self._failures = {}
+        self._opened_at = {}
+        self._lock = threading.Lock()
+
+    def allow(self, host):
+        # type: (str) -> bool
+        with self._lock:
+            if self._failures.get(host, 0) < self.failure_threshold:
+                return True
+            if self._clock() - self._opened_at[host] < self.reset_timeout:
+                return False
+            # Let this request try, and keep the others out until it is known how it went
+            self._opened_at[host] = self._clock()
+            return True
+
+    def record_success(self, host):
+        # type: (str) -> None
+        with self._lock:
+            self._failures[host] = 0
+
+    def record_failure(self, host):
+        # type: (str) -> None
+        with self._lock:
+            self._failures[host] = self._failures.get(host, 0) + 1
+            if self._failures[host] >= self.failure_threshold:
+                self._opened_at[host] = self._clock()
+
+
+class _Hedge(object):
+    # The requests sent for one hedged call. The first response that isn't an error wins, later ones are closed
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.done = threading.Event()
+        self.running = 0
+        self.response = None
+        self.error = None
+
+    def finish(self, response, error):
+        with self.lock:
+            self.running -= 1
+            if self.done.is_set():
+                if response is not None:
+                    response.close()
+                return
+            if error is None:
+                self.response = response
+                self.done.set()
+                return
+            self.error = error
+            if self.running == 0:
+                self.done.set()
+
+
+class RequestPolicy(object):
+    """
+    Sends requests through a requests session with:
+
+    - timeouts from the latency of earlier requests to the same host, timeout_factor times its timeout_percentile,
+      once there are min_samples of them. Until then default_timeout is used
+    - a second request for calls that ask for hedging when the first takes longer than the hedge_percentile of the host.
+      Whichever answers first is used. Only meant for small idempotent requests like metadata lookups
+    - retries with full jitter for idempotent requests that fail or get a 5xx, up to max_attempts
+    - a CircuitBreaker per host
+    """
+
+    def __init__(self, session=None, default_timeout=30.0, min_timeout=2.0, max_timeout=120.0, timeout_percentile=99,
+                 timeout_factor=3.0, hedge_percentile=90, min_samples=10, max_attempts=5, base_delay=0.5,
+                 max_delay=30.0, failure_threshold=5, reset_timeout=30.0, sleep=time.sleep, rng=None):
+        self.session = session or requests.Session()
+        self.default_timeout = default_timeout
+        self.min_timeout = min_timeout
+        self.max_timeout = max_timeout
+        self.timeout_percentile = timeout_percentile
+        self.timeout_factor = timeout_factor
+        self.hedge_percentile = hedge_percentile
+        self.min_samples = min_samples
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.latencies = LatencyTracker()
+        self.breaker = CircuitBreaker(failure_threshold, reset_timeout)
+        self.hedged = collections.Counter()
+        self.retried = collections.Counter()
+        self._sleep = sleep
+        self._random = rng or random.Random()
+        self._lock = threading.Lock()
+
+    def get_host(self, url):
+        # type: (str) -> str
+        return urlparse.urlparse(url).netloc or url
+
+    def get_timeout(self, host):
+        # type: (str) -> float
+        if self.latencies.get_count(host) < self.min_samples:
+            return self.default_timeout
+        timeout = self.latencies.get_percentile(host, self.timeout_percentile) * self.timeout_factor
+        return max(self.min_timeout, min(timeout, self.max_timeout))
+
+    def get_hedge_delay(self, host):
+        # type: (str) -> float
+        # How long to wait before sending a second request, or None if too little is known about the host yet
+        if self.latencies.get_count(host) < self.min_samples:
+            return None
+        return self.latencies.get_percentile(host, self.hedge_percentile)
+
+    def get_retry_delay(self, attempt):
+        # type: (int) -> float
+        # Full jitter, so clients that failed at the same time don't all come back at the same time
+        return self._random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+
+    def retry(self, url, description, func):
+        """
+        Calls func until it returns without raising, at most max_attempts times and with a jittered delay in between.
+        Client errors (4xx) and an open circuit for the host of url are raised right away
+        """
+        host = self.get_host(url)
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                return func()
+            except CircuitOpenError:
+                raise
+            except requests.HTTPError as e:
+                if e.response is not None and e.response.status_code < 500 or attempt >= self.max_attempts:
+                    raise
+                error = e
+            except Exception as e:
+                if attempt >= self.max_attempts:
+                    print "  Reached maximum retries"
+                    raise
+                error = e
+
+            delay = self.get_retry_delay(attempt)
+            with self._lock:
+                self.retried[host] += 1
+            print "  Got exception while {0}: {1}. Retrying in {2:.2f}sec. (Attempt {3}/{4})".format(
+                description, error, delay, attempt, self.max_attempts)
+            self._sleep(delay)
+
+    def request(self, method, url, hedge=False, retry=None, **kwargs):
+        # type: (str, str, bool, bool, ...) -> requests.Response
+        """
+        Sends a request like requests.Session.request. retry defaults to whether the method is idempotent. When retrying,
+        5xx answers are retried as well, and the last one is returned if all attempts get one
+        """
+        method = method.upper()
+        if retry is None:
+            retry = method in IDEMPOTENT_METHODS
+        if not retry:
+            return self._send(method, url, hedge, kwargs)
+
+        attempts = [0]
+
+        def send():
+            attempts[0] += 1
+            response = self._send(method, url, hedge, kwargs)
+            if response.status_code >= 500 and attempts[0] < self.max_attempts:
+                response.close()
+                raise requests.HTTPError("{0} {1} answered {2}".format(method, url, response.status_code),
+                                         response=response)
+            return response
+        return self.retry(url, "{0} {1}".format(method, url), send)
+
+    def _send(self, method, url, hedge, kwargs):
+        host = self.get_host(url)
+        if not self.breaker.allow(host):
+            raise CircuitOpenError("Requests to {0} failed too often recently, so it isn't tried again for now".format(
+                host))
+
+        kwargs = dict(kwargs)
+        if "timeout" not in kwargs:
+            # Uploads and other changes take as long as the server needs, the latency of lookups says nothing about it
+            kwargs["timeout"] = self.get_timeout(host) if method in IDEMPOTENT_METHODS else self.max_timeout
+
+        hedge_delay = self.get_hedge_delay(host) if hedge and method in IDEMPOTENT_METHODS else None
+        if hedge_delay is None:
+            return self._send_once(host, method, url, kwargs)
+        return self._send_hedged(host, method, url, kwargs, hedge_delay)
+
+    def _send_once(self, host, method, url, kwargs):
+        start_time = time.time()
+        try:
+            # Through the method of the session, so tests can replace just the method they care about
+            response = getattr(self.session, method.lower())(url, **kwargs)
+        except Exception:
+            self.breaker.record_failure(host)
+            raise
+        if response.status_code >= 500:
+            self.breaker.record_failure(host)
+        else:
+            self.breaker.record_success(host)
+            self.latencies.record(host, time.time() - start_time)
+        return response
+
+    def _send_hedged(self, host, method, url, kwargs, hedge_delay):
+        hedge = _Hedge()
+
+        def send():
+            try:
+                response = self._send_once(host, method, url, kwargs)
+            except Exception as e:
+                hedge.finish(None, e)
+            else:
+                hedge.finish(response, None)
+
+        def start():
+            hedge.running += 1
+            thread = threading.Thread(target=send, name="Hedged request")
+            thread.daemon = True
+            thread.start()
+
+        with hedge.lock:
+            start()
+        if not hedge.done.wait(hedge_delay):
+            with hedge.lock:
+                if not hedge.done.is_set():
+                    print "  {0} {1} is taking longer than {2:.2f}s, sending it again".format(method, url,
+                                                                                            hedge_delay)
+                    with self._lock:
+                        self.hedged[host] += 1
+                    start()
+        # Waiting with a timeout keeps the main thread responsive to ctrl+c in python 2
+        while not hedge.done.wait(60 * 60 * 24):
+            pass
+        if hedge.response is None:
+            raise hedge.error
+        return hedge.response
+
+    def get_summary(self):
+        # type: () -> str
+        # Latency percentiles, timeouts, hedged requests and retries per host
+        lines = ["{0:>6}  {1:>8}  {2:>8}  {3:>8}  {4:>8}  {5:>6}  {6:>7}  {7}".format(
+            "count", "p50", "p90", "p99", "timeout", "hedged", "retried", "host")]
+        for host in self.latencies.get_hosts():
+            lines.append("{0:6}  {1:7.3f}s  {2:7.3f}s  {3:7.3f}s  {4:7.1f}s  {5:6}  {6:7}  {7}".format(
+                self.latencies.get_count(host), self.latencies.get_percentile(host, 50),
+                self.latencies.get_percentile(host, 90), self.latencies.get_percentile(host, 99),
+                self.get_timeout(host), self.hedged[host], self.retried[host], host))
+        return "\n".join(lines)
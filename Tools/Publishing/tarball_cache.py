@@ -0,0 +1,117 @@
+import errno
+import hashlib
+import os
+import tempfile
+import threading
+
+
+class TarballCache(object):
+    """
+    Keeps downloaded package tarballs on disk between runs. A published name@version never changes, so entries are
+    addressed by name, version and the integrity hash from the registry and never need to be refreshed. When the cache
+    grows above max_size the least recently used tarballs are removed. Entries are written to a temporary file and
+    renamed into place, so several runs on the same machine can share the cache. Tarballs are handed out as open files,
+    so evicting one while a caller still needs it doesn't take it away from them.
+    """
+
+    TARBALL_EXTENSION = ".tgz"
+    TEMP_PREFIX = ".tmp-"
+
+    def __init__(self, cache_dir, max_size):
+        # type: (str, int) -> None
+        self.cache_dir = os.path.abspath(os.path.expanduser(cache_dir))
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        if not os.path.isdir(self.cache_dir):
+            try:
+                os.makedirs(self.cache_dir)
+            except OSError:
+                # Another run might have created it in the meantime
+                if not os.path.isdir(self.cache_dir):
+                    raise
+
+    def get_path(self, package_name, version, integrity):
+        # type: (str, str, str) -> str
+        integrity_hash = hashlib.sha1(integrity or "").hexdigest()[:16]
+        file_name = "{0}-{1}-{2}{3}".format(package_name.replace("/", "+"), version, integrity_hash,
+                                            self.TARBALL_EXTENSION)
+        return os.path.join(self.cache_dir, file_name)
+
+    def get(self, package_name, version, integrity):
+        # type: (str, str, str) -> file
+        # Returns the cached tarball opened for reading, or None if it isn't in the cache
+        path = self.get_path(package_name, version, integrity)
+        with self._lock:
+            try:
+                tarball = open(path, 'rb')
+            except IOError as e:
+                if e.errno == errno.ENOENT:
+                    return None
+                raise
+        try:
+            # The modification time is what we use to find the least recently used entries
+            os.utime(path, None)
+        except OSError:
+            # Another run evicted it since we opened it, which doesn't matter for reading it
+            pass
+        return tarball
+
+    def add(self, package_name, version, integrity, write_tarball):
+        # type: (str, str, str, callable) -> file
+        # write_tarball gets a path to write the tarball to. Returns the tarball in the cache opened for reading
+        path = self.get_path(package_name, version, integrity)
+        handle, temp_path = tempfile.mkstemp(prefix=self.TEMP_PREFIX, suffix=self.TARBALL_EXTENSION,
+                                             dir=self.cache_dir)
+        os.close(handle)
+        try:
+            write_tarball(temp_path)
+            with self._lock:
+                self._replace(temp_path, path)
+                tarball = open(path, 'rb')
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+        self.evict(keep=path)
+        return tarball
+
+    def _replace(self, source, destination):
+        try:
+            os.rename(source, destination)
+        except OSError:
+            # On Windows rename fails if the destination exists. Then another run just added the same tarball
+            if not os.path.exists(destination):
+                raise
+
+    def get_entries(self):
+        # type: () -> list
+        # Returns (modification time, size, path) for all tarballs in the cache, least recently used first
+        entries = []
+        for file_name in os.listdir(self.cache_dir):
+            if file_name.startswith(self.TEMP_PREFIX) or not file_name.endswith(self.TARBALL_EXTENSION):
+                continue
+            path = os.path.join(self.cache_dir, file_name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        return sorted(entries)
+
+    def evict(self, keep=None):
+        # type: (str) -> None
+        with self._lock:
+            entries = self.get_entries()
+            total_size = sum(size for mtime, size, path in entries)
+            for mtime, size, path in entries:
+                if total_size <= self.max_size:
+                    break
+                if path == keep:
+                    continue
+                try:
+                    os.remove(path)
+                except OSError:
+                    # Another run evicted it already, or on Windows someone still has it open
+                    pass
+                total_size -= size
+
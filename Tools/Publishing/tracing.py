@@ -0,0 +1,141 @@
+import functools
+import json
+import os
+import threading
+import time
+
+
+class _NullSpan(object):
+    # Handed out while tracing is off, so a span costs one attribute check and nothing else
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+    def set(self, key, value):
+        pass
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class _Span(object):
+    def __init__(self, tracer, name, category, span_args):
+        self.tracer = tracer
+        self.name = name
+        self.category = category
+        self.args = span_args
+        self.start_time = None
+
+    def __enter__(self):
+        self.start_time = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self.args["error"] = "{0}: {1}".format(exc_type.__name__, exc_value)
+        self.tracer._add(self, time.time())
+        return False
+
+    def set(self, key, value):
+        # type: (str, object) -> None
+        self.args[key] = value
+
+
+class Tracer(object):
+    """
+    Records nested spans of time, like the phases of a publish run, the work done for each package and every git, npm
+    and http request made on the way. Spans on the same thread nest by time, so there is no need to pass parents around.
+    The spans can be written as a Chrome trace, which chrome://tracing and Perfetto can open, and summarized as text.
+    While disabled span returns a shared object that does nothing.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.events = []
+        self._start_time = time.time()
+        self._lock = threading.Lock()
+
+    def enable(self):
+        # type: () -> None
+        self.enabled = True
+        self.events = []
+        self._start_time = time.time()
+
+    def span(self, name, category="phase", **span_args):
+        # type: (str, str, ...) -> _Span
+        if not self.enabled:
+            return _NULL_SPAN
+        return _Span(self, name, category, span_args)
+
+    def _add(self, span, end_time):
+        event = {
+            "name": span.name,
+            "cat": span.category,
+            "ph": "X",
+            "ts": int((span.start_time - self._start_time) * 1000000),
+            "dur": int((end_time - span.start_time) * 1000000),
+            "pid": os.getpid(),
+            "tid": threading.current_thread().ident,
+            "args": span.args,
+        }
+        with self._lock:
+            self.events.append(event)
+
+    def get_chrome_trace(self):
+        # type: () -> dict
+        with self._lock:
+            events = sorted(self.events, key=lambda e: (e["ts"], -e["dur"]))
+        thread_names = {}
+        for thread in threading.enumerate():
+            thread_names[thread.ident] = thread.name
+        metadata = [{"name": "thread_name", "ph": "M", "pid": os.getpid(), "tid": tid,
+                     "args": {"name": thread_names.get(tid, str(tid))}}
+                    for tid in sorted(set(e["tid"] for e in events))]
+        return {"traceEvents": metadata + events, "displayTimeUnit": "ms"}
+
+    def write_chrome_trace(self, path):
+        # type: (str) -> None
+        with open(path, 'w') as f:
+            json.dump(self.get_chrome_trace(), f)
+
+    def get_summary(self, count=20):
+        # type: (int) -> str
+        # Total time, number of spans and the longest span for the count most expensive span names
+        with self._lock:
+            events = list(self.events)
+
+        totals = {}
+        for event in events:
+            key = (event["cat"], event["name"])
+            total, calls, longest = totals.get(key, (0, 0, 0))
+            totals[key] = (total + event["dur"], calls + 1, max(longest, event["dur"]))
+
+        lines = ["{0:>10}  {1:>6}  {2:>10}  {3}".format("total", "count", "longest", "span")]
+        for (category, name), (total, calls, longest) in sorted(totals.iteritems(), key=lambda t: t[1],
+                                                                 reverse=True)[:count]:
+            lines.append("{0:9.3f}s  {1:6}  {2:9.3f}s  {3}: {4}".format(total / 1000000.0, calls,
+                                                                       longest / 1000000.0, category, name))
+        return "\n".join(lines)
+
+
+tracer = Tracer()
+
+
+def traced(name=None, category="phase"):
+    """
+    Decorator that puts every call of a function in a span named after the function, unless another name is given
+    """
+    def decorator(func):
+        span_name = name or func.__name__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not tracer.enabled:
+                return func(*args, **kwargs)
+            with tracer.span(span_name, category):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
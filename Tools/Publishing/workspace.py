@@ -0,0 +1,102 @@
+import difflib
+import json
+import os
+import shutil
+import tempfile
+import threading
+from collections import OrderedDict
+
+
+def serialize_json(data):
+    # type: (dict) -> str
+    # The same formatting the publishing scripts have always written manifest.json and package.json files with
+    return json.dumps(data, indent=4)
+
+
+def _parse_json(text):
+    # Keeping the order of the keys makes the written files and the diffs only show what was actually edited
+    return json.loads(text, object_pairs_hook=OrderedDict)
+
+
+class Workspace(object):
+    """
+    The manifest.json and the package.json files of a packages folder. Every file is read once, the first time it is
+    asked for, and all edits are made to the parsed documents in memory. Nothing is written until save is called,
+    which writes the files that have changed, each one atomically. Until then get_diff shows what would be written.
+    """
+
+    MANIFEST = "manifest.json"
+    TEMP_PREFIX = ".tmp-"
+
+    def __init__(self, packages_path):
+        # type: (str) -> None
+        self.packages_path = packages_path
+        # relative path -> (text on disk, parsed document)
+        self._files = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _get(self, relative_path):
+        with self._lock:
+            if relative_path not in self._files:
+                with open(os.path.join(self.packages_path, relative_path), 'r') as f:
+                    text = f.read()
+                self._files[relative_path] = (text, _parse_json(text))
+            return self._files[relative_path][1]
+
+    def get_manifest(self):
+        # type: () -> dict
+        return self._get(self.MANIFEST)
+
+    def get_package_file(self, package_name):
+        # type: (str) -> dict
+        return self._get("{0}/package.json".format(package_name))
+
+    def forget_package(self, package_name):
+        # type: (str) -> None
+        # For packages whose folder has been removed, so save doesn't bring their package.json back
+        with self._lock:
+            self._files.pop("{0}/package.json".format(package_name), None)
+
+    def get_changed_files(self):
+        # type: () -> [str]
+        # Files are compared by their content, so a file that is only formatted differently isn't rewritten
+        with self._lock:
+            return [relative_path for relative_path, (text, data) in self._files.iteritems()
+                    if _parse_json(text) != data]
+
+    def get_diff(self):
+        # type: () -> str
+        diff = []
+        for relative_path in self.get_changed_files():
+            text, data = self._files[relative_path]
+            diff.extend(difflib.unified_diff(text.splitlines(True), serialize_json(data).splitlines(True),
+                                             "a/{0}".format(relative_path), "b/{0}".format(relative_path)))
+        return "".join(line if line.endswith("\n") else line + "\n" for line in diff)
+
+    def save(self):
+        # type: () -> [str]
+        # Writes all changed files and returns their paths relative to the packages folder
+        changed_files = self.get_changed_files()
+        for relative_path in changed_files:
+            text = serialize_json(self._files[relative_path][1])
+            self._write(os.path.join(self.packages_path, relative_path), text)
+            self._files[relative_path] = (text, self._files[relative_path][1])
+        return changed_files
+
+    def _write(self, path, text):
+        handle, temp_path = tempfile.mkstemp(prefix=self.TEMP_PREFIX, dir=os.path.dirname(os.path.abspath(path)))
+        try:
+            with os.fdopen(handle, 'w') as f:
+                f.write(text)
+            # mkstemp creates the file only readable by us, the file it replaces keeps its permissions
+            if os.path.exists(path):
+                shutil.copymode(path, temp_path)
+            try:
+                os.rename(temp_path, path)
+            except OSError:
+                # On Windows rename can't replace an existing file
+                os.remove(path)
+                os.rename(temp_path, path)
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)